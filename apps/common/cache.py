@@ -0,0 +1,54 @@
+import math
+import random
+import time
+
+from django.core.cache import cache
+
+LOCK_TIMEOUT = 10
+WAIT_INTERVAL = 0.05
+WAIT_ATTEMPTS = 20
+
+
+def expires_early(entry, beta=1.0) -> bool:
+    """
+    Probabilistic early expiration (XFetch).
+
+    The closer an entry gets to its expiry and the longer it took to compute, the likelier a request
+    treats it as expired, so one request refreshes it before all of them miss at the same time.
+    """
+    return time.time() - entry["delta"] * beta * math.log(1.0 - random.random()) >= entry["expiry"]
+
+
+def get_or_compute(key, compute, timeout, usable=None):
+    """
+    Value cached under `key`, recomputed by a single process at a time.
+
+    `usable(value)` tells whether a cached value can answer the current request, e.g. a cached top-N
+    serves any smaller N. While another process holds the refresh lock the current (possibly expired)
+    value is served; requests without any usable value wait for the refresh before computing it themselves.
+    """
+    usable = usable or (lambda value: True)
+    entry = cache.get(key)
+    if entry is not None and usable(entry["value"]) and not expires_early(entry):
+        return entry["value"]
+
+    lock_key = f"{key}:lock"
+    locked = cache.add(lock_key, True, timeout=LOCK_TIMEOUT)
+    if not locked:
+        for attempt in range(WAIT_ATTEMPTS + 1):
+            if entry is not None and usable(entry["value"]):
+                return entry["value"]
+            if attempt < WAIT_ATTEMPTS:
+                time.sleep(WAIT_INTERVAL)
+                entry = cache.get(key)
+
+    try:
+        started = time.monotonic()
+        value = compute()
+        delta = time.monotonic() - started
+        # The entry outlives its expiry so that it can be served while it is being refreshed
+        cache.set(key, {"value": value, "delta": delta, "expiry": time.time() + timeout}, timeout=timeout * 2)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+    return value
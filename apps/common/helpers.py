@@ -1,5 +1,85 @@
-from rest_framework import serializers
+from functools import cached_property
+
+from django.conf import settings
+from django.utils.duration import duration_string
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
 
 
 class EmptySerializer(serializers.Serializer):
     pass
+
+
+class ValuesSerializer:
+    """
+    Read-only counterpart of a ModelSerializer that renders `.values()` rows.
+
+    The field plan (output name, values() lookup, representation function) is compiled from the
+    serializer's own fields, so the output matches the serializer and the OpenAPI schema can keep
+    pointing at it, while no model instances or bound fields are created per row.
+    """
+
+    # Fields whose representation of a values() column is the column itself
+    passthrough_fields = (
+        serializers.BooleanField,
+        serializers.CharField,
+        serializers.IntegerField,
+        serializers.PrimaryKeyRelatedField,
+    )
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+
+    @cached_property
+    def fields(self):
+        pk_name = self.serializer_class.Meta.model._meta.pk.name
+        fields = []
+        for name, field in self.serializer_class().fields.items():
+            if field.write_only:
+                continue
+            lookup = pk_name if field.source == "pk" else field.source.replace(".", "__")
+            fields.append((name, lookup, field))
+        return fields
+
+    def values(self, queryset):
+        return queryset.values(*[lookup for _, lookup, _ in self.fields])
+
+    def compile(self):
+        # Resolved per call, the datetime representation depends on the active timezone
+        return [(name, lookup, self.representation(field)) for name, lookup, field in self.fields]
+
+    def representation(self, field):
+        if isinstance(field, self.passthrough_fields):
+            return None
+        if isinstance(field, serializers.DurationField):
+            return duration_string
+        if isinstance(field, serializers.DateTimeField):
+            output_format = getattr(field, "format", api_settings.DATETIME_FORMAT)
+            if output_format and output_format.lower() == ISO_8601:
+                tz = field.timezone if hasattr(field, "timezone") else field.default_timezone()
+                return self.iso_datetime(tz)
+        return field.to_representation
+
+    @staticmethod
+    def iso_datetime(tz):
+        def to_representation(value):
+            value = value.astimezone(tz).isoformat() if tz is not None else value.isoformat()
+            return value[:-6] + "Z" if value.endswith("+00:00") else value
+
+        return to_representation
+
+    def iter_representation(self, rows):
+        plan = self.compile()
+        for row in rows:
+            yield {
+                name: row[lookup] if representation is None or row[lookup] is None else representation(row[lookup])
+                for name, lookup, representation in plan
+            }
+
+    def to_representation(self, rows):
+        return list(self.iter_representation(rows))
+
+    def iterator(self, queryset, chunk_size=None):
+        """Lazily render the queryset, fetching rows through a server-side cursor where the database has one"""
+        rows = self.values(queryset).iterator(chunk_size=chunk_size or settings.STREAMING_CHUNK_SIZE)
+        return self.iter_representation(rows)
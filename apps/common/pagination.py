@@ -0,0 +1,16 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class IdCursorPagination(CursorPagination):
+    """
+    Keyset pagination over the primary key.
+
+    The cursor encodes the last seen id, so pages stay stable while new rows are inserted
+    and every page is an indexed range scan instead of an OFFSET over the whole table.
+    """
+
+    ordering = "id"
+    page_size = settings.PAGINATION_PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = settings.PAGINATION_MAX_PAGE_SIZE
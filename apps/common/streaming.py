@@ -0,0 +1,127 @@
+import csv
+import io
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+stream_parameter = OpenApiParameter(
+    name="stream",
+    type=OpenApiTypes.BOOL,
+    location=OpenApiParameter.QUERY,
+    required=False,
+    description="Stream the whole collection as a single unpaginated JSON array (optional)",
+)
+
+
+def wants_stream(request) -> bool:
+    return request.query_params.get("stream", "").lower() in ("1", "true")
+
+
+def iter_json_array(items, batch_size=None):
+    """Encode `items` as one JSON array, yielding a chunk of text for every `batch_size` items"""
+    batch_size = batch_size or settings.STREAMING_CHUNK_SIZE
+    encode = JSONEncoder(ensure_ascii=False).encode
+
+    yield "["
+    batch = []
+    separator = ""
+    for item in items:
+        batch.append(separator + encode(item))
+        separator = ","
+        if len(batch) >= batch_size:
+            yield "".join(batch)
+            batch = []
+    yield "".join(batch) + "]"
+
+
+def stream_json_array(items):
+    """
+    Response that writes `items` as a JSON array while they are produced.
+
+    Pass a lazy iterable (e.g. queryset.iterator(chunk_size=...)) so that neither the rows nor
+    the encoded body are held in memory as a whole.
+    """
+    return StreamingHttpResponse(iter_json_array(items), content_type="application/json")
+
+
+def iter_csv(fieldnames, items, batch_size=None):
+    """Encode `items` as CSV with a header row, yielding a chunk of text for every `batch_size` items"""
+    batch_size = batch_size or settings.STREAMING_CHUNK_SIZE
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction="ignore")
+
+    writer.writeheader()
+    for count, item in enumerate(items, 1):
+        writer.writerow(item)
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_ndjson(items, batch_size=None):
+    """Encode `items` as newline delimited JSON, yielding a chunk of text for every `batch_size` items"""
+    batch_size = batch_size or settings.STREAMING_CHUNK_SIZE
+    encode = JSONEncoder(ensure_ascii=False).encode
+
+    batch = []
+    for item in items:
+        batch.append(encode(item) + "\n")
+        if len(batch) >= batch_size:
+            yield "".join(batch)
+            batch = []
+    yield "".join(batch)
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    Selects CSV on the export endpoints (?format=csv or Accept: text/csv).
+
+    Exports are streamed without going through the renderer, it only renders their error responses.
+    """
+
+    media_type = "text/csv"
+    format = "csv"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        rows = [
+            row if isinstance(row, dict) else {"detail": row} for row in (data if isinstance(data, list) else [data])
+        ]
+        fieldnames = list(dict.fromkeys(name for row in rows for name in row))
+        return "".join(iter_csv(fieldnames, rows)).encode(self.charset)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Selects newline delimited JSON on the export endpoints (?format=ndjson or Accept: application/x-ndjson)"""
+
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return "".join(iter_ndjson(data if isinstance(data, list) else [data])).encode(self.charset)
+
+
+export_renderer_classes = [CSVRenderer, NDJSONRenderer]
+
+
+def stream_export(items, fieldnames, export_format, filename):
+    """
+    Response that downloads `items` as CSV or NDJSON while they are produced.
+
+    Like stream_json_array(), pass a lazy iterable so that memory use does not grow with the export.
+    """
+    if export_format == CSVRenderer.format:
+        response = StreamingHttpResponse(iter_csv(fieldnames, items), content_type=CSVRenderer.media_type)
+    else:
+        response = StreamingHttpResponse(iter_ndjson(items), content_type=NDJSONRenderer.media_type)
+    response["Content-Disposition"] = f'attachment; filename="{filename}.{export_format}"'
+    return response
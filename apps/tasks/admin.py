@@ -6,12 +6,32 @@ from apps.tasks.models import Task, Comment, TimeLog, TaskAttachment
 
 @admin.register(Task)
 class TaskAdmin(admin.ModelAdmin):
-    list_display = ["id", "title", "description", "user", "is_completed"]
+    list_display = [
+        "id",
+        "title",
+        "description",
+        "user",
+        "is_completed",
+        "time_spent",
+        "comment_count",
+        "attachment_count",
+    ]
     list_display_links = ["title"]
     search_fields = ["title", "description"]
     list_filter = ["is_completed"]
     actions = ["mark_completed", "mark_incomplete", "delete_time_logs"]
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_comment_count().with_attachment_count()
+
+    @admin.display(ordering="comment_count")
+    def comment_count(self, obj):
+        return obj.comment_count
+
+    @admin.display(ordering="attachment_count")
+    def attachment_count(self, obj):
+        return obj.attachment_count
+
     @admin.action(description="Mark task as completed and email users")
     def mark_completed(self, request, queryset: QuerySet):
         for task in queryset:
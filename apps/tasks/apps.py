@@ -6,4 +6,4 @@ class TasksConfig(AppConfig):
     name = "apps.tasks"
 
     def ready(self):
-        pass
+        from apps.tasks import signals  # noqa: F401
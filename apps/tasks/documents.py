@@ -1,20 +1,53 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
 from django_elasticsearch_dsl import Document, fields
 from django_elasticsearch_dsl.registries import registry
+from django_elasticsearch_dsl.signals import RealTimeSignalProcessor
 
 from apps.tasks.models import Task, Comment
+from apps.tasks.signals import deleted_directly
 from apps.users.models import User
 
+logger = logging.getLogger(__name__)
+
+# Set while the document of the task is scheduled to be indexed
+INDEX_PENDING_KEY = "tasks:search:pending:{}"
+# Name of the index being built by reindex-tasks, before the alias is swapped to it
+REINDEX_TARGET_KEY = "tasks:search:reindex-target"
+REINDEX_TARGET_TIMEOUT = 60 * 60 * 24
+# Ids of the tasks changed while an index is built, appended under the numbers counted by REINDEX_CHANGES_COUNT_KEY
+REINDEX_CHANGES_KEY = "tasks:search:reindex:{}:changes:{}"
+REINDEX_CHANGES_COUNT_KEY = "tasks:search:reindex:{}:changes"
+
+# Replaces the comments with the ids `params.ids` in a task document by `params.comments`, their current version.
+# Documents indexed before the comments had ids are left as they are (a noop), the whole document is indexed instead.
+COMMENTS_SCRIPT = """
+if (ctx._source.comments == null) { ctx._source.comments = []; }
+if (ctx._source.comments.stream().anyMatch(comment -> comment.id == null)) {
+  ctx.op = 'none';
+} else {
+  ctx._source.comments.removeIf(comment -> params.ids.contains(comment.id));
+  ctx._source.comments.addAll(params.comments);
+}
+"""
+
 
 @registry.register_document
 class TaskDocument(Document):
     user = fields.ObjectField(
         properties={
+            "id": fields.LongField(),
             "email": fields.TextField(),
         }
     )
 
     comments = fields.NestedField(
         properties={
+            # Identifies the comment in the scripted updates of the document
+            "id": fields.LongField(),
             "body": fields.TextField(),
         }
     )
@@ -26,11 +59,152 @@ class TaskDocument(Document):
     class Django:
         model = Task
 
-        fields = ["title", "description", "is_completed"]
+        # The id is the tiebreaker of the search_after cursor of the task search
+        fields = ["id", "title", "description", "is_completed"]
         related_models = [Comment, User]
 
+    def get_queryset(self):
+        return super().get_queryset().select_related("user").prefetch_related("comments")
+
     def get_instances_from_related(self, related_instance):
         if isinstance(related_instance, User):
             return related_instance.task_set.all()
         elif isinstance(related_instance, Comment):
             return related_instance.task
+
+
+class TaskSignalProcessor(RealTimeSignalProcessor):
+    """
+    Index the tasks changed by a save or delete in a Celery task instead of in the request.
+
+    Only the task ids are queued, once the transaction is committed. The documents are built from the
+    database when the task runs, so every write to a task within ELASTICSEARCH_INDEX_WINDOW seconds is
+    indexed by a single bulk request. A changed comment is written into the document of its task with a
+    script, without loading and sending the other comments of the task. A comment moved to another task is
+    removed from the document of its previous task as well.
+
+    The only field of a user in the documents is the email, so other changes to users, e.g. of last_login
+    on every login, are not indexed and a new email is set in the documents of the user by one
+    update_by_query.
+    """
+
+    def setup(self):
+        super().setup()
+        models.signals.pre_save.connect(self.handle_user_pre_save, sender=User)
+        models.signals.pre_save.connect(self.handle_comment_pre_save, sender=Comment)
+
+    def teardown(self):
+        super().teardown()
+        models.signals.pre_save.disconnect(self.handle_user_pre_save, sender=User)
+        models.signals.pre_save.disconnect(self.handle_comment_pre_save, sender=Comment)
+
+    def handle_user_pre_save(self, sender, instance, update_fields=None, **kwargs):
+        if instance.pk is None or (update_fields is not None and "email" not in update_fields):
+            return
+        instance._indexed_email = User.objects.filter(pk=instance.pk).values_list("email", flat=True).first()
+
+    def handle_comment_pre_save(self, sender, instance, update_fields=None, **kwargs):
+        if instance.pk is None or (update_fields is not None and not {"task", "task_id"} & set(update_fields)):
+            return
+        instance._indexed_task_id = Comment.objects.filter(pk=instance.pk).values_list("task_id", flat=True).first()
+
+    def handle_save(self, sender, instance, **kwargs):
+        if isinstance(instance, User):
+            indexed_email = instance.__dict__.pop("_indexed_email", instance.email)
+            if indexed_email != instance.email:
+                update_user_documents(instance.pk)
+            return
+
+        if isinstance(instance, Comment):
+            update_comment_documents(instance.task_id, instance.pk)
+            indexed_task_id = instance.__dict__.pop("_indexed_task_id", instance.task_id)
+            if indexed_task_id not in (None, instance.task_id):
+                update_comment_documents(indexed_task_id, instance.pk)
+        elif isinstance(instance, Task):
+            update_task_documents([instance.pk])
+
+    def handle_pre_delete(self, sender, instance, origin=None, **kwargs):
+        # The tasks of a deleted user are deleted with it, the comments of a deleted task with its document
+        if isinstance(instance, Comment) and deleted_directly(sender, instance, origin):
+            self.handle_save(sender, instance)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        if isinstance(instance, Task):
+            self.handle_save(sender, instance)
+
+
+def update_reindex_target(document, tasks, action="index"):
+    """Write the changes to the index being rebuilt as well, the alias still points to the previous one"""
+    target = cache.get(REINDEX_TARGET_KEY)
+    if target is None:
+        return
+    record_reindex_changes(target, [task.id for task in tasks])
+    actions = ({**action, "_index": target} for action in document.get_actions(tasks, action))
+    document.bulk(actions, raise_on_error=False)
+
+
+def record_reindex_changes(target, task_ids):
+    """
+    Record tasks changed while the target index is built. Their documents written by the load may be older
+    than the ones written by the syncs, reindex-tasks indexes them again before the alias is swapped.
+    """
+    count_key = REINDEX_CHANGES_COUNT_KEY.format(target)
+    cache.add(count_key, 0, timeout=REINDEX_TARGET_TIMEOUT)
+    number = cache.incr(count_key)
+    cache.set(REINDEX_CHANGES_KEY.format(target, number), list(task_ids), timeout=REINDEX_TARGET_TIMEOUT)
+
+
+def reindex_changes(target):
+    """Ids of the tasks recorded as changed while the target index is built"""
+    count = cache.get(REINDEX_CHANGES_COUNT_KEY.format(target), 0)
+    changes = cache.get_many([REINDEX_CHANGES_KEY.format(target, number) for number in range(1, count + 1)])
+    return set().union(*changes.values())
+
+
+def update_task_documents(task_ids):
+    """
+    Schedule the indexing of tasks, including the ones written with QuerySet.update() or bulk_create(),
+    which send no signals. A task is scheduled once per window, the first change of the window schedules it.
+    """
+    if not settings.ELASTICSEARCH_ACTIVE:
+        return
+
+    def schedule():
+        from apps.tasks.tasks import sync_task_documents
+
+        window = settings.ELASTICSEARCH_INDEX_WINDOW
+        waiting = [
+            task_id for task_id in set(task_ids) if cache.add(INDEX_PENDING_KEY.format(task_id), True, timeout=window)
+        ]
+        if not waiting:
+            return
+        try:
+            sync_task_documents.apply_async((sorted(waiting),), countdown=window)
+        except Exception:
+            # Not scheduled, the next change of the tasks schedules them again instead of waiting out the window
+            cache.delete_many([INDEX_PENDING_KEY.format(task_id) for task_id in waiting])
+            logger.warning("Could not schedule the indexing of tasks %s", sorted(waiting), exc_info=True)
+
+    transaction.on_commit(schedule)
+
+
+def update_comment_documents(task_id, comment_id):
+    """
+    Schedule the update of a comment in the document of its task, once the transaction is committed.
+    Nothing is scheduled while the whole document is, it is built with the comment.
+    """
+
+    def schedule():
+        from apps.tasks.tasks import sync_task_comments
+
+        if cache.get(INDEX_PENDING_KEY.format(task_id)) is None:
+            sync_task_comments.delay(task_id, [comment_id])
+
+    transaction.on_commit(schedule)
+
+
+def update_user_documents(user_id):
+    """Set the email of a user in the documents of their tasks, once the transaction is committed"""
+    from apps.tasks.tasks import sync_user_documents
+
+    transaction.on_commit(lambda: sync_user_documents.delay(user_id))
@@ -0,0 +1,167 @@
+"""
+Bulk import of stopped time logs from CSV or NDJSON bodies.
+
+Records are parsed while the request body is read and validated together: the owners of the tasks
+and the existing logs of those tasks are fetched in one query each, the logs of every task are
+sorted once and swept for overlaps, and the accepted rows are inserted with bulk_create. The stored
+time spent and the rollups are then recomputed once per task instead of once per log.
+"""
+
+import codecs
+import csv
+import json
+import math
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.exceptions import ParseError, UnsupportedMediaType
+from rest_framework.fields import empty
+
+from apps.tasks.exceptions import TimeLogError
+from apps.tasks.models import Task, TimeLog, TimeLogRollup
+
+CSV_MEDIA_TYPES = ("text/csv",)
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/jsonl")
+
+FIELDS = {
+    "task": serializers.IntegerField(min_value=1),
+    "start_time": serializers.DateTimeField(),
+    "duration": serializers.DurationField(min_value=timezone.timedelta(seconds=1)),
+}
+
+# End of a running log, which is open ended
+OPEN_END = datetime.max.replace(tzinfo=dt_timezone.utc)
+
+
+def read_records(stream, content_type, max_records):
+    """(line number, record) of every record of a CSV body with a header row or of an NDJSON body"""
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type not in CSV_MEDIA_TYPES + NDJSON_MEDIA_TYPES:
+        raise UnsupportedMediaType(media_type)
+    if stream is None:
+        return
+
+    lines = codecs.iterdecode(stream, "utf-8-sig")
+    if media_type in CSV_MEDIA_TYPES:
+        reader = csv.DictReader(lines)
+        if reader.fieldnames is None or not set(FIELDS) <= set(reader.fieldnames):
+            raise ParseError(f"CSV header must contain the columns {", ".join(FIELDS)}")
+        records = ((reader.line_num, record) for record in reader)
+    else:
+        records = ((line_num, parse_json(line)) for line_num, line in enumerate(lines, 1) if line.strip())
+
+    for count, record in enumerate(records, 1):
+        if count > max_records:
+            raise ParseError(f"Expected at most {max_records} time logs")
+        yield record
+
+
+def parse_json(line):
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) else None
+
+
+def clean(record):
+    """Validated (task id, start time, duration) of a record, or its errors by field"""
+    if record is None:
+        return None, {"non_field_errors": ["Expected a JSON object"]}
+
+    values, errors = [], {}
+    for name, field in FIELDS.items():
+        value = record.get(name)
+        try:
+            values.append(field.run_validation(empty if value in (None, "") else value))
+        except serializers.ValidationError as e:
+            errors[name] = e.detail
+    if errors:
+        return None, errors
+
+    task_id, start_time, duration = values
+    # Stored in whole seconds, like TimeLog.save()
+    return (task_id, start_time, timezone.timedelta(seconds=math.floor(duration.total_seconds()))), None
+
+
+def sweep(existing, rows):
+    """
+    Split the rows of one task into the accepted and the overlapping ones.
+
+    `existing` are the (start, end) of the logs of the task and `rows` the imported (line, start, duration),
+    both sorted by start. Existing logs never overlap each other, so a row is accepted if it starts after the
+    end of everything before it and ends before the start of the next existing log.
+    """
+    accepted, rejected = [], []
+    end = None
+    position = 0
+    for row in rows:
+        _, start, duration = row
+        while position < len(existing) and existing[position][0] < start:
+            end = existing[position][1] if end is None else max(end, existing[position][1])
+            position += 1
+        following = existing[position][0] if position < len(existing) else None
+
+        if (end is not None and end > start) or (following is not None and following < start + duration):
+            rejected.append(row)
+        else:
+            accepted.append(row)
+            end = start + duration
+    return accepted, rejected
+
+
+def import_time_logs(user, records):
+    """
+    Insert the valid records as time logs of the tasks of `user`.
+
+    Returns the number of created logs and the errors of the rejected records by line.
+    """
+    errors = []
+    rows = defaultdict(list)
+    for line, record in records:
+        values, record_errors = clean(record)
+        if record_errors:
+            errors.append({"line": line, "errors": record_errors})
+        else:
+            task_id, start_time, duration = values
+            rows[task_id].append((line, start_time, duration))
+
+    owners = dict(Task.objects.filter(id__in=list(rows)).values_list("id", "user_id"))
+    for task_id in list(rows):
+        if owners.get(task_id) == user.id:
+            continue
+        error = "Task does not exist" if task_id not in owners else "You are not authorized to log time for this task"
+        errors += [{"line": line, "errors": {"task": [error]}} for line, _, _ in rows.pop(task_id)]
+
+    existing = defaultdict(list)
+    logs = TimeLog.objects.filter(task_id__in=list(rows)).order_by("task_id", "start_time")
+    for task_id, start_time, duration in logs.values_list("task_id", "start_time", "duration").iterator(
+        chunk_size=settings.STREAMING_CHUNK_SIZE
+    ):
+        existing[task_id].append((start_time, start_time + duration if duration is not None else OPEN_END))
+
+    time_logs = []
+    for task_id, task_rows in rows.items():
+        accepted, rejected = sweep(existing[task_id], sorted(task_rows, key=lambda row: (row[1], row[0])))
+        time_logs += [TimeLog(task_id=task_id, start_time=start, duration=duration) for _, start, duration in accepted]
+        errors += [
+            {"line": line, "errors": {"start_time": ["TimeLog overlaps with another timeLog"]}}
+            for line, _, _ in rejected
+        ]
+
+    if time_logs:
+        task_ids = {time_log.task_id for time_log in time_logs}
+        try:
+            with transaction.atomic():
+                TimeLog.objects.bulk_create(time_logs, batch_size=settings.STREAMING_CHUNK_SIZE)
+                Task.objects.filter(id__in=task_ids).update_time_spent()
+                TimeLogRollup.rebuild(task_ids)
+        except IntegrityError as e:
+            # Logs written by a concurrent request after they were fetched, caught by the constraints
+            raise TimeLogError("Time logs of the imported tasks changed during the import, nothing was imported") from e
+
+    return len(time_logs), sorted(errors, key=lambda error: error["line"])
@@ -0,0 +1,142 @@
+import random
+import statistics
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from apps.tasks.models import Task, TimeLog, TimeLogRollup
+from apps.users.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Report query plans and timings of the queries behind the task endpoints on a generated dataset, "
+        "optionally compared to the same queries without the tasks app indexes. Everything is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20, help="Users to generate, 0 benchmarks the existing data")
+        parser.add_argument("--tasks", type=int, default=50, help="Tasks to generate per user")
+        parser.add_argument("--logs", type=int, default=200, help="Time logs to generate per task")
+        parser.add_argument("--repeat", type=int, default=20, help="Runs of every query")
+        parser.add_argument("--compare", action="store_true", default=False, help="Also run without the indexes")
+        parser.add_argument("--plans", action="store_true", default=False, help="Print the query plans")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options["users"]:
+                self.generate(options["users"], options["tasks"], options["logs"])
+
+            user = User.objects.filter(task__isnull=False).order_by("id").first()
+            if user is None:
+                self.stdout.write(self.style.ERROR("No tasks found. Generate some with --users"))
+                return
+            queries = self.queries(user)
+
+            timings = {"with indexes": self.run("with indexes", queries, options)}
+            if options["compare"]:
+                with transaction.atomic():
+                    self.drop_indexes()
+                    timings["without indexes"] = self.run("without indexes", queries, options)
+                    transaction.set_rollback(True)
+
+            self.report(timings)
+            transaction.set_rollback(True)
+
+    def generate(self, user_nr, task_nr, log_nr):
+        tag = f"benchmark-{time.time_ns()}"
+        users = User.objects.bulk_create(
+            User(username=f"{tag}-{i}", email=f"{tag}-{i}@example.mail.com") for i in range(user_nr)
+        )
+        tasks = Task.objects.bulk_create(
+            Task(title=f"{tag} task {i}", description=tag, user=user, is_completed=random.random() < 0.5)
+            for user in users
+            for i in range(task_nr)
+        )
+
+        # Logs of a task follow each other over the last 90 days, so they never overlap
+        now = timezone.now()
+        spacing = timezone.timedelta(days=90) / log_nr
+        logs = (
+            TimeLog(
+                task=task,
+                start_time=now - spacing * (i + 1),
+                duration=timezone.timedelta(seconds=random.randint(60, max(60, int(spacing.total_seconds() / 2)))),
+            )
+            for task in tasks
+            for i in range(log_nr)
+        )
+        TimeLog.objects.bulk_create(logs, batch_size=settings.STREAMING_CHUNK_SIZE)
+        TimeLogRollup.rebuild()
+
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        self.stdout.write(
+            f"Generated {user_nr} users, {user_nr * task_nr} tasks and {user_nr * task_nr * log_nr} time logs."
+        )
+
+    @staticmethod
+    def queries(user):
+        now = timezone.now()
+        last_month = now - timezone.timedelta(days=30)
+        task = Task.objects.filter(user=user).order_by("id").first()
+        page_size = settings.PAGINATION_PAGE_SIZE
+        return {
+            "tasks list": Task.objects.filter(user=user).order_by("id")[:page_size],
+            "completed tasks": Task.objects.filter(user=user, is_completed=True).order_by("id")[:page_size],
+            "timer logs": TimeLog.objects.filter(task=task),
+            "running timer": TimeLog.objects.filter(task=task, duration=None),
+            "overlap check": TimeLog.objects.filter(task=task, start_time__lt=now).order_by("-start_time")[:1],
+            "last month logs": TimeLog.objects.filter(task__user=user, start_time__gte=last_month, start_time__lte=now)
+            .exclude(duration=None)
+            .values("duration"),
+            "last month rollups": TimeLogRollup.objects.filter(user=user, day__gte=last_month.date()).values(
+                "total_duration"
+            ),
+            "top logs": TimeLog.user_top_logs(user, 20),
+        }
+
+    def run(self, phase, queries, options):
+        timings = {}
+        for name, queryset in queries.items():
+            if options["plans"]:
+                self.stdout.write(self.style.MIGRATE_HEADING(f"{name} ({phase})"))
+                self.stdout.write(self.explain(phase, queryset))
+
+            durations = []
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                list(queryset.all())
+                durations.append((time.perf_counter() - started) * 1000)
+            timings[name] = statistics.median(durations)
+        return timings
+
+    @staticmethod
+    def explain(phase, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            # The phase comment keeps sqlite3 from answering with a plan it cached before the indexes were dropped
+            cursor.execute(f"{connection.ops.explain_query_prefix()} {sql} -- {phase}", params)
+            return "\n".join(" ".join(map(str, row)) for row in cursor.fetchall())
+
+    @staticmethod
+    def drop_indexes():
+        """Drop the declared indexes of the tasks app, including the partial unique ones"""
+        names = []
+        for model in apps.get_app_config("tasks").get_models():
+            names += [index.name for index in model._meta.indexes]
+            names += [constraint.name for constraint in model._meta.constraints if constraint.condition is not None]
+
+        with connection.cursor() as cursor:
+            for name in names:
+                cursor.execute(f"DROP INDEX {connection.ops.quote_name(name)}")
+
+    def report(self, timings):
+        columns = list(timings)
+        self.stdout.write(self.style.MIGRATE_HEADING(f"{'median ms':<20}" + "".join(f"{c:>18}" for c in columns)))
+        for name in timings[columns[0]]:
+            self.stdout.write(f"{name:<20}" + "".join(f"{timings[c][name]:>18.3f}" for c in columns))
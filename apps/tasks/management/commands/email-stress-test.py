@@ -1,16 +1,23 @@
 import random
 
+from django.conf import settings
 from django.core.management import BaseCommand
 
-from apps.tasks.tasks import c_send_mail
+from apps.tasks.tasks import c_send_mail, mail_message, send_mail_batches
 from apps.users.models import User
 
 
 class Command(BaseCommand):
-    help = "Populate the database with random comments"
+    help = "Send emails to random test users, in batches over one SMTP connection or one task per email"
 
     def add_arguments(self, parser):
         parser.add_argument("email-nr", type=int)
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.MAIL_BATCH_SIZE,
+            help="Emails per batch mail task, 0 sends one task per email",
+        )
 
     def handle(self, *args, **options):
         email_nr = options["email-nr"]
@@ -19,14 +26,20 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR("No users found. Please create test users first"))
             return
 
-        for i in range(email_nr):
-            user = random.choice(user_list)
-            c_send_mail.delay(
-                [user.email],
-                f"Email Nr {i}",
-                "QWERTY-QWERTY-QWERTY-QWERTY-QWERTY\n"
-                + "QWERTY-QWERTY-QWERTY-QWERTY-QWERTY\n"
-                + "QWERTY-QWERTY-QWERTY-QWERTY-QWERTY\n"
-                + "QWERTY-QWERTY-QWERTY-QWERTY-QWERTY\n"
-                + "QWERTY-QWERTY-QWERTY-QWERTY-QWERTY\n",
-            )
+        body = (
+            "QWERTY-QWERTY-QWERTY-QWERTY-QWERTY\n"
+            + "QWERTY-QWERTY-QWERTY-QWERTY-QWERTY\n"
+            + "QWERTY-QWERTY-QWERTY-QWERTY-QWERTY\n"
+            + "QWERTY-QWERTY-QWERTY-QWERTY-QWERTY\n"
+            + "QWERTY-QWERTY-QWERTY-QWERTY-QWERTY\n"
+        )
+        messages = (mail_message([random.choice(user_list).email], f"Email Nr {i}", body) for i in range(email_nr))
+
+        if options["batch_size"] <= 0:
+            for message in messages:
+                c_send_mail.delay(**message)
+            self.stdout.write(self.style.SUCCESS(f"Enqueued {email_nr} emails"))
+            return
+
+        batches = send_mail_batches(messages, options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Enqueued {email_nr} emails in {batches} batches"))
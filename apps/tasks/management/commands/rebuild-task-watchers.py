@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from apps.tasks.models import TaskWatcher
+
+
+class Command(BaseCommand):
+    help = "Rebuild the watchers (owner and commenters) of every task (or of the given tasks)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--task", type=int, action="append", dest="tasks", help="Only rebuild this task")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of watchers inserted per query")
+
+    def handle(self, *args, **options):
+        created = TaskWatcher.rebuild(options["tasks"], batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {created} task watchers."))
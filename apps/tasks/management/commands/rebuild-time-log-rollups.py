@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from apps.tasks.models import TimeLogRollup
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per day time log rollups of every task (or of the given tasks) from the time logs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--task", type=int, action="append", dest="tasks", help="Only rebuild this task")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of rollups inserted per query")
+
+    def handle(self, *args, **options):
+        created = TimeLogRollup.rebuild(options["tasks"], batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {created} time log rollups."))
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.tasks import timers
+
+
+class Command(BaseCommand):
+    help = "Rebuild the registry of running timers from the time logs without a duration"
+
+    def handle(self, *args, **options):
+        if not settings.TIMER_REGISTRY_ACTIVE:
+            self.stdout.write(self.style.WARNING("The timer registry needs the redis cache backend, nothing to do."))
+            return
+
+        running = timers.reconcile()
+        self.stdout.write(self.style.SUCCESS(f"Registered {running} running timers."))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from django.db.models.functions import NullIf
+
+from apps.tasks.models import Task, ZERO_DURATION
+
+
+class Command(BaseCommand):
+    help = "Recompute the stored time spent of every task from its time logs and fix mismatches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of tasks updated per query")
+        parser.add_argument("--dry-run", action="store_true", default=False, help="Only report mismatched tasks")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        dry_run = options["dry_run"]
+
+        tasks = (
+            Task.objects.annotate(logged=NullIf(Sum("timelog__duration"), ZERO_DURATION))
+            .only("id", "time_spent")
+            .order_by("id")
+        )
+
+        checked = 0
+        mismatched = 0
+        batch = []
+        for task in tasks.iterator(chunk_size=batch_size):
+            checked += 1
+            if task.time_spent == task.logged:
+                continue
+
+            mismatched += 1
+            self.stdout.write(f"Task {task.id}: stored={task.time_spent} logged={task.logged}")
+            batch.append(task.id)
+            if len(batch) >= batch_size:
+                self.flush(batch, dry_run)
+                batch = []
+        self.flush(batch, dry_run)
+
+        action = "Found" if dry_run else "Fixed"
+        self.stdout.write(self.style.SUCCESS(f"Checked {checked} tasks. {action} {mismatched} mismatched tasks."))
+
+    @staticmethod
+    def flush(batch, dry_run):
+        # Recompute in SQL instead of writing the values read above, so concurrent timer updates are not lost
+        if batch and not dry_run:
+            Task.objects.filter(id__in=batch).update_time_spent()
@@ -0,0 +1,107 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from elasticsearch.helpers import parallel_bulk
+
+from apps.tasks.documents import REINDEX_TARGET_KEY, REINDEX_TARGET_TIMEOUT, TaskDocument, reindex_changes
+from apps.tasks.models import Task
+
+
+class Command(BaseCommand):
+    help = (
+        "Build a new versioned tasks index in parallel and swap the tasks alias to it once the document count "
+        "is checked. Search keeps answering from the previous index during the rebuild."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="Threads sending bulk requests")
+        parser.add_argument(
+            "--chunk-size", type=int, default=settings.STREAMING_CHUNK_SIZE, help="Tasks per query and bulk request"
+        )
+        parser.add_argument(
+            "--if-missing", action="store_true", default=False, help="Only build the index if the alias does not exist"
+        )
+        parser.add_argument(
+            "--keep-previous", action="store_true", default=False, help="Keep the indexes the alias pointed to"
+        )
+
+    def handle(self, *args, **options):
+        document = TaskDocument()
+        client = document._get_connection()
+        alias = document._index._name
+
+        if options["if_missing"] and client.indices.exists(index=alias):
+            self.stdout.write(self.style.SUCCESS(f"Index {alias} already exists."))
+            return
+
+        name = f"{alias}-{timezone.now():%Y%m%d%H%M%S%f}"
+        # No refreshes while loading, the index is not searched before the swap
+        document._index.clone(name=name).settings(refresh_interval="-1").create()
+        cache.set(REINDEX_TARGET_KEY, name, timeout=REINDEX_TARGET_TIMEOUT)
+        try:
+            indexed = self.load(document, client, name, options["workers"], options["chunk_size"])
+            # Changes from now on are written into the index after the load, by the syncs
+            removed = self.resync(document, name)
+            client.indices.put_settings(index=name, settings={"refresh_interval": None})
+            client.indices.refresh(index=name)
+
+            # Tasks created during the rebuild are indexed into it as well
+            count = client.count(index=name)["count"]
+            if count < indexed - removed:
+                raise CommandError(
+                    f"Index {name} holds {count} of the {indexed - removed} indexed tasks, the alias is unchanged"
+                )
+
+            previous = self.swap(client, alias, name)
+        except BaseException:
+            client.indices.delete(index=name, ignore_unavailable=True)
+            raise
+        finally:
+            cache.delete(REINDEX_TARGET_KEY)
+
+        if previous and not options["keep_previous"]:
+            client.indices.delete(index=",".join(previous), ignore_unavailable=True)
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} tasks into {name}, alias {alias} swapped."))
+
+    @staticmethod
+    def load(document, client, name, workers, chunk_size):
+        # Comments are prefetched and users joined per chunk of tasks
+        tasks = document.get_queryset().order_by("id").iterator(chunk_size=chunk_size)
+        actions = ({**action, "_index": name} for action in document.get_actions(tasks, "index"))
+        results = parallel_bulk(client, actions, thread_count=workers, chunk_size=chunk_size)
+        return sum(1 for ok, _ in results if ok)
+
+    @staticmethod
+    def resync(document, name):
+        """
+        Index the tasks changed during the load again, the load may have overwritten their newer documents
+        or indexed tasks deleted in the meantime. Returns the number of documents deleted.
+        """
+        task_ids = reindex_changes(name)
+        tasks = list(document.get_queryset().filter(id__in=task_ids))
+        if tasks:
+            document.bulk({**action, "_index": name} for action in document.get_actions(tasks, "index"))
+        deleted = [Task(id=task_id) for task_id in sorted(task_ids - {task.id for task in tasks})]
+        if not deleted:
+            return 0
+        actions = ({**action, "_index": name} for action in document.get_actions(deleted, "delete"))
+        # Tasks deleted before the load reached them are not in the index
+        removed, _ = document.bulk(actions, raise_on_error=False)
+        return removed
+
+    @staticmethod
+    def swap(client, alias, name):
+        """Point the alias to the new index in one request, returns the indexes it pointed to"""
+        actions = [{"add": {"index": name, "alias": alias}}]
+        if client.indices.exists_alias(name=alias):
+            previous = list(client.indices.get_alias(name=alias))
+            actions += [{"remove": {"index": index, "alias": alias}} for index in previous]
+        elif client.indices.exists(index=alias):
+            # Index created before the alias, e.g. by search_index --rebuild
+            previous = []
+            actions.append({"remove_index": {"index": alias}})
+        else:
+            previous = []
+        client.indices.update_aliases(actions=actions)
+        return previous
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.tasks.outbox import relay_all, retry_failed
+
+
+class Command(BaseCommand):
+    help = "Relay the due events of the outbox, e.g. after the broker was down"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=settings.OUTBOX_RELAY_BATCH_SIZE, help="Events relayed per transaction"
+        )
+        parser.add_argument(
+            "--retry-failed",
+            action="store_true",
+            default=False,
+            help="First queue again the events that ran out of attempts",
+        )
+
+    def handle(self, *args, **options):
+        if options["retry_failed"]:
+            self.stdout.write(f"Queued {retry_failed()} failed outbox events again.")
+        relayed, failed = relay_all(options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Relayed {relayed} outbox events, {failed} failed."))
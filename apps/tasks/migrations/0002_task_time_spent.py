@@ -0,0 +1,37 @@
+# Generated by Django 5.1.15 on 2026-10-17 11:20
+
+import datetime
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Value
+from django.db.models.functions import NullIf
+
+
+def populate_time_spent(apps, schema_editor):
+    Task = apps.get_model("tasks", "Task")
+    TimeLog = apps.get_model("tasks", "TimeLog")
+
+    logged = (
+        TimeLog.objects.filter(task=OuterRef("pk"))
+        .exclude(duration=None)
+        .values("task")
+        .annotate(total=Sum("duration"))
+        .values("total")
+    )
+    zero = Value(datetime.timedelta(0), output_field=models.DurationField())
+    Task.objects.update(time_spent=NullIf(Subquery(logged), zero))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tasks", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="task",
+            name="time_spent",
+            field=models.DurationField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(populate_time_spent, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.1.15 on 2026-10-17 11:32
+
+from itertools import batched
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import TruncDate
+
+
+def populate_time_log_rollups(apps, schema_editor):
+    TimeLog = apps.get_model("tasks", "TimeLog")
+    TimeLogRollup = apps.get_model("tasks", "TimeLogRollup")
+
+    days = (
+        TimeLog.objects.exclude(duration=None)
+        .annotate(day=TruncDate("start_time"))
+        .order_by()
+        .values("task_id", "task__user_id", "day")
+        .annotate(total_duration=Sum("duration"), log_count=Count("id"), max_duration=Max("duration"))
+    )
+    rollups = (TimeLogRollup(user_id=row.pop("task__user_id"), **row) for row in days.iterator(chunk_size=1000))
+    for batch in batched(rollups, 1000):
+        TimeLogRollup.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tasks", "0002_task_time_spent"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TimeLogRollup",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("day", models.DateField()),
+                ("total_duration", models.DurationField()),
+                ("log_count", models.PositiveIntegerField()),
+                ("max_duration", models.DurationField()),
+                ("task", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="tasks.task")),
+                ("user", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                "indexes": [models.Index(fields=["user", "day"], name="time_log_rollup_user_day")],
+                "constraints": [
+                    models.UniqueConstraint(fields=("task", "day"), name="unique_time_log_rollup_task_day")
+                ],
+            },
+        ),
+        migrations.RunPython(populate_time_log_rollups, migrations.RunPython.noop),
+    ]
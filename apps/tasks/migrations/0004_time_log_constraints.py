@@ -0,0 +1,107 @@
+# Generated by Django 5.1.15 on 2026-10-17 11:34
+
+import datetime
+import math
+import sys
+from itertools import batched
+
+from django.db import IntegrityError, migrations, models, transaction
+from django.db.models import Count, Max, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import NullIf, TruncDate
+
+
+def close_conflicting_logs(apps, schema_editor):
+    """
+    Cut every log of a task at the start of the next one, closing the running logs followed by another log
+    and shortening overlapping ones, so the constraints below can be added to existing data. The time spent
+    and the rollups of the changed tasks are recomputed.
+    """
+    Task = apps.get_model("tasks", "Task")
+    TimeLog = apps.get_model("tasks", "TimeLog")
+    TimeLogRollup = apps.get_model("tasks", "TimeLogRollup")
+
+    logs = TimeLog.objects.order_by("task_id", "start_time", "id").values_list(
+        "id", "task_id", "start_time", "duration"
+    )
+    durations = {}
+    previous = None
+    for log in logs.iterator(chunk_size=1000):
+        if previous is not None and previous[1] == log[1]:
+            time_log_id, _, start_time, duration = previous
+            if duration is None or start_time + duration > log[2]:
+                # Whole seconds like TimeLog.save(), rounded down so the logs no longer overlap
+                durations[time_log_id] = datetime.timedelta(seconds=math.floor((log[2] - start_time).total_seconds()))
+        previous = log
+    if not durations:
+        return
+
+    for batch in batched(durations.items(), 1000):
+        changed = TimeLog.objects.in_bulk([time_log_id for time_log_id, _ in batch])
+        for time_log_id, duration in batch:
+            changed[time_log_id].duration = duration
+        TimeLog.objects.bulk_update(changed.values(), ["duration"])
+
+    task_ids = set(TimeLog.objects.filter(id__in=durations).values_list("task_id", flat=True))
+    logged = (
+        TimeLog.objects.filter(task=OuterRef("pk"))
+        .exclude(duration=None)
+        .values("task")
+        .annotate(total=Sum("duration"))
+        .values("total")
+    )
+    zero = Value(datetime.timedelta(0), output_field=models.DurationField())
+    Task.objects.filter(id__in=task_ids).update(time_spent=NullIf(Subquery(logged), zero))
+
+    TimeLogRollup.objects.filter(task_id__in=task_ids).delete()
+    days = (
+        TimeLog.objects.filter(task_id__in=task_ids)
+        .exclude(duration=None)
+        .annotate(day=TruncDate("start_time"))
+        .order_by()
+        .values("task_id", "task__user_id", "day")
+        .annotate(total_duration=Sum("duration"), log_count=Count("id"), max_duration=Max("duration"))
+    )
+    TimeLogRollup.objects.bulk_create(
+        [TimeLogRollup(user_id=row.pop("task__user_id"), **row) for row in days], batch_size=1000
+    )
+
+
+def add_overlap_constraint(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS btree_gist")
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            # A running log (NULL duration) is an open ended range
+            schema_editor.execute(
+                "ALTER TABLE tasks_timelog ADD CONSTRAINT time_log_no_overlap EXCLUDE USING gist "
+                "(task_id WITH =, tstzrange(start_time, start_time + duration, '[)') WITH &&)"
+            )
+    except IntegrityError as e:
+        sys.stderr.write(
+            f"\n  Skipped time_log_no_overlap, existing time logs overlap: {e}"
+            "  Fix the overlapping logs and re-run this migration to enforce it in the database.\n"
+        )
+
+
+def remove_overlap_constraint(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute("ALTER TABLE tasks_timelog DROP CONSTRAINT IF EXISTS time_log_no_overlap")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tasks", "0003_time_log_rollup"),
+    ]
+
+    operations = [
+        migrations.RunPython(close_conflicting_logs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="timelog",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("duration", None)), fields=("task",), name="unique_running_time_log"
+            ),
+        ),
+        migrations.RunPython(add_overlap_constraint, remove_overlap_constraint),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.15 on 2026-10-17 11:35
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tasks", "0004_time_log_constraints"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="task",
+            index=models.Index(fields=["user", "is_completed", "id"], name="task_user_completed_id"),
+        ),
+        migrations.AddIndex(
+            model_name="timelog",
+            index=models.Index(fields=["task", "start_time"], include=("duration",), name="time_log_task_start"),
+        ),
+        migrations.AddIndex(
+            model_name="timelog",
+            index=models.Index(fields=["start_time"], include=("task", "duration"), name="time_log_start"),
+        ),
+    ]
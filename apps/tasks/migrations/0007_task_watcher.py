@@ -0,0 +1,46 @@
+# Generated by Django 5.1.15 on 2026-10-17 11:53
+
+from itertools import batched
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_task_watchers(apps, schema_editor):
+    Task = apps.get_model("tasks", "Task")
+    Comment = apps.get_model("tasks", "Comment")
+    TaskWatcher = apps.get_model("tasks", "TaskWatcher")
+
+    owners = Task.objects.order_by().values_list("id", "user_id")
+    commenters = Comment.objects.order_by().values_list("task_id", "user_id")
+    watchers = (TaskWatcher(task_id=task_id, user_id=user_id) for task_id, user_id in owners.union(commenters))
+    for batch in batched(watchers, 1000):
+        TaskWatcher.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tasks", "0006_notification_event"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TaskWatcher",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "task",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, related_name="watchers", to="tasks.task"
+                    ),
+                ),
+                ("user", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                "constraints": [models.UniqueConstraint(fields=("task", "user"), name="unique_task_watcher")],
+            },
+        ),
+        migrations.RunPython(populate_task_watchers, migrations.RunPython.noop),
+    ]
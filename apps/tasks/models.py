@@ -1,40 +1,156 @@
 import logging
 import math
+from itertools import batched
 
-from django.db import models
-from django.db.models import Sum
+from django.db import IntegrityError, models, transaction
+from django.core.cache import cache
+from django.db.models import Count, Exists, F, Max, OuterRef, Q, Subquery, Sum, Value, Window
+from django.db.models.functions import Coalesce, NullIf, RowNumber, TruncDate
 from django.utils import timezone
 
 from django_minio_backend import iso_date_prefix
 
+from apps.tasks import timers
 from apps.tasks.exceptions import TimeLogError
+from apps.tasks.versions import (
+    VERSION_TIMEOUT,
+    bump_task_versions,
+    bump_user_versions,
+    bump_watchers_versions,
+    watchers_version,
+)
 from apps.users.models import User
 
 
 logger = logging.getLogger(__name__)
 
+ZERO_DURATION = Value(timezone.timedelta(0), output_field=models.DurationField())
+
+RUNNING_CONSTRAINT = "unique_running_time_log"
+# Only exists on PostgreSQL, see migration 0004
+OVERLAP_CONSTRAINT = "time_log_no_overlap"
+
+WATCHERS_KEY = "tasks:watchers:task:{}:{}"
+
+
+class TaskQuerySet(models.QuerySet):
+    """
+    Annotations are correlated subqueries rather than joins, so they can be combined
+    without multiplying rows and each one stays a single indexed lookup per task.
+    """
+
+    @staticmethod
+    def logged_time():
+        logged = (
+            TimeLog.objects.filter(task=OuterRef("pk"))
+            .exclude(duration=None)
+            .order_by()
+            .values("task")
+            .annotate(total=Sum("duration"))
+            .values("total")
+        )
+        return NullIf(Subquery(logged), ZERO_DURATION)
+
+    @staticmethod
+    def related_count(model):
+        counted = model.objects.filter(task=OuterRef("pk")).order_by().values("task").annotate(count=Count("pk"))
+        return Coalesce(Subquery(counted.values("count")), 0)
+
+    def with_time_spent(self):
+        return self.annotate(time_all=self.logged_time())
+
+    def with_comment_count(self):
+        return self.annotate(comment_count=self.related_count(Comment))
+
+    def with_attachment_count(self):
+        return self.annotate(attachment_count=self.related_count(TaskAttachment))
+
+    def top_time_spent(self, limit):
+        """
+        The `limit` tasks of every user with the most stored time spent, ranked by
+        ROW_NUMBER() OVER (PARTITION BY user) in a single query.
+        """
+        rank = Window(
+            RowNumber(), partition_by=F("user_id"), order_by=[F("time_spent").desc(nulls_last=True), F("id").asc()]
+        )
+        return self.annotate(rank=rank).filter(rank__lte=limit).order_by("user_id", "rank")
+
+    def set_completed(self, is_completed):
+        """Complete or undo the tasks in a single UPDATE, returns the ids of the tasks that changed"""
+        with transaction.atomic():
+            # Locked, a concurrent request waits and then no longer counts these tasks as changed
+            tasks = list(self.select_for_update().exclude(is_completed=is_completed).values_list("id", "user_id"))
+            task_ids = [task_id for task_id, _ in tasks]
+            Task.objects.filter(id__in=task_ids).update(is_completed=is_completed)
+        bump_task_versions(*task_ids)
+        bump_user_versions(*(user_id for _, user_id in tasks))
+        return task_ids
+
+    def assign(self, user):
+        """Assign the tasks to `user` in a single UPDATE, returns the ids of the tasks that changed owner"""
+        with transaction.atomic():
+            # Locked, a concurrent request waits and then no longer counts these tasks as changed
+            tasks = list(self.select_for_update().exclude(user=user).values_list("id", "user_id"))
+            task_ids = [task_id for task_id, _ in tasks]
+            Task.objects.filter(id__in=task_ids).update(user=user)
+            TimeLogRollup.objects.filter(task__in=task_ids).update(user=user)
+            TaskWatcher.add((task_id, user.id) for task_id in task_ids)
+            TaskWatcher.prune(task_id__in=task_ids)
+        for task_id in task_ids:
+            timers.move(task_id, user.id)
+        bump_task_versions(*task_ids)
+        bump_user_versions(user.id, *(user_id for _, user_id in tasks))
+        return task_ids
+
+    def update_time_spent(self):
+        """Recompute the stored time spent of the tasks from their time logs in a single UPDATE"""
+        tasks = list(self.values_list("id", "user_id"))
+        updated = self.update(time_spent=self.logged_time())
+        bump_task_versions(*(task_id for task_id, _ in tasks))
+        bump_user_versions(*(user_id for _, user_id in tasks))
+        return updated
+
 
 class Task(models.Model):
     title = models.CharField(max_length=255)
     description = models.TextField()
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     is_completed = models.BooleanField()
+    time_spent = models.DurationField(blank=True, null=True, editable=False)
+
+    objects = TaskQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Own (completed / incomplete) task listings, paginated by id
+            models.Index(fields=["user", "is_completed", "id"], name="task_user_completed_id"),
+        ]
 
     def __str__(self) -> str:
         return self.title
 
-    @property
-    def time_spent(self):
-        time_logs = self.get_time_logs().exclude(duration=None)
-        time_spent = time_logs.aggregate(Sum("duration"))["duration__sum"]
-        return time_spent
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if not adding:
+            TimeLogRollup.objects.filter(task=self).exclude(user=self.user_id).update(user=self.user_id)
+
+    @staticmethod
+    def add_time_spent(task_id, duration):
+        """Atomically shift the stored time spent of a task, an empty total is kept as NULL"""
+        if not duration:
+            return
+        time_spent = Coalesce(F("time_spent"), ZERO_DURATION) + Value(duration, output_field=models.DurationField())
+        Task.objects.filter(id=task_id).update(time_spent=NullIf(time_spent, ZERO_DURATION))
 
     def get_time_logs(self):
         return self.timelog_set.all()
 
     def assign_user(self, new_user):
+        previous_user_id = self.user_id
         self.user = new_user
         self.save()
+        bump_user_versions(previous_user_id)
         return
 
     def complete_task(self):
@@ -46,6 +162,7 @@ class Task(models.Model):
         self.save()
 
     def start_timer(self):
+        # The running log is checked by check_overlap() and the constraints, a registry entry may be stale
         try:
             TimeLog.objects.create(task=self, start_time=timezone.now())
         except TimeLogError as e:
@@ -54,7 +171,15 @@ class Task(models.Model):
         return None
 
     def stop_timer(self):
-        time_log = TimeLog.objects.filter(task=self).latest("start_time")
+        time_log_id = timers.running_time_log_id(self.id)
+        time_log = TimeLog.objects.filter(id=time_log_id, duration=None).first() if time_log_id else None
+        if time_log is None and time_log_id is not None:
+            # Registry entry of a log stopped since, e.g. after a lost write
+            time_log = TimeLog.objects.filter(task=self, duration=None).first()
+            if time_log is None:
+                timers.unregister(self.id, self.user_id)
+        if time_log is None:
+            return "TimeLog is already stopped"
         try:
             time_log.stop()
         except TimeLogError as e:
@@ -72,6 +197,82 @@ class Comment(models.Model):
         return self.task.title + ": " + self.user.username + ": " + self.body
 
 
+class TaskWatcher(models.Model):
+    """
+    Users notified of the changes of a task: its owner and everyone who commented on it.
+
+    Maintained by the task and comment signal handlers, so the recipients of a task are read with one
+    (task, user) index lookup instead of joining the users to the task and all of its comments.
+    """
+
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name="watchers")
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["task", "user"], name="unique_task_watcher")]
+
+    def __str__(self) -> str:
+        return f"TaskWatcher task={self.task_id} user={self.user_id}"
+
+    @classmethod
+    def add(cls, pairs):
+        """Watch the tasks of the (task id, user id) pairs, only the tasks gaining a watcher are bumped"""
+        pairs = set(pairs)
+        if not pairs:
+            return
+        existing = cls.objects.filter(
+            task_id__in={task_id for task_id, _ in pairs}, user_id__in={user_id for _, user_id in pairs}
+        )
+        pairs -= set(existing.values_list("task_id", "user_id"))
+        if pairs:
+            cls.objects.bulk_create(
+                [cls(task_id=task_id, user_id=user_id) for task_id, user_id in pairs], ignore_conflicts=True
+            )
+            bump_watchers_versions(*(task_id for task_id, _ in pairs))
+
+    @classmethod
+    def prune(cls, **filters):
+        """Remove the watchers matching `filters` that neither own nor commented on their task"""
+        owner = Task.objects.filter(id=OuterRef("task_id"), user_id=OuterRef("user_id"))
+        commenter = Comment.objects.filter(task_id=OuterRef("task_id"), user_id=OuterRef("user_id"))
+        stale = cls.objects.filter(**filters).exclude(Exists(owner)).exclude(Exists(commenter))
+        task_ids = set(stale.values_list("task_id", flat=True))
+        if task_ids:
+            stale.delete()
+            bump_watchers_versions(*task_ids)
+
+    @classmethod
+    def user_ids(cls, task_id) -> list[int]:
+        """Ids of the watchers of a task, cached under the version of its watchers"""
+        key = WATCHERS_KEY.format(task_id, watchers_version(task_id))
+        user_ids = cache.get(key)
+        if user_ids is None:
+            user_ids = list(cls.objects.filter(task_id=task_id).values_list("user_id", flat=True))
+            cache.set(key, user_ids, timeout=VERSION_TIMEOUT)
+        return user_ids
+
+    @classmethod
+    def rebuild(cls, task_ids=None, batch_size=1000):
+        """Replace the watchers of the given tasks, or of all tasks, by their owners and commenters"""
+        owners = Task.objects.order_by().values_list("id", "user_id")
+        commenters = Comment.objects.order_by().values_list("task_id", "user_id")
+        watchers = cls.objects.all()
+        if task_ids is not None:
+            owners = owners.filter(id__in=task_ids)
+            commenters = commenters.filter(task_id__in=task_ids)
+            watchers = watchers.filter(task_id__in=task_ids)
+
+        created = 0
+        with transaction.atomic():
+            watchers.delete()
+            pairs = owners.union(commenters)
+            for batch in batched((cls(task_id=task_id, user_id=user_id) for task_id, user_id in pairs), batch_size):
+                created += len(cls.objects.bulk_create(batch))
+                # Every task has its owner as a watcher, so the batches cover all rebuilt tasks
+                bump_watchers_versions(*(watcher.task_id for watcher in batch))
+        return created
+
+
 class TaskAttachment(models.Model):
     file = models.FileField(
         verbose_name="Task Photo",
@@ -83,11 +284,35 @@ class TaskAttachment(models.Model):
         return self.task.title + ": Attachment"
 
 
+class TimeLogQuerySet(models.QuerySet):
+    def delete(self):
+        task_ids = set(self.values_list("task_id", flat=True))
+        with transaction.atomic():
+            deleted = super().delete()
+            Task.objects.filter(id__in=task_ids).update_time_spent()
+            TimeLogRollup.rebuild(task_ids)
+        return deleted
+
+
 class TimeLog(models.Model):
     task = models.ForeignKey(Task, on_delete=models.CASCADE)
     start_time = models.DateTimeField()
     duration = models.DurationField(blank=True, null=True)
 
+    objects = TimeLogQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # Also the partial index that finds the running log of a task
+            models.UniqueConstraint(fields=["task"], condition=Q(duration=None), name=RUNNING_CONSTRAINT),
+        ]
+        indexes = [
+            # Timer logs of a task, overlap checks and rollup refreshes, covering the duration sums
+            models.Index(fields=["task", "start_time"], include=["duration"], name="time_log_task_start"),
+            # Time windows (last month, top logs) joined to the task owner
+            models.Index(fields=["start_time"], include=["task", "duration"], name="time_log_start"),
+        ]
+
     def __str__(self) -> str:
         return (
             "id="
@@ -101,25 +326,94 @@ class TimeLog(models.Model):
         )
 
     def save(self, *args, **kwargs):
-        for time_log in TimeLog.objects.filter(task=self.task).exclude(id=self.id):
-            if time_log.duration is None:
-                raise TimeLogError(
-                    f"Task timer is already running. Task_id={self.task.id}:{time_log.task.id}, Target_duration={time_log.duration}"
-                )
+        if self.duration:
+            duration_rounded = math.floor(self.duration.total_seconds())
+            self.duration = timezone.timedelta(seconds=duration_rounded)
+        self.check_overlap()
+
+        previous = None
+        try:
+            with transaction.atomic():
+                if self.id:
+                    # Locked, so concurrent edits of the log shift the time spent by what the other one stored
+                    previous = (
+                        TimeLog.objects.select_for_update()
+                        .filter(id=self.id)
+                        .values("task_id", "start_time", "duration")
+                        .first()
+                    )
+                super().save(*args, **kwargs)
+                if previous:
+                    Task.add_time_spent(previous["task_id"], -previous["duration"] if previous["duration"] else None)
+                Task.add_time_spent(self.task_id, self.duration)
+                if previous and previous["duration"]:
+                    TimeLogRollup.refresh(previous["task_id"], timezone.localdate(previous["start_time"]))
+                if self.duration:
+                    TimeLogRollup.refresh(self.task_id, timezone.localdate(self.start_time))
+        except IntegrityError as e:
+            # A concurrent write got past check_overlap() first, the constraints have the final say
+            message = str(e)
+            if OVERLAP_CONSTRAINT in message:
+                raise TimeLogError(f"TimeLog overlaps with another timeLog.Task_id={self.task_id}") from e
+            if RUNNING_CONSTRAINT in message or "tasks_timelog.task_id" in message:
+                raise TimeLogError(f"Task timer is already running. Task_id={self.task_id}") from e
+            raise
+        self.time_spent_changed(previous)
+
+    def check_overlap(self):
+        """
+        Reject a second running timer and overlapping logs of the same task.
+
+        Logs of a task never overlap, so besides the running one only the last log starting before this
+        one and the first log starting inside it can conflict, each found by a (task, start_time) index scan.
+        A running log is open ended.
+        """
+        others = TimeLog.objects.filter(task_id=self.task_id)
+        if self.id:
+            others = others.exclude(id=self.id)
+
+        running = others.filter(duration=None).first()
+        if running is not None:
+            raise TimeLogError(
+                f"Task timer is already running. Task_id={self.task_id}:{running.task_id}, "
+                + f"Target_duration={running.duration}"
+            )
+
+        conflict = others.filter(start_time__lt=self.start_time).order_by("-start_time").first()
+        if conflict is not None and conflict.start_time + conflict.duration <= self.start_time:
+            conflict = None
+        if conflict is None:
+            following = others.filter(start_time__gte=self.start_time)
+            if self.duration is not None:
+                following = following.filter(start_time__lt=self.start_time + self.duration)
+            conflict = following.order_by("start_time").first()
+
+        if conflict is not None:
+            raise TimeLogError(
+                "TimeLog overlaps with another timeLog."
+                + f"Conflict_id={conflict.id}."
+                + f"Task_id={conflict.task_id}:{self.task_id},"
+                + f"Date={conflict.start_time.date()}/{self.start_time.date()},"
+                + f"Start={conflict.start_time.time()}/{self.start_time.time()},"
+                + f"Duration={conflict.duration}/{self.duration}"
+            )
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            deleted = super().delete(*args, **kwargs)
+            Task.add_time_spent(self.task_id, -self.duration if self.duration else None)
             if self.duration:
-                duration_rounded = math.floor(self.duration.total_seconds())
-                self.duration = timezone.timedelta(seconds=duration_rounded)
-            if time_log.start_time < self.start_time < time_log.start_time + time_log.duration:
-                raise TimeLogError(
-                    "TimeLog overlaps with another timeLog."
-                    + f"Conflict_id={time_log.id}."
-                    + f"Task_id={time_log.task.id}:{self.task.id},"
-                    + f"Date={time_log.start_time.date()}/{self.start_time.date()},"
-                    + f"Start={time_log.start_time.time()}/{self.start_time.time()},"
-                    + f"Duration={time_log.duration}/{self.duration}"
-                )
+                TimeLogRollup.refresh(self.task_id, timezone.localdate(self.start_time))
+        self.time_spent_changed()
+        return deleted
 
-        super().save(*args, **kwargs)
+    def time_spent_changed(self, previous=None):
+        """The stored time spent is updated without Task.save(), so its owner's listings are bumped here"""
+        if previous and previous["task_id"] != self.task_id:
+            bump_task_versions(previous["task_id"])
+            bump_user_versions(*Task.objects.filter(id=previous["task_id"]).values_list("user_id", flat=True))
+        if self.duration or (previous and previous["duration"]):
+            bump_user_versions(self.task.user_id)
 
     def stop(self):
         if self.duration is not None:
@@ -130,11 +424,25 @@ class TimeLog(models.Model):
 
     @staticmethod
     def user_time_last_month(user):
-        last_month = timezone.now() - timezone.timedelta(days=30)
+        """Whole days of the last 30 are summed from the rollups, only the two partial days from the logs"""
+        now = timezone.now()
+        last_month = now - timezone.timedelta(days=30)
+        first_day = timezone.localdate(last_month) + timezone.timedelta(days=1)
+        today = timezone.localdate(now)
+
+        days = TimeLogRollup.objects.filter(user=user, day__gte=first_day, day__lt=today)
+        days_total = days.aggregate(Sum("total_duration"))["total_duration__sum"]
+
         logs = TimeLog.objects.filter(
-            task__user=user, start_time__gte=last_month, start_time__lte=timezone.now()
+            Q(start_time__gte=last_month, start_time__lt=TimeLogRollup.day_start(first_day))
+            | Q(start_time__gte=TimeLogRollup.day_start(today), start_time__lte=now),
+            task__user=user,
         ).exclude(duration=None)
-        return logs.aggregate(Sum("duration"))["duration__sum"]
+        logs_total = logs.aggregate(Sum("duration"))["duration__sum"]
+
+        if days_total is None or logs_total is None:
+            return days_total if logs_total is None else logs_total
+        return days_total + logs_total
 
     @staticmethod
     def user_top_logs(user: User, limit=20):
@@ -142,6 +450,136 @@ class TimeLog(models.Model):
         logs = (
             TimeLog.objects.filter(task__user=user, start_time__gte=last_month)
             .exclude(duration=None)
-            .order_by("-duration")[:limit]
+            .order_by("-duration", "id")[:limit]
         )
         return logs
+
+
+class TimeLogRollup(models.Model):
+    """
+    Totals of the stopped time logs of a task per day.
+
+    Maintained by TimeLog writes, so the time logged over a period is read from one row per task and day
+    instead of from every log. The user is the owner of the task and follows it when it is reassigned.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    task = models.ForeignKey(Task, on_delete=models.CASCADE)
+    day = models.DateField()
+    total_duration = models.DurationField()
+    log_count = models.PositiveIntegerField()
+    max_duration = models.DurationField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=["task", "day"], name="unique_time_log_rollup_task_day")]
+        indexes = [models.Index(fields=["user", "day"], name="time_log_rollup_user_day")]
+
+    def __str__(self) -> str:
+        return f"TimeLogRollup task={self.task_id} day={self.day} total_duration={self.total_duration}"
+
+    @staticmethod
+    def day_start(day):
+        return timezone.make_aware(timezone.datetime.combine(day, timezone.datetime.min.time()))
+
+    @classmethod
+    def refresh(cls, task_id, day):
+        """Recompute the rollup of one task and day from its time logs"""
+        start = cls.day_start(day)
+        with transaction.atomic():
+            # Lock the row before reading the logs, so a concurrent refresh of the same day sees our log
+            rollup = cls.objects.select_for_update().filter(task_id=task_id, day=day).first()
+            if rollup is None:
+                # Nothing to lock yet: insert an empty row, a concurrent first refresh waits for it on the unique
+                # constraint instead of inserting a second one
+                user_id = Task.objects.filter(id=task_id).values_list("user_id", flat=True).first()
+                empty = cls(
+                    task_id=task_id,
+                    day=day,
+                    user_id=user_id,
+                    total_duration=timezone.timedelta(0),
+                    log_count=0,
+                    max_duration=timezone.timedelta(0),
+                )
+                cls.objects.bulk_create([empty], ignore_conflicts=True)
+                rollup = cls.objects.select_for_update().get(task_id=task_id, day=day)
+            logs = TimeLog.objects.filter(
+                task_id=task_id, start_time__gte=start, start_time__lt=start + timezone.timedelta(days=1)
+            ).exclude(duration=None)
+            totals = logs.aggregate(total_duration=Sum("duration"), log_count=Count("id"), max_duration=Max("duration"))
+            if not totals["log_count"]:
+                rollup.delete()
+                return
+            for name, value in totals.items():
+                setattr(rollup, name, value)
+            rollup.save(update_fields=list(totals))
+
+    @classmethod
+    def rebuild(cls, task_ids=None, batch_size=1000):
+        """Replace the rollups of the given tasks, or of all tasks, by totals recomputed from the time logs"""
+        logs = TimeLog.objects.exclude(duration=None)
+        rollups = cls.objects.all()
+        if task_ids is not None:
+            logs = logs.filter(task_id__in=task_ids)
+            rollups = rollups.filter(task_id__in=task_ids)
+
+        days = (
+            logs.annotate(day=TruncDate("start_time"))
+            .order_by()
+            .values("task_id", "task__user_id", "day")
+            .annotate(total_duration=Sum("duration"), log_count=Count("id"), max_duration=Max("duration"))
+        )
+        created = 0
+        with transaction.atomic():
+            rollups.delete()
+            days = (cls(user_id=row.pop("task__user_id"), **row) for row in days.iterator(chunk_size=batch_size))
+            for batch in batched(days, batch_size):
+                created += len(cls.objects.bulk_create(batch))
+        return created
+
+
+class NotificationEvent(models.Model):
+    """
+    Email notification waiting for the next digest of its recipient.
+
+    Buffered by apps.tasks.tasks.notify() and sent by send_notification_digests, which mails all the pending
+    events of a user at once.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    task = models.ForeignKey(Task, on_delete=models.CASCADE)
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Pending events of a user, in order
+            models.Index(fields=["user", "id"], name="notification_event_user_id"),
+            # Events pending for longer than the digest window
+            models.Index(fields=["created_at"], name="notification_event_created"),
+        ]
+
+    def __str__(self) -> str:
+        return f"NotificationEvent user={self.user_id} subject={self.subject}"
+
+
+class OutboxEvent(models.Model):
+    """
+    Domain event written in the transaction of the change it describes, see apps.tasks.outbox.
+
+    The payload holds ids rather than instances, `<model>_id` keys are loaded back into instances by the relay.
+    An event whose relay fails is retried after a backoff and set aside as failed after OUTBOX_MAX_ATTEMPTS.
+    """
+
+    name = models.CharField(max_length=64)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # Not relayed before, set after a failed attempt
+    retry_at = models.DateTimeField(blank=True, null=True)
+    # Set once the event ran out of attempts, it is no longer relayed
+    failed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self) -> str:
+        return f"OutboxEvent id={self.id} name={self.name}"
@@ -0,0 +1,143 @@
+"""
+Transactional outbox of the task events.
+
+The views publish an event in the transaction of the change it describes, so an event is stored if and only
+if the change is committed, and the request never waits for the notification handlers or the broker. The
+relay sends the signals of the stored events in batches from a Celery task, which is triggered once the
+transaction commits and runs periodically for the events whose trigger was lost, e.g. while the broker was down.
+
+Events are relayed at least once. A failed event is retried after a growing delay without holding up the
+events after it, and is set aside as failed after OUTBOX_MAX_ATTEMPTS, see the relay-outbox command.
+"""
+
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.tasks.models import Comment, OutboxEvent, Task
+from apps.tasks.signals import (
+    task_assigned,
+    task_comment,
+    task_complete,
+    task_undo,
+    tasks_assigned,
+    tasks_complete,
+    tasks_undo,
+)
+from apps.users.models import User
+
+logger = logging.getLogger(__name__)
+
+EVENTS = {
+    "task_assigned": task_assigned,
+    "task_complete": task_complete,
+    "task_undo": task_undo,
+    "task_comment": task_comment,
+    "tasks_assigned": tasks_assigned,
+    "tasks_complete": tasks_complete,
+    "tasks_undo": tasks_undo,
+}
+
+# Payload keys loaded back into instances, e.g. task_id is sent as task
+MODELS = {"task_id": Task, "user_id": User, "comment_id": Comment}
+
+# Longest delay between two attempts of a failed event, in seconds
+MAX_RETRY_DELAY = 60 * 60
+
+
+def publish(name, **payload):
+    """Store an event in the current transaction, relayed once it is committed"""
+    if name not in EVENTS:
+        raise ValueError(f"Unknown event {name}")
+    OutboxEvent.objects.create(name=name, payload=payload)
+    transaction.on_commit(trigger_relay)
+
+
+def trigger_relay():
+    from apps.tasks.tasks import relay_outbox_events
+
+    try:
+        relay_outbox_events.delay()
+    except Exception:
+        # The event stays in the outbox until the periodic relay
+        logger.warning("Could not trigger the outbox relay", exc_info=True)
+
+
+def load(payload) -> dict | None:
+    """Signal arguments of a payload, or None if one of its instances no longer exists"""
+    kwargs = {}
+    for key, value in payload.items():
+        if key in MODELS:
+            instance = MODELS[key].objects.filter(id=value).first()
+            if instance is None:
+                return None
+            kwargs[key.removesuffix("_id")] = instance
+        else:
+            kwargs[key] = value
+    return kwargs
+
+
+def relay(batch_size) -> tuple[int, int]:
+    """
+    Send the signals of up to `batch_size` due events, oldest first, and remove them from the outbox.
+
+    Returns the numbers of relayed and failed events. Events locked by a concurrent relay are skipped, so
+    concurrent relays and retries do not keep the order of the events. An event whose handlers fail is
+    rolled back to its savepoint and rescheduled, the other events of the batch are still relayed.
+    """
+    relayed = failed = 0
+    now = timezone.now()
+    with transaction.atomic():
+        events = (
+            OutboxEvent.objects.select_for_update(skip_locked=True)
+            .filter(Q(retry_at=None) | Q(retry_at__lte=now), failed_at=None)
+            .order_by("id")[:batch_size]
+        )
+        for event in events:
+            try:
+                with transaction.atomic():
+                    kwargs = load(event.payload)
+                    if kwargs is None:
+                        logger.info(f"Skipped {event}, its instances were deleted")
+                    else:
+                        EVENTS[event.name].send(sender=OutboxEvent, **kwargs)
+                    event.delete()
+            except Exception as e:
+                logger.exception(f"Could not relay {event}")
+                reschedule(event, e, now)
+                failed += 1
+            else:
+                relayed += 1
+    return relayed, failed
+
+
+def reschedule(event, error, now):
+    """Retry a failed event after a delay doubling with every attempt, or set it aside after the last one"""
+    event.attempts += 1
+    event.last_error = f"{type(error).__name__}: {error}"
+    if event.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        event.failed_at = now
+        logger.error(f"Gave up on {event} after {event.attempts} attempts")
+    else:
+        delay = min(settings.OUTBOX_RELAY_INTERVAL * 2 ** (event.attempts - 1), MAX_RETRY_DELAY)
+        event.retry_at = now + timezone.timedelta(seconds=delay)
+    event.save(update_fields=["attempts", "last_error", "retry_at", "failed_at"])
+
+
+def relay_all(batch_size) -> tuple[int, int]:
+    """Relay batches until no event is due, returns the numbers of relayed and failed events"""
+    relayed = failed = 0
+    while True:
+        batch_relayed, batch_failed = relay(batch_size)
+        if not batch_relayed and not batch_failed:
+            return relayed, failed
+        relayed += batch_relayed
+        failed += batch_failed
+
+
+def retry_failed() -> int:
+    """Queue the events set aside as failed again, with new attempts"""
+    return OutboxEvent.objects.exclude(failed_at=None).update(failed_at=None, retry_at=None, attempts=0)
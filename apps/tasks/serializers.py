@@ -1,11 +1,30 @@
+import base64
+import binascii
+import json
+
+from django.conf import settings
 from rest_framework import serializers
 
 from apps.tasks.models import Task, Comment, TimeLog, TaskAttachment
+from apps.users.models import User
+
+
+class AnnotatedDurationField(serializers.DurationField):
+    """Duration read from a queryset annotation when the instance carries it, otherwise from the source"""
+
+    def __init__(self, annotation, **kwargs):
+        self.annotation = annotation
+        super().__init__(**kwargs)
+
+    def get_attribute(self, instance):
+        if hasattr(instance, self.annotation):
+            return getattr(instance, self.annotation)
+        return super().get_attribute(instance)
 
 
 class TaskSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(source="pk", read_only=True)
-    time_spent = serializers.DurationField(read_only=True)
+    time_spent = AnnotatedDurationField(annotation="time_all", read_only=True)
 
     class Meta:
         model = Task
@@ -15,17 +34,120 @@ class TaskSerializer(serializers.ModelSerializer):
 
 class TaskPreviewSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(source="pk", read_only=True)
-    time_spent = serializers.DurationField(read_only=True)
+    time_spent = AnnotatedDurationField(annotation="time_all", read_only=True)
 
     class Meta:
         model = Task
         fields = ["id", "title", "time_spent"]
 
 
+class TaskBulkSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False, max_length=settings.BULK_MAX_ITEMS)
+
+
+class TaskBulkAssignSerializer(TaskBulkSerializer):
+    user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+
+
+class TaskBulkResultSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    message = serializers.CharField(required=False)
+    error = serializers.CharField(required=False)
+
+
+class TaskBulkCreateResultSerializer(serializers.Serializer):
+    index = serializers.IntegerField()
+    id = serializers.IntegerField(required=False)
+    errors = serializers.DictField(required=False)
+
+
+class TaskExportSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source="pk", read_only=True)
+
+    class Meta:
+        model = Task
+        fields = ["id", "title", "description", "is_completed", "user", "time_spent"]
+
+
+class TaskExportFilterSerializer(serializers.Serializer):
+    user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), required=False)
+
+
 class TaskSearchSerializer(serializers.Serializer):
     search = serializers.CharField(max_length=255)
 
 
+class TaskDocumentSearchSerializer(serializers.Serializer):
+    SOURCE_FIELDS = ("id", "title", "description", "is_completed", "user", "user.email", "comments", "comments.body")
+
+    title = serializers.CharField(required=False, help_text="Title of the task (optional)")
+    description = serializers.CharField(required=False, help_text="Description of the task (optional)")
+    comment_body = serializers.CharField(
+        required=False, help_text="Body of comment associated with the task (optional)"
+    )
+    limit = serializers.IntegerField(
+        default=20,
+        min_value=1,
+        max_value=settings.PAGINATION_MAX_PAGE_SIZE,
+        help_text="Length of the response (optional, defaults to 20)",
+    )
+    cursor = serializers.CharField(required=False, help_text="Cursor of the next page, from the Link header (optional)")
+    fields = serializers.CharField(
+        required=False, help_text=f"Comma separated fields of the hits, of {", ".join(SOURCE_FIELDS)} (optional)"
+    )
+    exclude = serializers.CharField(required=False, help_text="Comma separated fields left out of the hits (optional)")
+    total = serializers.ChoiceField(
+        choices=["exact", "capped", "none"],
+        default="exact",
+        help_text="Count every hit, count up to ELASTICSEARCH_TOTAL_HITS_CAP hits or do not count them",
+    )
+    comments = serializers.ChoiceField(
+        choices=["all", "matching", "none"],
+        default="all",
+        help_text="Comments of the hits: all of them, only the ones matching comment-body or none",
+    )
+
+    def get_fields(self):
+        return {name.replace("_", "-"): field for name, field in super().get_fields().items()}
+
+    def to_internal_value(self, data):
+        # Blank parameters are ignored like missing ones, some clients always send every key
+        return super().to_internal_value({key: value for key, value in data.items() if value != ""})
+
+    def validate_fields(self, value):
+        return self.source_fields(value)
+
+    def validate_exclude(self, value):
+        return self.source_fields(value)
+
+    def source_fields(self, value):
+        names = [name.strip() for name in value.split(",") if name.strip()]
+        unknown = [name for name in names if name not in self.SOURCE_FIELDS]
+        if unknown:
+            raise serializers.ValidationError(f"Unknown fields: {", ".join(unknown)}")
+        return names
+
+    def validate_cursor(self, value):
+        try:
+            sort = json.loads(base64.urlsafe_b64decode(value))
+        except (binascii.Error, ValueError):
+            sort = None
+        # The sort values of the last hit, its score and id
+        if not (
+            isinstance(sort, list)
+            and len(sort) == 2
+            and isinstance(sort[0], (int, float))
+            and isinstance(sort[1], int)
+            and not any(isinstance(value, bool) for value in sort)
+        ):
+            raise serializers.ValidationError("Invalid cursor")
+        return sort
+
+    @staticmethod
+    def encode_cursor(sort) -> str:
+        return base64.urlsafe_b64encode(json.dumps(list(sort)).encode()).decode()
+
+
 class TaskUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Task
@@ -57,8 +179,53 @@ class TimeLogSerializer(serializers.ModelSerializer):
         fields = ("id", "task", "start_time", "duration")
 
 
+class TimeLogImportErrorSerializer(serializers.Serializer):
+    line = serializers.IntegerField()
+    errors = serializers.DictField(child=serializers.ListField(child=serializers.CharField()))
+
+
+class TimeLogImportResultSerializer(serializers.Serializer):
+    created = serializers.IntegerField()
+    errors = TimeLogImportErrorSerializer(many=True)
+
+
+class TimeLogExportSerializer(serializers.ModelSerializer):
+    id = serializers.IntegerField(source="pk", read_only=True)
+    task_title = serializers.CharField(source="task.title", read_only=True)
+    user = serializers.IntegerField(source="task.user_id", read_only=True)
+
+    class Meta:
+        model = TimeLog
+        fields = ("id", "task", "task_title", "user", "start_time", "duration")
+
+
+class TimeLogExportFilterSerializer(serializers.Serializer):
+    from_ = serializers.DateTimeField(required=False, help_text="Time logs starting at or after (optional)")
+    to = serializers.DateTimeField(required=False, help_text="Time logs starting before (optional)")
+    user = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), required=False)
+    task = serializers.PrimaryKeyRelatedField(queryset=Task.objects.all(), required=False)
+
+    def get_fields(self):
+        # "from" is a keyword and cannot be declared as an attribute
+        return {"from" if name == "from_" else name: field for name, field in super().get_fields().items()}
+
+    def validate(self, attrs):
+        if "from" in attrs and "to" in attrs and attrs["from"] >= attrs["to"]:
+            raise serializers.ValidationError({"to": "Must be after from"})
+        return attrs
+
+
 class TimeLogTopSerializer(serializers.Serializer):
-    limit = serializers.IntegerField(default=20, min_value=1, required=False)
+    # Size of the cached top logs, every limit is answered from them
+    MAX_LIMIT = 100
+
+    limit = serializers.IntegerField(
+        default=20,
+        min_value=1,
+        max_value=MAX_LIMIT,
+        required=False,
+        help_text=f"Number of logs, up to {MAX_LIMIT} (optional, defaults to 20)",
+    )
 
 
 class EmptySerializer(serializers.Serializer):
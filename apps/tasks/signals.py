@@ -1,7 +1,12 @@
+from django.conf import settings
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import Signal, receiver
 
-from apps.tasks.tasks import c_send_mail
-from apps.users.models import User
+from apps.tasks import timers
+from apps.tasks.models import Comment, Task, TaskAttachment, TaskWatcher, TimeLog
+from apps.tasks.tasks import c_send_mail, mail_message, notify, send_mail_batches
+from apps.tasks.versions import bump_task_versions, bump_user_versions, set_tasks_exist
 
 
 # Email signal
@@ -9,6 +14,9 @@ task_assigned = Signal()
 task_complete = Signal()
 task_undo = Signal()
 task_comment = Signal()
+tasks_assigned = Signal()
+tasks_complete = Signal()
+tasks_undo = Signal()
 
 
 @receiver(task_assigned)
@@ -24,25 +32,21 @@ def task_assigned_handler(sender, **kwargs):
 @receiver(task_complete)
 def task_complete_handler(sender, **kwargs):
     task = kwargs["task"]
-    users = User.objects.filter(comment__task=task).distinct()
-    users |= User.objects.filter(task=task).distinct()
+    users = TaskWatcher.user_ids(task.id)
 
-    recipient = [user.email for user in users]
     subject = "Task completed"
     message = f"Task [{task.title}] has been completed"
-    c_send_mail.delay(recipient, subject, message)
+    notify(users, task, subject, message)
 
 
 @receiver(task_undo)
 def task_undo_handler(sender, **kwargs):
     task = kwargs["task"]
-    users = User.objects.filter(comment__task=task).distinct()
-    users |= User.objects.filter(task=task).distinct()
+    users = TaskWatcher.user_ids(task.id)
 
-    recipient = [user.email for user in users]
     subject = "Task marked incomplete"
     message = f"Task [{task.title}] has been marked incomplete"
-    c_send_mail.delay(recipient, subject, message)
+    notify(users, task, subject, message)
 
 
 @receiver(task_comment)
@@ -50,7 +54,135 @@ def task_comment_handler(sender, **kwargs):
     user = kwargs["user"]
     task = kwargs["task"]
     comment = kwargs["comment"]
-    recipient = [user.email]
     subject = "Task comment"
     message = f"Task [{task.title}] has received a comment:\n\t{comment.body}"
-    c_send_mail.delay(recipient, subject, message)
+    notify([user.id], task, subject, message)
+
+
+def send_batched_mail(recipients, subject, message):
+    """One email per recipient listing every task of `recipients` ({email: [title, ...]}), sent in batches"""
+    messages = []
+    for email, titles in recipients.items():
+        task_list = "\n".join(f"\t[{title}]" for title in titles)
+        messages.append(mail_message([email], subject, f"{message}:\n{task_list}"))
+    send_mail_batches(messages)
+
+
+@receiver(tasks_assigned)
+def tasks_assigned_handler(sender, **kwargs):
+    user = kwargs["user"]
+    titles = Task.objects.filter(id__in=kwargs["task_ids"]).order_by("id").values_list("title", flat=True)
+    send_batched_mail({user.email: list(titles)}, "Tasks assigned", "These tasks have been assigned to you")
+
+
+def task_watchers(task_ids):
+    """Titles of the tasks by the email of their owners and commenters"""
+    tasks = dict(Task.objects.filter(id__in=task_ids).values_list("id", "title"))
+    watchers = TaskWatcher.objects.filter(task__in=task_ids).values_list("user__email", "task_id")
+
+    recipients = {}
+    for email, task_id in sorted(watchers):
+        recipients.setdefault(email, []).append(tasks[task_id])
+    return recipients
+
+
+@receiver(tasks_complete)
+def tasks_complete_handler(sender, **kwargs):
+    send_batched_mail(task_watchers(kwargs["task_ids"]), "Tasks completed", "These tasks have been completed")
+
+
+@receiver(tasks_undo)
+def tasks_undo_handler(sender, **kwargs):
+    send_batched_mail(
+        task_watchers(kwargs["task_ids"]), "Tasks marked incomplete", "These tasks have been marked incomplete"
+    )
+
+
+# Version stamps
+def deleted_directly(sender, instance, origin):
+    """False for rows removed by the cascade of a task delete, which already bumps their task"""
+    return origin is instance or (isinstance(origin, QuerySet) and origin.model is sender)
+
+
+@receiver([post_save, post_delete], sender=Task)
+def task_changed_handler(sender, instance, **kwargs):
+    bump_task_versions(instance.id)
+    bump_user_versions(instance.user_id)
+
+
+@receiver(post_save, sender=Task)
+def task_created_handler(sender, instance, created=False, **kwargs):
+    if created:
+        set_tasks_exist([instance.id], True)
+
+
+@receiver(post_delete, sender=Task)
+def task_deleted_handler(sender, instance, **kwargs):
+    set_tasks_exist([instance.id], False)
+
+
+# Task watchers, also derived from the raw saves of fixtures
+@receiver(post_save, sender=Task)
+def task_saved_watcher_handler(sender, instance, created=False, **kwargs):
+    TaskWatcher.add([(instance.id, instance.user_id)])
+    if not created:
+        # A previous owner stops watching unless they commented
+        TaskWatcher.prune(task_id=instance.id)
+
+
+@receiver(post_save, sender=Comment)
+def comment_saved_watcher_handler(sender, instance, created=False, **kwargs):
+    TaskWatcher.add([(instance.task_id, instance.user_id)])
+    if not created:
+        # The comment may have been moved to another task
+        TaskWatcher.prune(user_id=instance.user_id)
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted_watcher_handler(sender, instance, origin=None, **kwargs):
+    if deleted_directly(sender, instance, origin):
+        TaskWatcher.prune(task_id=instance.task_id, user_id=instance.user_id)
+
+
+# Running timers
+@receiver(post_save, sender=Task)
+def task_saved_timer_handler(sender, instance, created=False, raw=False, **kwargs):
+    if not created and not raw:
+        timers.move(instance.id, instance.user_id)
+
+
+@receiver(post_delete, sender=Task)
+def task_deleted_timer_handler(sender, instance, **kwargs):
+    timers.unregister(instance.id, instance.user_id)
+
+
+@receiver(post_save, sender=TimeLog)
+def time_log_saved_timer_handler(sender, instance, raw=False, **kwargs):
+    # The owner is only looked up when there is a registry to write to
+    if raw or not settings.TIMER_REGISTRY_ACTIVE:
+        return
+    if instance.duration is None:
+        timers.register(instance, instance.task.user_id)
+    else:
+        timers.unregister(instance.task_id, instance.task.user_id)
+
+
+@receiver(post_delete, sender=TimeLog)
+def time_log_deleted_timer_handler(sender, instance, origin=None, **kwargs):
+    if settings.TIMER_REGISTRY_ACTIVE and instance.duration is None and deleted_directly(sender, instance, origin):
+        timers.unregister(instance.task_id, instance.task.user_id)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_save, sender=TimeLog)
+@receiver(post_save, sender=TaskAttachment)
+def task_child_saved_handler(sender, instance, **kwargs):
+    bump_task_versions(instance.task_id)
+
+
+@receiver(post_delete, sender=Comment)
+@receiver(post_delete, sender=TimeLog)
+@receiver(post_delete, sender=TaskAttachment)
+def task_child_deleted_handler(sender, instance, origin=None, **kwargs):
+    if deleted_directly(sender, instance, origin):
+        bump_task_versions(instance.task_id)
@@ -1,17 +1,35 @@
+from itertools import batched
 from smtplib import SMTPException
 
-from django.core.mail import send_mail
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection, send_mail
 
-from celery import shared_task
+from celery import group, shared_task
 from celery.schedules import crontab
-from django.db.models import Sum, F
+from elasticsearch import ApiError, NotFoundError, TransportError
+from elasticsearch.helpers import BulkIndexError
+from django.db import transaction
+from django.db.models import Count, F
 from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.duration import duration_string
 
-from apps.tasks.models import Task
-from apps.tasks.serializers import TaskPreviewSerializer
+from apps.tasks import timers
+from apps.tasks.models import Comment, NotificationEvent, Task
 from apps.users.models import User
 from config.celery import app
 
+WEEKLY_REPORT_SIZE = 20
+# Set per report and user once the report of the user is queued, kept until the next report
+WEEKLY_REPORT_SENT_KEY = "tasks:weekly-report:{}:user:{}"
+WEEKLY_REPORT_TIMEOUT = 60 * 60 * 24 * 7
+# Set while a digest of the user is scheduled
+NOTIFICATION_DIGEST_KEY = "tasks:notifications:digest:{}"
+# Elasticsearch unreachable, overloaded or rejecting part of a bulk request, the search tasks retry with backoff
+SEARCH_ERRORS = (TransportError, ApiError, BulkIndexError)
+SEARCH_RETRY = {"autoretry_for": SEARCH_ERRORS, "retry_backoff": True, "retry_backoff_max": 600, "max_retries": 8}
+
 
 @app.on_after_finalize.connect
 def setup_periodic_tasks(sender, **kwargs):
@@ -19,6 +37,16 @@ def setup_periodic_tasks(sender, **kwargs):
     sender.add_periodic_task(
         crontab(hour=7, minute=30, day_of_week=1), send_weekly_report.s(), name="Weekly Task Report"
     )
+    # Events whose relay was not triggered, e.g. while the broker was down
+    sender.add_periodic_task(settings.OUTBOX_RELAY_INTERVAL, relay_outbox_events.s(), name="Outbox Relay")
+    # Running timers lost from the registry, e.g. to an eviction or a flush
+    sender.add_periodic_task(
+        settings.TIMER_RECONCILE_INTERVAL, reconcile_running_timers.s(), name="Reconcile Running Timers"
+    )
+    # Digests whose scheduled send was lost, e.g. to a worker crash
+    sender.add_periodic_task(
+        settings.NOTIFICATION_DIGEST_WINDOW, send_notification_digests.s(), name="Overdue Notification Digests"
+    )
 
 
 @shared_task(bind=True, max_retries=5, default_retry_delay=30)
@@ -30,22 +58,278 @@ def c_send_mail(self, recipient, subject, message, html_message=None):
     return {"success": True, "message": "Email sent!"}
 
 
-@shared_task
+def mail_message(recipient, subject, message, html_message=None) -> dict:
+    """Arguments of c_send_mail as one message of c_send_mail_batch"""
+    return {"recipient": recipient, "subject": subject, "message": message, "html_message": html_message}
+
+
+@shared_task(bind=True, max_retries=5, default_retry_delay=30)
+def c_send_mail_batch(self, messages):
+    """
+    Send many messages (see mail_message) over a single SMTP connection.
+
+    A message that fails does not stop the batch, only the failed messages are retried.
+    """
+    failed = []
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+        for data in messages:
+            email = EmailMultiAlternatives(
+                data["subject"], data["message"], None, data["recipient"], connection=connection
+            )
+            if data["html_message"]:
+                email.attach_alternative(data["html_message"], "text/html")
+            try:
+                email.send()
+            except SMTPException as exc:
+                failed.append(data)
+                error = exc
+    except SMTPException as exc:
+        raise self.retry(exc=exc)
+    finally:
+        connection.close()
+
+    if failed:
+        raise self.retry(args=[failed], exc=error)
+    return {"success": True, "message": f"{len(messages)} emails sent!"}
+
+
+def send_mail_batches(messages, batch_size=None):
+    """Enqueue `messages` in batches of `batch_size` (MAIL_BATCH_SIZE), returns the number of batches"""
+    batches = 0
+    for batch in batched(messages, batch_size or settings.MAIL_BATCH_SIZE):
+        c_send_mail_batch.delay(list(batch))
+        batches += 1
+    return batches
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
 def send_weekly_report():
-    subject = "Weekly Report"
-    users = User.objects.all()
-
-    for user in users:
-        tasks = (
-            Task.objects.filter(user=user)
-            .annotate(time_all=Sum("timelog__duration"))
-            .order_by(F("time_all").desc(nulls_last=True))[:20]
+    """
+    Split the users into id ranges of WEEKLY_REPORT_CHUNK_SIZE and send their reports from a group of tasks.
+
+    The ids are streamed, so the dispatch does not load the users, and the chunk tasks record the users
+    they sent per report, so dispatching again after a crash only sends the reports that are missing, even
+    if users were created or deleted in between and the ranges moved. A crash between queueing a batch and
+    recording it can still send that batch twice.
+    """
+    report_id = timezone.localdate().strftime("%G-W%V")
+    user_ids = (
+        User.objects.order_by("id").values_list("id", flat=True).iterator(chunk_size=settings.STREAMING_CHUNK_SIZE)
+    )
+    chunks = [(chunk[0], chunk[-1]) for chunk in batched(user_ids, settings.WEEKLY_REPORT_CHUNK_SIZE)]
+    group(send_weekly_report_chunk.s(report_id, first_id, last_id) for first_id, last_id in chunks).apply_async()
+    return {"report": report_id, "chunks": len(chunks)}
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def send_weekly_report_chunk(report_id, first_user_id, last_user_id):
+    """Send the weekly report of the users with ids in [first_user_id, last_user_id] not yet sent for `report_id`"""
+    users = list(
+        User.objects.filter(id__gte=first_user_id, id__lte=last_user_id).order_by("id").values_list("id", "email")
+    )
+    keys = {user_id: WEEKLY_REPORT_SENT_KEY.format(report_id, user_id) for user_id, _ in users}
+    already_sent = cache.get_many(keys.values())
+    users = [(user_id, email) for user_id, email in users if keys[user_id] not in already_sent]
+    if not users:
+        return {"report": report_id, "sent": 0}
+
+    tasks = (
+        Task.objects.filter(user_id__in=[user_id for user_id, _ in users])
+        .top_time_spent(WEEKLY_REPORT_SIZE)
+        .values("id", "title", "user_id", time_all=F("time_spent"))
+    )
+    reports = {}
+    for task in tasks:
+        reports.setdefault(task["user_id"], []).append(task)
+
+    def messages():
+        for user_id, email in users:
+            message, message_html = render_weekly_report(reports.get(user_id, []))
+            yield user_id, mail_message([email], "Weekly Report", message, message_html)
+
+    sent = 0
+    for batch in batched(messages(), settings.MAIL_BATCH_SIZE):
+        c_send_mail_batch.delay([message for _, message in batch])
+        cache.set_many({keys[user_id]: True for user_id, _ in batch}, timeout=WEEKLY_REPORT_TIMEOUT)
+        sent += len(batch)
+    return {"report": report_id, "sent": sent}
+
+
+def render_weekly_report(tasks):
+    message = "Top Tasks by time:\n"
+    for count, task in enumerate(tasks, 1):
+        time_spent = duration_string(task["time_all"]) if task["time_all"] is not None else None
+        message += f"{count}. Id: {task["id"]}, Title: {task["title"]}, Time spent: {time_spent}\n"
+    return message, render_to_string("tasks/tasks_email.html", {"tasks": tasks})
+
+
+def notify(user_ids, task, subject, message):
+    """
+    Buffer a notification for every user in `user_ids` instead of mailing it right away.
+
+    The pending notifications of a user are mailed as one digest NOTIFICATION_DIGEST_WINDOW seconds after
+    the first of them, or as soon as NOTIFICATION_DIGEST_MAX_EVENTS are pending.
+    """
+    user_ids = set(user_ids)
+    NotificationEvent.objects.bulk_create(
+        NotificationEvent(user_id=user_id, task=task, subject=subject, message=message) for user_id in user_ids
+    )
+    transaction.on_commit(lambda: schedule_notification_digests(user_ids))
+
+
+def schedule_notification_digests(user_ids):
+    pending = (
+        NotificationEvent.objects.filter(user__in=user_ids)
+        .order_by()
+        .values("user")
+        .annotate(count=Count("id"))
+        .values_list("user", "count")
+    )
+    full = [user_id for user_id, count in pending if count >= settings.NOTIFICATION_DIGEST_MAX_EVENTS]
+    if full:
+        send_notification_digests.delay(full)
+
+    window = settings.NOTIFICATION_DIGEST_WINDOW
+    # One scheduled digest per user and window, the first event of the window schedules it
+    waiting = [
+        user_id
+        for user_id in set(user_ids) - set(full)
+        if cache.add(NOTIFICATION_DIGEST_KEY.format(user_id), True, timeout=window)
+    ]
+    if waiting:
+        send_notification_digests.apply_async((waiting,), countdown=window)
+
+
+@shared_task
+def send_notification_digests(user_ids=None):
+    """Mail the pending notifications of `user_ids`, or of every user with one older than the digest window"""
+    events = NotificationEvent.objects.order_by("user_id", "id")
+    if user_ids is None:
+        overdue = timezone.now() - timezone.timedelta(seconds=settings.NOTIFICATION_DIGEST_WINDOW)
+        user_ids = list(events.filter(created_at__lte=overdue).order_by().values_list("user_id", flat=True).distinct())
+    cache.delete_many([NOTIFICATION_DIGEST_KEY.format(user_id) for user_id in user_ids])
+
+    with transaction.atomic():
+        # Events claimed by a concurrent digest are skipped rather than mailed twice
+        pending = list(
+            events.filter(user__in=user_ids)
+            .select_for_update(skip_locked=True, of=("self",))
+            .values("id", "user_id", "user__email", "subject", "message")
         )
-        message_html = render_to_string("tasks/tasks_email.html", {"tasks": tasks})
-        serializer = TaskPreviewSerializer(tasks, many=True)
-        message = "Top Tasks by time:\n"
-        count = 0
-        for task in serializer.data:
-            count += 1
-            message += f"{count}. Id: {task["id"]}, Title: {task["title"]}, Time spent: {task["time_spent"]}\n"
-        c_send_mail.delay([user.email], subject, message, message_html)
+        digests = {}
+        for event in pending:
+            digests.setdefault(event["user__email"], []).append(event)
+        # Queued before the events are deleted: a broker error rolls the delete back and the periodic task
+        # sends them later. A failed commit after the enqueue can mail a digest twice, never lose it.
+        send_mail_batches(digest_message(email, user_events) for email, user_events in digests.items())
+        NotificationEvent.objects.filter(id__in=[event["id"] for event in pending]).delete()
+    return {"success": True, "message": f"{len(digests)} digests sent!"}
+
+
+def digest_message(email, events):
+    """A single pending notification is mailed as is, several as one digest"""
+    if len(events) == 1:
+        return mail_message([email], events[0]["subject"], events[0]["message"])
+    message = "\n\n".join(f"{event["subject"]}:\n{event["message"]}" for event in events)
+    return mail_message([email], f"{len(events)} task notifications", message)
+
+
+@shared_task
+def relay_outbox_events():
+    """Relay the due events of the outbox in batches"""
+    from apps.tasks.outbox import relay_all
+
+    relayed, failed = relay_all(settings.OUTBOX_RELAY_BATCH_SIZE)
+    return {"success": True, "message": f"{relayed} events relayed, {failed} failed!"}
+
+
+@shared_task
+def reconcile_running_timers():
+    """Rebuild the registry of running timers from the database"""
+    if not settings.TIMER_REGISTRY_ACTIVE:
+        return {"success": True, "message": "Timer registry not active!"}
+
+    running = timers.reconcile()
+    return {"success": True, "message": f"{running} running timers registered!"}
+
+
+@shared_task(**SEARCH_RETRY)
+def sync_task_documents(task_ids):
+    """Index the documents of the tasks in one bulk request, and delete the ones of deleted tasks"""
+    from apps.tasks.documents import INDEX_PENDING_KEY, TaskDocument, update_reindex_target
+
+    # Changes from now on schedule the task again
+    cache.delete_many([INDEX_PENDING_KEY.format(task_id) for task_id in task_ids])
+
+    document = TaskDocument()
+    tasks = list(document.get_queryset().filter(id__in=task_ids))
+    if tasks:
+        document.update(tasks)
+        update_reindex_target(document, tasks)
+    deleted = set(task_ids) - {task.id for task in tasks}
+    if deleted:
+        deleted_tasks = [Task(id=task_id) for task_id in sorted(deleted)]
+        document.update(deleted_tasks, action="delete", raise_on_error=False)
+        update_reindex_target(document, deleted_tasks, action="delete")
+    return {"success": True, "message": f"{len(tasks)} tasks indexed, {len(deleted)} deleted!"}
+
+
+@shared_task(**SEARCH_RETRY)
+def sync_task_comments(task_id, comment_ids):
+    """Write the current version of comments into the document of their task, deleted comments are removed"""
+    from apps.tasks.documents import COMMENTS_SCRIPT, REINDEX_TARGET_KEY, TaskDocument, record_reindex_changes
+
+    comments = list(Comment.objects.filter(id__in=comment_ids, task_id=task_id).values("id", "body"))
+    script = {"source": COMMENTS_SCRIPT, "lang": "painless", "params": {"ids": comment_ids, "comments": comments}}
+
+    client = TaskDocument._get_connection()
+    try:
+        response = client.update(
+            index=TaskDocument._index._name, id=task_id, script=script, retry_on_conflict=3, refresh=True
+        )
+    except NotFoundError:
+        # Not indexed yet, or deleted with the task
+        return sync_task_documents([task_id])
+    if response["result"] == "noop":
+        # Indexed before the comments had ids, they cannot be replaced one by one
+        return sync_task_documents([task_id])
+
+    target = cache.get(REINDEX_TARGET_KEY)
+    if target is not None:
+        record_reindex_changes(target, [task_id])
+        try:
+            client.update(index=target, id=task_id, script=script, retry_on_conflict=3)
+        except NotFoundError:
+            # Not streamed into the new index yet, it is read with the comments
+            pass
+    return {
+        "success": True,
+        "message": f"{len(comments)} comments indexed, {len(comment_ids) - len(comments)} removed!",
+    }
+
+
+@shared_task(**SEARCH_RETRY)
+def sync_user_documents(user_id):
+    """Set the current email of a user in the documents of their tasks with one update_by_query"""
+    from apps.tasks.documents import REINDEX_TARGET_KEY, TaskDocument, record_reindex_changes
+
+    email = User.objects.filter(id=user_id).values_list("email", flat=True).first()
+    if email is None:
+        return {"success": True, "message": "User deleted!"}
+
+    target = cache.get(REINDEX_TARGET_KEY)
+    if target is not None:
+        record_reindex_changes(target, Task.objects.filter(user_id=user_id).values_list("id", flat=True))
+    indexes = [TaskDocument._index._name, target]
+    response = TaskDocument._get_connection().update_by_query(
+        index=",".join(index for index in indexes if index),
+        query={"term": {"user.id": user_id}},
+        script={"source": "ctx._source.user.email = params.email", "lang": "painless", "params": {"email": email}},
+        # Documents indexed in the meantime were built with the current email
+        conflicts="proceed",
+        ignore_unavailable=True,
+        refresh=True,
+    )
+    return {"success": True, "message": f"{response["updated"]} documents updated!"}
@@ -1,26 +1,76 @@
+import csv
 import datetime
+import json
 import logging
-from unittest import skipUnless
+from fnmatch import fnmatch
+from importlib import import_module
+from smtplib import SMTPException
+from io import StringIO
+from unittest import mock, skipUnless
 
 
+from django.apps import apps as django_apps
+from django.conf import settings
 from django.core import mail
+from django.core.mail import get_connection
+from django.core.mail.backends import locmem
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
+from django.test.utils import CaptureQueriesContext
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import QueryDict
 from django.urls import reverse
 from django.utils import timezone
 
+from elasticsearch import NotFoundError, TransportError
+from redis.exceptions import ConnectionError as RedisConnectionError
 from rest_framework import status
 from rest_framework.test import APIClient, APITestCase
 
 from config.celery import app as celery_app
 from config.settings import ELASTICSEARCH_ACTIVE
 
+from apps.common.helpers import ValuesSerializer
+from apps.common.pagination import IdCursorPagination
 from apps.users.models import User
-from apps.tasks.models import Task, Comment, TimeLog, TaskAttachment
-from apps.tasks.serializers import TaskSerializer, CommentSerializer, TimeLogSerializer
+from apps.tasks import timers
+from apps.tasks.documents import TaskDocument, TaskSignalProcessor, reindex_changes
+from apps.tasks.exceptions import TimeLogError
+from apps.tasks.models import (
+    Task,
+    Comment,
+    TimeLog,
+    TaskAttachment,
+    TimeLogRollup,
+    NotificationEvent,
+    TaskWatcher,
+    OutboxEvent,
+)
+from apps.tasks.tasks import (
+    WEEKLY_REPORT_SENT_KEY,
+    c_send_mail_batch,
+    mail_message,
+    reconcile_running_timers,
+    send_notification_digests,
+    send_weekly_report,
+    sync_task_comments,
+    sync_task_documents,
+    sync_user_documents,
+)
+from apps.tasks.serializers import (
+    TaskSerializer,
+    TaskPreviewSerializer,
+    CommentSerializer,
+    TimeLogSerializer,
+    TaskDocumentSearchSerializer,
+)
+from apps.tasks.versions import user_version
 
 
 class TestTasks(APITestCase):
-    fixtures = ["fixtures/users", "fixtures/tasks", "fixtures/timelogs"]
+    fixtures = ["fixtures/users", "fixtures/tasks", "fixtures/timelogs", "fixtures/timelogrollups"]
 
     def setUp(self) -> None:
         logging.disable(logging.CRITICAL)
@@ -28,6 +78,9 @@ class TestTasks(APITestCase):
             task_always_eager=True,
         )
 
+        # Cached responses and version stamps outlive the rolled back test transactions
+        cache.clear()
+
         self.client = APIClient()
 
         self.user = User.objects.get(pk=1)
@@ -52,7 +105,7 @@ class TestTasks(APITestCase):
         response = self.client.get(reverse("tasks-list"))
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), Task.objects.filter(user=self.user).count())
+        self.assertEqual(len(response.data["results"]), Task.objects.filter(user=self.user).count())
         self.assertContains(response, "id")
         self.assertContains(response, "title")
 
@@ -62,7 +115,7 @@ class TestTasks(APITestCase):
         response = self.client.get(reverse("tasks-list"))
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), Task.objects.filter(user=self.user2).count())
+        self.assertEqual(len(response.data["results"]), Task.objects.filter(user=self.user2).count())
 
     # Check if time_spent is in response
     def test_get_tasks_check_time(self) -> None:
@@ -77,7 +130,7 @@ class TestTasks(APITestCase):
         for time_log in task3_log_set.all():
             task3_time_spent += time_log.duration
 
-        r_task3 = next(task for task in response.data if task["id"] == 3)
+        r_task3 = next(task for task in response.data["results"] if task["id"] == 3)
         r_time = r_task3["time_spent"]
         r_time = datetime.datetime.strptime(r_time, "%H:%M:%S")
         r_time = timezone.timedelta(hours=r_time.hour, minutes=r_time.minute, seconds=r_time.second)
@@ -86,14 +139,64 @@ class TestTasks(APITestCase):
     # Check if time_spent is calculated correctly for task without timelogs
     def test_get_tasks_calculate_time_no_timelogs(self) -> None:
         response = self.client.get(reverse("tasks-list"))
-        r_task2 = next(task for task in response.data if task["id"] == 2)
+        r_task2 = next(task for task in response.data["results"] if task["id"] == 2)
         r_time = r_task2["time_spent"]
         self.assertEqual(r_time, None)
 
+    # Annotated read paths compute the aggregates in one query
+    def test_task_queryset_annotations(self) -> None:
+        TaskAttachment.objects.create(task_id=3, file=SimpleUploadedFile("a.png", b"file_content"))
+        Comment.objects.create(task_id=3, user=self.user, body="Test comment")
+
+        with self.assertNumQueries(1):
+            tasks = list(
+                Task.objects.filter(id__in=[2, 3]).with_time_spent().with_comment_count().with_attachment_count()
+            )
+
+        task2, task3 = sorted(tasks, key=lambda task: task.id)
+        self.assertIsNone(task2.time_all)
+        self.assertEqual(task3.time_all, timezone.timedelta(minutes=45))
+        self.assertEqual((task3.comment_count, task3.attachment_count), (1, 1))
+        self.assertEqual((task2.comment_count, task2.attachment_count), (0, 0))
+
+    # Serializers prefer the annotation over the stored column
+    def test_task_serializer_reads_annotation(self) -> None:
+        Task.objects.filter(id=3).update(time_spent=timezone.timedelta(hours=9))
+
+        task = Task.objects.with_time_spent().get(id=3)
+        self.assertEqual(TaskPreviewSerializer(task).data["time_spent"], "00:45:00")
+        self.assertEqual(TaskPreviewSerializer(Task.objects.get(id=3)).data["time_spent"], "09:00:00")
+
+    # Rows rendered from values() match the model serializers
+    def test_values_serializer_matches_serializer(self) -> None:
+        Comment.objects.create(task_id=1, user=self.user, body="Test comment")
+        cases = [
+            (TaskPreviewSerializer, Task.objects.order_by("id")),
+            (TimeLogSerializer, TimeLog.objects.order_by("id")),
+            (CommentSerializer, Comment.objects.order_by("id")),
+        ]
+        for serializer_class, queryset in cases:
+            rows = ValuesSerializer(serializer_class)
+            self.assertEqual(rows.to_representation(rows.values(queryset)), serializer_class(queryset, many=True).data)
+
+    def test_export_tasks(self) -> None:
+        response = self.client.get(reverse("tasks-export"), {"user": self.user2.id}, HTTP_ACCEPT="application/x-ndjson")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(
+            [row["id"] for row in rows], list(Task.objects.filter(user=self.user2).values_list("id", flat=True))
+        )
+        self.assertEqual(set(rows[0]), {"id", "title", "description", "is_completed", "user", "time_spent"})
+
+        response = self.client.get(reverse("tasks-export"))
+        rows = list(csv.DictReader(StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual(len(rows), Task.objects.count())
+
     def test_get_user_tasks(self) -> None:
         response = self.client.get(reverse("tasks-user", kwargs={"pk": 1}))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), Task.objects.filter(user=self.user).count())
+        self.assertEqual(len(response.data["results"]), Task.objects.filter(user=self.user).count())
 
     # User ID does not exist
     def test_get_user_tasks_no_user(self) -> None:
@@ -105,10 +208,41 @@ class TestTasks(APITestCase):
         response = self.client.get(reverse("tasks-all-tasks"))
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), len(self.tasks))
+        self.assertEqual(len(response.data["results"]), len(self.tasks))
         self.assertContains(response, "title")
         self.assertContains(response, "id")
 
+    # Walk all tasks page by page using the cursor
+    def test_get_all_task_paginated(self) -> None:
+        task_ids = []
+        url = reverse("tasks-all-tasks") + "?page_size=4"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data["results"]), 4)
+            task_ids += [task["id"] for task in response.data["results"]]
+            url = response.data["next"]
+
+        self.assertEqual(task_ids, sorted(task["id"] for task in self.tasks))
+
+    # Page size is capped by the configured maximum
+    def test_get_all_task_max_page_size(self) -> None:
+        with mock.patch.object(IdCursorPagination, "max_page_size", 2):
+            response = self.client.get(reverse("tasks-all-tasks"), {"page_size": 10})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data["results"]), 2)
+        self.assertIsNotNone(response.data["next"])
+
+    # Stream all tasks as a single array
+    def test_get_all_task_stream(self) -> None:
+        with mock.patch.object(settings, "STREAMING_CHUNK_SIZE", 4):
+            response = self.client.get(reverse("tasks-all-tasks"), {"stream": "true"})
+            content = b"".join(response.streaming_content)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(content), TaskPreviewSerializer(Task.objects.order_by("id"), many=True).data)
+
     def test_get_task(self) -> None:
         response = self.client.get(reverse("tasks-detail", args=[1]))
 
@@ -136,9 +270,9 @@ class TestTasks(APITestCase):
         completed_tasks = Task.objects.filter(is_completed=True, user=self.user)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), completed_tasks.count())
-        self.assertEqual(response.data[0]["title"], completed_tasks[0].title)
-        self.assertEqual(response.data[0]["id"], completed_tasks[0].id)
+        self.assertEqual(len(response.data["results"]), completed_tasks.count())
+        self.assertEqual(response.data["results"][0]["title"], completed_tasks[0].title)
+        self.assertEqual(response.data["results"][0]["id"], completed_tasks[0].id)
         self.assertContains(response, "title")
         self.assertContains(response, "id")
 
@@ -146,16 +280,16 @@ class TestTasks(APITestCase):
         self.client.force_authenticate(user=self.user)
         response = self.client.get(reverse("tasks-incomplete-tasks"))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 3)
+        self.assertEqual(len(response.data["results"]), 3)
 
     # Search full title
     def test_search_task(self) -> None:
         response = self.client.post(reverse("tasks-search"), {"search": "Test task 1"})
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 1)
-        self.assertEqual(response.data[0]["title"], "Test task 1")
-        self.assertEqual(response.data[0]["id"], 1)
+        self.assertEqual(len(response.data["results"]), 1)
+        self.assertEqual(response.data["results"][0]["title"], "Test task 1")
+        self.assertEqual(response.data["results"][0]["id"], 1)
         self.assertContains(response, "title")
         self.assertContains(response, "id")
 
@@ -164,13 +298,13 @@ class TestTasks(APITestCase):
         response = self.client.post(reverse("tasks-search"), {"search": "Finish"})
         task_nr = Task.objects.filter(title__icontains="Finish").count()
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), task_nr)
+        self.assertEqual(len(response.data["results"]), task_nr)
 
     # Title does not exist
     def test_search_task_no_task(self) -> None:
         response = self.client.post(reverse("tasks-search"), {"search": "Idempotent"})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data["results"]), 0)
 
     def test_assign_task(self) -> None:
         response = self.client.patch(reverse("tasks-assign-task", args=[1]), {"user": self.user2.id})
@@ -250,6 +384,85 @@ class TestTasks(APITestCase):
         response = self.client.patch(reverse("tasks-undo-task", args=[9999]))
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_bulk_create_tasks(self) -> None:
+        tasks = [
+            {"title": "Bulk task 1", "description": "One", "is_completed": False},
+            {"description": "No title"},
+            {"title": "Bulk task 2", "description": "Two", "is_completed": True},
+        ]
+        response = self.client.post(reverse("tasks-bulk"), tasks, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result["index"] for result in response.data], [0, 1, 2])
+        self.assertIn("title", response.data[1]["errors"])
+        created = Task.objects.filter(id__in=[response.data[0]["id"], response.data[2]["id"]])
+        self.assertEqual(list(created.values_list("title", "user")), [("Bulk task 1", 1), ("Bulk task 2", 1)])
+
+    def test_bulk_create_tasks_not_list(self) -> None:
+        response = self.client.post(reverse("tasks-bulk"), {"title": "Bulk task"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(reverse("tasks-bulk"), [], format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_complete(self) -> None:
+        response = self.client.patch(reverse("tasks-bulk-complete"), {"ids": [1, 2, 1, 9999]}, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data,
+            [
+                {"id": 1, "message": "Task completed successfully"},
+                {"id": 2, "error": "Task already completed"},
+                {"id": 9999, "error": "Task does not exist"},
+            ],
+        )
+        self.assertTrue(Task.objects.get(id=1).is_completed)
+
+    def test_bulk_undo(self) -> None:
+        response = self.client.patch(reverse("tasks-bulk-undo"), {"ids": [2, 3]}, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data,
+            [{"id": 2, "message": "Task undone successfully"}, {"id": 3, "error": "Task not yet completed"}],
+        )
+        self.assertFalse(Task.objects.get(id=2).is_completed)
+
+    def test_bulk_complete_too_many(self) -> None:
+        response = self.client.patch(
+            reverse("tasks-bulk-complete"), {"ids": list(range(settings.BULK_MAX_ITEMS + 1))}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_assign(self) -> None:
+        response = self.client.patch(
+            reverse("tasks-bulk-assign"), {"ids": [1, 6, 9999], "user": self.user2.id}, format="json"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.data,
+            [
+                {"id": 1, "message": "Task assigned successfully"},
+                {"id": 6, "error": "Task already belongs to user"},
+                {"id": 9999, "error": "Task does not exist"},
+            ],
+        )
+        self.assertEqual(Task.objects.get(id=1).user, self.user2)
+
+    def test_bulk_assign_no_user(self) -> None:
+        response = self.client.patch(reverse("tasks-bulk-assign"), {"ids": [1], "user": 9999}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_tasks_modified_by_bulk_complete(self) -> None:
+        response = self.client.get(reverse("tasks-incomplete-tasks"))
+        self.assertIn(1, [task["id"] for task in response.data["results"]])
+
+        self.client.patch(reverse("tasks-bulk-complete"), {"ids": [1]}, format="json")
+        response = self.client.get(reverse("tasks-incomplete-tasks"))
+        self.assertNotIn(1, [task["id"] for task in response.data["results"]])
+
     def test_delete_task(self) -> None:
         response = self.client.delete(reverse("tasks-detail", args=[1]))
 
@@ -272,6 +485,85 @@ class TestTasks(APITestCase):
         response = self.client.delete(reverse("tasks-detail", args=[9999]))
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_get_tasks_not_modified(self) -> None:
+        response = self.client.get(reverse("tasks-list"))
+        etag = response["ETag"]
+        # Whole seconds cannot tell apart writes made in the second of the response
+        self.assertNotIn("Last-Modified", response)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("tasks-list"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Another page is another representation
+        response = self.client.get(reverse("tasks-list"), {"page_size": 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.client.post(reverse("tasks-list"), self.tasks[0])
+        response = self.client.get(reverse("tasks-list"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+    # Both the previous and the new owner see the reassigned task
+    def test_get_tasks_modified_by_assign(self) -> None:
+        etag = self.client.get(reverse("tasks-list"))["ETag"]
+        self.client.force_authenticate(user=self.user2)
+        etag2 = self.client.get(reverse("tasks-list"))["ETag"]
+
+        Task.objects.get(id=1).assign_user(self.user2)
+
+        response = self.client.get(reverse("tasks-list"), HTTP_IF_NONE_MATCH=etag2)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse("tasks-list"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_get_tasks_cached(self) -> None:
+        response = self.client.get(reverse("tasks-list"))
+        with self.assertNumQueries(0):
+            cached = self.client.get(reverse("tasks-list"))
+        self.assertEqual(cached.data, response.data)
+
+        # Own writes are visible right away
+        self.client.post(reverse("tasks-list"), self.tasks[0])
+        response = self.client.get(reverse("tasks-list"))
+        self.assertEqual(len(response.data["results"]), Task.objects.filter(user=self.user).count())
+
+    def test_get_completed_tasks_cached(self) -> None:
+        self.client.get(reverse("tasks-completed-tasks"))
+        self.client.get(reverse("tasks-incomplete-tasks"))
+
+        self.client.patch(reverse("tasks-complete-task", args=[1]))
+
+        response = self.client.get(reverse("tasks-completed-tasks"))
+        self.assertIn(1, [task["id"] for task in response.data["results"]])
+        response = self.client.get(reverse("tasks-incomplete-tasks"))
+        self.assertNotIn(1, [task["id"] for task in response.data["results"]])
+
+    def test_get_user_tasks_cached_assign(self) -> None:
+        self.client.get(reverse("tasks-user", kwargs={"pk": self.user.id}))
+        self.client.get(reverse("tasks-user", kwargs={"pk": self.user2.id}))
+
+        self.client.patch(reverse("tasks-assign-task", args=[1]), {"user": self.user2.id})
+
+        response = self.client.get(reverse("tasks-user", kwargs={"pk": self.user.id}))
+        self.assertNotIn(1, [task["id"] for task in response.data["results"]])
+        response = self.client.get(reverse("tasks-user", kwargs={"pk": self.user2.id}))
+        self.assertIn(1, [task["id"] for task in response.data["results"]])
+
+    def test_get_task_not_modified(self) -> None:
+        etag = self.client.get(reverse("tasks-detail", args=[1]))["ETag"]
+
+        response = self.client.get(reverse("tasks-detail", args=[1]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self.client.get(reverse("tasks-detail", args=[2]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.client.patch(reverse("tasks-complete-task", args=[1]))
+        response = self.client.get(reverse("tasks-detail", args=[1]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data["is_completed"])
+
 
 class TestComments(APITestCase):
     fixtures = ["fixtures/users", "fixtures/tasks", "fixtures/comments"]
@@ -282,6 +574,8 @@ class TestComments(APITestCase):
             task_always_eager=True,
         )
 
+        cache.clear()
+
         self.client = APIClient()
 
         self.user = User.objects.get(pk=1)
@@ -322,6 +616,17 @@ class TestComments(APITestCase):
         response = self.client.get(reverse("tasks-comments", args=[9999]))
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_get_comments_not_modified(self) -> None:
+        etag = self.client.get(reverse("tasks-comments", args=[1]))["ETag"]
+
+        response = self.client.get(reverse("tasks-comments", args=[1]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.client.post(reverse("comments-list"), {"body": "Test comment 999", "task": 1})
+        response = self.client.get(reverse("tasks-comments", args=[1]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("Test comment 999", response.data)
+
 
 class TestMail(APITestCase):
     fixtures = ["fixtures/users", "fixtures/tasks", "fixtures/comments"]
@@ -332,6 +637,8 @@ class TestMail(APITestCase):
             task_always_eager=True,
         )
 
+        cache.clear()
+
         self.client = APIClient()
 
         self.user = User.objects.get(pk=1)
@@ -339,8 +646,24 @@ class TestMail(APITestCase):
 
         self.client.force_authenticate(user=self.user)
 
+    # Owners of bulk created tasks watch them like the ones created one by one
+    def test_mail_complete_bulk_created_task(self) -> None:
+        response = self.client.post(
+            reverse("tasks-bulk"), [{"title": "Bulk task", "description": "One", "is_completed": False}], format="json"
+        )
+        task_id = response.data[0]["id"]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(reverse("tasks-complete-task", args=[task_id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(message.subject, message.to) for message in mail.outbox], [("Task completed", [self.user.email])]
+        )
+
     def test_mail_assign_task(self) -> None:
-        response = self.client.patch(reverse("tasks-assign-task", args=[1]), {"user": self.user2.id})
+        # Events are relayed from the outbox once the request is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(reverse("tasks-assign-task", args=[1]), {"user": self.user2.id})
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
@@ -350,7 +673,9 @@ class TestMail(APITestCase):
 
     def test_mail_complete_task(self) -> None:
         # Task with no comments
-        response = self.client.patch(reverse("tasks-complete-task", args=[4]))
+        # Notifications are buffered until the request is committed, eager digests are sent right away
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(reverse("tasks-complete-task", args=[4]))
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
@@ -359,19 +684,339 @@ class TestMail(APITestCase):
         self.assertEqual(mail.outbox[0].subject, "Task completed")
 
         # Task with comments
-        response = self.client.patch(reverse("tasks-complete-task", args=[1]))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(reverse("tasks-complete-task", args=[1]))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-        # Check if email is sent
-        self.assertEqual(len(mail.outbox), 2)
-        self.assertEqual(mail.outbox[1].subject, "Task completed")
+        # Check if email is sent, one per recipient
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[2].subject, "Task completed")
 
         # Check if email is sent to comment user
-        self.assertIn(self.user2.email, mail.outbox[1].to)
+        self.assertIn([self.user2.email], [message.to for message in mail.outbox[1:]])
+
+    # Notifications within the window are mailed as one digest
+    def test_mail_notification_digest(self) -> None:
+        with mock.patch("apps.tasks.tasks.send_notification_digests.apply_async") as apply_async:
+            for i in range(3):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.client.post(reverse("comments-list"), {"body": f"Digest comment {i}", "task": 6})
+
+        self.assertEqual(len(mail.outbox), 0)
+        apply_async.assert_called_once_with(([self.user2.id],), countdown=settings.NOTIFICATION_DIGEST_WINDOW)
+
+        send_notification_digests.delay([self.user2.id])
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.user2.email])
+        self.assertEqual(mail.outbox[0].subject, "3 task notifications")
+        self.assertIn("Digest comment 2", mail.outbox[0].body)
+        self.assertFalse(NotificationEvent.objects.exists())
+
+    def test_mail_notification_digest_full(self) -> None:
+        with self.settings(NOTIFICATION_DIGEST_MAX_EVENTS=2):
+            with mock.patch("apps.tasks.tasks.send_notification_digests.apply_async") as apply_async:
+                for i in range(2):
+                    with self.captureOnCommitCallbacks(execute=True):
+                        self.client.post(reverse("comments-list"), {"body": f"Digest comment {i}", "task": 6})
+
+        # Scheduled by the first event, sent right away on the second
+        self.assertEqual(apply_async.call_count, 2)
+        self.assertEqual(apply_async.call_args.args[0], ([self.user2.id],))
+        self.assertNotIn("countdown", apply_async.call_args.kwargs)
+
+    # Digests whose scheduled send was lost are sent by the periodic task
+    def test_mail_notification_digest_overdue(self) -> None:
+        with mock.patch("apps.tasks.tasks.send_notification_digests.apply_async"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse("comments-list"), {"body": "Digest comment", "task": 6})
+
+        send_notification_digests.delay()
+        self.assertEqual(len(mail.outbox), 0)
+
+        NotificationEvent.objects.update(created_at=timezone.now() - timezone.timedelta(hours=1))
+        send_notification_digests.delay()
+        self.assertEqual([message.subject for message in mail.outbox], ["Task comment"])
+
+    # Events are only deleted once their digest is queued
+    def test_mail_notification_digest_broker_down(self) -> None:
+        with mock.patch("apps.tasks.tasks.send_notification_digests.apply_async"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse("comments-list"), {"body": "Digest comment", "task": 6})
+
+        with mock.patch("apps.tasks.tasks.c_send_mail_batch.delay", side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                send_notification_digests([self.user2.id])
+        self.assertEqual(NotificationEvent.objects.count(), 1)
+
+        send_notification_digests([self.user2.id])
+        self.assertEqual([message.subject for message in mail.outbox], ["Task comment"])
+        self.assertFalse(NotificationEvent.objects.exists())
+
+    def test_outbox_event_published_with_change(self) -> None:
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.patch(reverse("tasks-complete-task", args=[4]))
+
+        # Stored with the change, nothing is sent before the commit
+        event = OutboxEvent.objects.get()
+        self.assertEqual((event.name, event.payload), ("task_complete", {"task_id": 4}))
+        self.assertEqual(len(mail.outbox), 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for callback in callbacks:
+                callback()
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual([message.subject for message in mail.outbox], ["Task completed"])
+
+    def test_outbox_event_not_published_without_change(self) -> None:
+        self.client.patch(reverse("tasks-complete-task", args=[2]))
+        self.client.patch(reverse("tasks-bulk-complete"), {"ids": [2]}, format="json")
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    # Events stay in the outbox while the broker is down and are relayed later
+    def test_outbox_relay_after_broker_outage(self) -> None:
+        with mock.patch("apps.tasks.tasks.relay_outbox_events.delay", side_effect=ConnectionError):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.patch(reverse("tasks-assign-task", args=[1]), {"user": self.user2.id})
+                self.client.patch(reverse("tasks-complete-task", args=[4]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(OutboxEvent.objects.count(), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            out = StringIO()
+            call_command("relay-outbox", stdout=out)
+        self.assertIn("Relayed 2 outbox events, 0 failed.", out.getvalue())
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual([message.subject for message in mail.outbox], ["Task assigned", "Task completed"])
+
+    # A failing event is retried later and then set aside, without holding up the events after it
+    def test_outbox_failed_event(self) -> None:
+        with mock.patch("apps.tasks.tasks.relay_outbox_events.delay", side_effect=ConnectionError):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.patch(reverse("tasks-assign-task", args=[1]), {"user": self.user2.id})
+                self.client.patch(reverse("tasks-complete-task", args=[4]))
+        failing = mock.Mock()
+        failing.send.side_effect = SMTPException("Mail server down")
+
+        def relay_outbox():
+            out = StringIO()
+            with self.captureOnCommitCallbacks(execute=True):
+                call_command("relay-outbox", stdout=out)
+            return out.getvalue()
+
+        with self.settings(OUTBOX_MAX_ATTEMPTS=2), mock.patch.dict("apps.tasks.outbox.EVENTS", task_assigned=failing):
+            self.assertIn("Relayed 1 outbox events, 1 failed.", relay_outbox())
+            event = OutboxEvent.objects.get()
+            self.assertEqual(
+                (event.name, event.attempts, event.last_error), ("task_assigned", 1, "SMTPException: Mail server down")
+            )
+            self.assertGreater(event.retry_at, timezone.now())
+
+            # Not due before its retry time
+            self.assertIn("Relayed 0 outbox events, 0 failed.", relay_outbox())
+
+            OutboxEvent.objects.update(retry_at=timezone.now())
+            self.assertIn("Relayed 0 outbox events, 1 failed.", relay_outbox())
+            event.refresh_from_db()
+            self.assertEqual(event.attempts, 2)
+            self.assertIsNotNone(event.failed_at)
+        self.assertEqual([message.subject for message in mail.outbox], ["Task completed"])
+
+        # Set aside until it is queued again
+        self.assertIn("Relayed 0 outbox events, 0 failed.", relay_outbox())
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("relay-outbox", "--retry-failed", stdout=out)
+        self.assertIn("Relayed 1 outbox events, 0 failed.", out.getvalue())
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual([message.subject for message in mail.outbox], ["Task completed", "Task assigned"])
+
+    def test_task_watchers(self) -> None:
+        def watchers(task_id):
+            return set(TaskWatcher.objects.filter(task_id=task_id).values_list("user_id", flat=True))
+
+        # Owner and commenters, derived from the fixtures
+        self.assertEqual(watchers(1), {1, 2})
+        self.assertEqual(watchers(3), {1, 2, 3, 4})
+
+        # The previous owner keeps watching only if they commented
+        self.client.patch(reverse("tasks-assign-task", args=[4]), {"user": self.user2.id})
+        self.assertEqual(watchers(4), {2})
+        self.client.patch(reverse("tasks-bulk-assign"), {"ids": [1], "user": 3}, format="json")
+        self.assertEqual(watchers(1), {1, 2, 3})
+
+        self.client.post(reverse("comments-list"), {"body": "Watching", "task": 4})
+        self.assertEqual(watchers(4), {1, 2})
+        Comment.objects.get(body="Watching").delete()
+        self.assertEqual(watchers(4), {2})
+
+        maintained = set(TaskWatcher.objects.values_list("task_id", "user_id"))
+        TaskWatcher.rebuild()
+        self.assertEqual(set(TaskWatcher.objects.values_list("task_id", "user_id")), maintained)
+
+    def test_task_watchers_cached(self) -> None:
+        self.assertEqual(sorted(TaskWatcher.user_ids(1)), [1, 2])
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(TaskWatcher.user_ids(1)), [1, 2])
+
+        self.client.post(reverse("comments-list"), {"body": "Watching", "task": 1}, format="json")
+        self.client.force_authenticate(user=User.objects.get(pk=3))
+        self.client.post(reverse("comments-list"), {"body": "Watching", "task": 1}, format="json")
+        self.assertEqual(sorted(TaskWatcher.user_ids(1)), [1, 2, 3])
+
+        # Writes to the task that leave its watchers unchanged keep the cached ids
+        self.client.patch(reverse("tasks-complete-task", args=[1]))
+        self.client.post(reverse("comments-list"), {"body": "Watching again", "task": 1}, format="json")
+        with self.assertNumQueries(0):
+            self.assertEqual(sorted(TaskWatcher.user_ids(1)), [1, 2, 3])
+
+    def test_mail_bulk_assign(self) -> None:
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(
+                reverse("tasks-bulk-assign"), {"ids": [1, 3, 4], "user": self.user2.id}, format="json"
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # One email for all the tasks
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, "Tasks assigned")
+        self.assertEqual(mail.outbox[0].to, [self.user2.email])
+
+    def test_mail_bulk_complete(self) -> None:
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(reverse("tasks-bulk-complete"), {"ids": [1, 3, 4]}, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # One email per owner or commenter of any of the tasks
+        recipients = sorted(message.to[0] for message in mail.outbox)
+        self.assertEqual(recipients, sorted(User.objects.filter(id__in=[1, 2, 3, 4]).values_list("email", flat=True)))
+        self.assertTrue(all(message.subject == "Tasks completed" for message in mail.outbox))
+
+    def test_mail_bulk_complete_nothing_changed(self) -> None:
+        self.client.patch(reverse("tasks-bulk-complete"), {"ids": [2, 9999]}, format="json")
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_mail_batch_one_connection(self) -> None:
+        messages = [mail_message([f"user{i}@example.com"], f"Email {i}", "Body", "<p>Body</p>") for i in range(5)]
+
+        with mock.patch("apps.tasks.tasks.get_connection", wraps=get_connection) as connection:
+            c_send_mail_batch.delay(messages)
+
+        self.assertEqual(connection.call_count, 1)
+        self.assertEqual([message.subject for message in mail.outbox], [f"Email {i}" for i in range(5)])
+        self.assertEqual(mail.outbox[0].alternatives[0][0], "<p>Body</p>")
+
+    # Only the message that failed is sent again
+    def test_mail_batch_retry_failed(self) -> None:
+        messages = [mail_message([f"user{i}@example.com"], f"Email {i}", "Body") for i in range(3)]
+        send_messages = locmem.EmailBackend.send_messages
+        failures = {"user1@example.com": 2}
+
+        def flaky_send_messages(backend, email_messages):
+            recipient = email_messages[0].to[0]
+            if failures.get(recipient):
+                failures[recipient] -= 1
+                raise SMTPException("Temporary failure")
+            return send_messages(backend, email_messages)
+
+        with mock.patch.object(locmem.EmailBackend, "send_messages", flaky_send_messages):
+            c_send_mail_batch.delay(messages)
+
+        self.assertEqual(sorted(message.subject for message in mail.outbox), ["Email 0", "Email 1", "Email 2"])
+
+    def test_mail_bulk_complete_one_batch(self) -> None:
+        with mock.patch("apps.tasks.tasks.c_send_mail_batch.delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.patch(reverse("tasks-bulk-complete"), {"ids": [1, 3, 4]}, format="json")
+
+        self.assertEqual(delay.call_count, 1)
+        self.assertEqual(len(delay.call_args.args[0]), 4)
+
+    def test_weekly_report(self) -> None:
+        Task.objects.update(time_spent=None)
+        Task.objects.filter(id=3).update(time_spent=timezone.timedelta(hours=2))
+        Task.objects.filter(id=1).update(time_spent=timezone.timedelta(hours=1))
+
+        with self.settings(WEEKLY_REPORT_CHUNK_SIZE=4):
+            result = send_weekly_report.delay().get()
+
+        self.assertEqual(result["chunks"], 2)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), sorted(u.email for u in User.objects.all()))
+        report = next(message for message in mail.outbox if message.to == [self.user.email])
+        self.assertEqual(report.subject, "Weekly Report")
+        lines = report.body.splitlines()
+        self.assertEqual(lines[1], f"1. Id: 3, Title: {Task.objects.get(id=3).title}, Time spent: 02:00:00")
+        self.assertEqual(lines[2], f"2. Id: 1, Title: {Task.objects.get(id=1).title}, Time spent: 01:00:00")
+        self.assertEqual(len(lines), 1 + Task.objects.filter(user=self.user).count())
+
+    # Users sent before an interruption are skipped, even if users were created and deleted since
+    def test_weekly_report_resume(self) -> None:
+        report_id = timezone.localdate().strftime("%G-W%V")
+        cache.set_many({WEEKLY_REPORT_SENT_KEY.format(report_id, user_id): True for user_id in (1, 2, 3)})
+        User.objects.create(username="late", email="late@example.mail.com")
+        User.objects.filter(id=2).delete()
+
+        # Chunks of two users no longer line up with the ranges of the first run
+        with self.settings(WEEKLY_REPORT_CHUNK_SIZE=2):
+            send_weekly_report.delay()
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            sorted(User.objects.filter(id__gt=3).values_list("email", flat=True)),
+        )
+
+        mail.outbox.clear()
+        send_weekly_report.delay()
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_top_time_spent(self) -> None:
+        Task.objects.update(time_spent=None)
+        Task.objects.filter(id=4).update(time_spent=timezone.timedelta(minutes=5))
+
+        with self.assertNumQueries(1):
+            top = list(Task.objects.top_time_spent(2).values_list("user_id", "id", "rank"))
+        self.assertEqual(top[:2], [(1, 4, 1), (1, 1, 2)])
+        for user_id in {user_id for user_id, _, _ in top}:
+            self.assertEqual(
+                len([task for task in top if task[0] == user_id]), min(2, Task.objects.filter(user=user_id).count())
+            )
+
+
+class FakeRegistry:
+    """In-memory stand-in for the redis hashes of the running timer registry"""
+
+    def __init__(self):
+        self.hashes = {}
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(str(field))
+
+    def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[str(field)] = value
+
+    def hdel(self, key, field):
+        self.hashes.get(key, {}).pop(str(field), None)
+
+    def hvals(self, key):
+        return list(self.hashes.get(key, {}).values())
+
+    def delete(self, *keys):
+        for key in keys:
+            self.hashes.pop(key, None)
+
+    def scan_iter(self, pattern):
+        return [key for key in self.hashes if fnmatch(key, pattern)]
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
 
 
 class TestTimeLog(APITestCase):
-    fixtures = ["fixtures/users", "fixtures/tasks", "fixtures/timelogs"]
+    fixtures = ["fixtures/users", "fixtures/tasks", "fixtures/timelogs", "fixtures/timelogrollups"]
 
     def setUp(self) -> None:
         logging.disable(logging.CRITICAL)
@@ -379,6 +1024,8 @@ class TestTimeLog(APITestCase):
             task_always_eager=True,
         )
 
+        cache.clear()
+
         self.client = APIClient()
 
         self.user = User.objects.get(pk=1)
@@ -447,6 +1094,124 @@ class TestTimeLog(APITestCase):
         response = self.client.patch(reverse("tasks-stop-timer", args=[1]))
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
+    # Stop timer for task without any time logs
+    def test_stop_timer_no_logs(self) -> None:
+        response = self.client.patch(reverse("tasks-stop-timer", args=[5]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(response.data["message"], "TimeLog is already stopped")
+
+    def test_get_running_logs(self) -> None:
+        self.client.patch(reverse("tasks-start-timer", args=[5]))
+
+        response = self.client.get(reverse("timelogs-running"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        running = TimeLog.objects.filter(task__user=self.user, duration=None).order_by("id")
+        self.assertEqual(response.data, TimeLogSerializer(running, many=True).data)
+        self.assertEqual([log["task"] for log in response.data], [2, 5])
+
+        self.client.patch(reverse("tasks-stop-timer", args=[5]))
+        response = self.client.get(reverse("timelogs-running"))
+        self.assertEqual([log["task"] for log in response.data], [2])
+
+        self.client.force_authenticate(user=self.user2)
+        response = self.client.get(reverse("timelogs-running"))
+        self.assertEqual(response.data, [])
+
+    def registry(self):
+        registry = FakeRegistry()
+        patcher = mock.patch("apps.tasks.timers.get_registry", return_value=registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        settings_override = self.settings(TIMER_REGISTRY_ACTIVE=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        return registry
+
+    def test_timer_registry_hit(self) -> None:
+        registry = self.registry()
+        running = TimeLog.objects.get(task=2, duration=None)
+        timers.store(running.id, 2, running.start_time, self.user.id)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(timers.running_time_log_id(2), running.id)
+        self.assertEqual([log["task"] for log in timers.user_running(self.user.id)], [2])
+        self.assertEqual(json.loads(registry.hget(timers.TASK_KEY, 2))["user"], self.user.id)
+
+    # Running logs missing from the registry are read from the database and registered again
+    def test_timer_registry_miss(self) -> None:
+        registry = self.registry()
+        running = TimeLog.objects.get(task=2, duration=None)
+
+        self.assertEqual(timers.running_time_log_id(2), running.id)
+        self.assertEqual(json.loads(registry.hget(timers.TASK_KEY, 2))["id"], running.id)
+        self.assertIsNone(timers.running_time_log_id(5))
+        self.assertIsNone(registry.hget(timers.TASK_KEY, 5))
+
+    def test_timer_registry_miss_stop_timer(self) -> None:
+        registry = self.registry()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(reverse("tasks-stop-timer", args=[2]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(TimeLog.objects.filter(task=2, duration=None).exists())
+        self.assertIsNone(registry.hget(timers.TASK_KEY, 2))
+
+    # An entry of a log stopped since is dropped instead of blocking the timer
+    def test_timer_registry_stale_entry(self) -> None:
+        registry = self.registry()
+        stopped = TimeLog.objects.create(
+            task_id=5, start_time=timezone.now() - timezone.timedelta(hours=2), duration=timezone.timedelta(hours=1)
+        )
+        timers.store(stopped.id, 5, stopped.start_time, self.user.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(reverse("tasks-stop-timer", args=[5]))
+        self.assertEqual(response.data["message"], "TimeLog is already stopped")
+        self.assertIsNone(registry.hget(timers.TASK_KEY, 5))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(reverse("tasks-start-timer", args=[5]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    # The database has the final say on starting a timer, an entry of a deleted log does not block it
+    def test_timer_registry_deleted_log(self) -> None:
+        registry = self.registry()
+        timers.store(9999, 5, timezone.now(), self.user.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(reverse("tasks-start-timer", args=[5]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        running = TimeLog.objects.get(task=5, duration=None)
+        self.assertEqual(json.loads(registry.hget(timers.TASK_KEY, 5))["id"], running.id)
+
+        response = self.client.patch(reverse("tasks-start-timer", args=[5]))
+        self.assertEqual(response.data["message"], "Task timer is already running")
+
+    # Running timers are read from the database while redis is unreachable
+    def test_timer_registry_unreachable(self) -> None:
+        registry = self.registry()
+        running = TimeLog.objects.get(task=2, duration=None)
+
+        with (
+            mock.patch.object(registry, "hget", side_effect=RedisConnectionError),
+            mock.patch.object(registry, "hvals", side_effect=RedisConnectionError),
+        ):
+            self.assertEqual(timers.running_time_log_id(2), running.id)
+            response = self.client.get(reverse("timelogs-running"))
+        self.assertEqual([log["id"] for log in response.data], [running.id])
+
+    # Entries lost or left behind are repaired periodically, not only at startup
+    def test_reconcile_running_timers(self) -> None:
+        registry = self.registry()
+        timers.store(9999, 5, timezone.now(), self.user.id)
+        running = TimeLog.objects.get(task=2, duration=None)
+
+        reconcile_running_timers()
+
+        self.assertIsNone(registry.hget(timers.TASK_KEY, 5))
+        self.assertEqual(json.loads(registry.hget(timers.TASK_KEY, 2))["id"], running.id)
+        self.assertEqual([log["id"] for log in timers.user_running(self.user.id)], [running.id])
+
     # Stop timer for task that does not belong to user
     def test_stop_timer_foreign(self) -> None:
         self.client.force_authenticate(user=self.user2)
@@ -458,6 +1223,30 @@ class TestTimeLog(APITestCase):
         response = self.client.patch(reverse("tasks-stop-timer", args=[9999]))
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    # Existing running duplicates and overlaps are cut before the constraints are added
+    def test_migration_closes_conflicting_logs(self) -> None:
+        migration = import_module("apps.tasks.migrations.0004_time_log_constraints")
+        task = Task.objects.create(title="Conflicts", description="Migrated logs", is_completed=False, user=self.user)
+        start = timezone.now().replace(microsecond=0) - datetime.timedelta(days=1)
+        hour = datetime.timedelta(hours=1)
+        logs = TimeLog.objects.bulk_create(
+            [
+                TimeLog(task=task, start_time=start, duration=2 * hour),
+                TimeLog(task=task, start_time=start + hour, duration=hour),
+                TimeLog(task=task, start_time=start + 3 * hour),
+                TimeLog(task=task, start_time=start + 4 * hour, duration=hour / 2),
+            ]
+        )
+
+        migration.close_conflicting_logs(django_apps, None)
+
+        durations = TimeLog.objects.filter(id__in=[log.id for log in logs]).order_by("start_time")
+        self.assertEqual(list(durations.values_list("duration", flat=True)), [hour, hour, hour, hour / 2])
+        task.refresh_from_db()
+        self.assertEqual(task.time_spent, 3.5 * hour)
+        rollups = TimeLogRollup.objects.filter(task=task).aggregate(total=Sum("total_duration"), count=Sum("log_count"))
+        self.assertEqual(rollups, {"total": 3.5 * hour, "count": 4})
+
     def test_create_time_log(self) -> None:
         task = Task.objects.get(id=1)
 
@@ -528,6 +1317,50 @@ class TestTimeLog(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
+    # A log may not cover the start of a later one either
+    def test_create_time_log_overlap_following(self) -> None:
+        response = self.client.post(
+            reverse("timelogs-list"),
+            {"task": 1, "start_time": "2024-10-09T13:30:00Z", "duration": timezone.timedelta(hours=1)},
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(response.data["message"], "TimeLog overlaps with another timeLog")
+
+        response = self.client.post(
+            reverse("timelogs-list"),
+            {"task": 1, "start_time": "2024-10-09T13:30:00Z", "duration": timezone.timedelta(minutes=30)},
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    # The overlap check does not depend on the number of logs of the task
+    def test_create_time_log_overlap_queries(self) -> None:
+        start_time = timezone.now() - timezone.timedelta(days=100)
+        TimeLog.objects.bulk_create(
+            TimeLog(
+                task_id=1, start_time=start_time + timezone.timedelta(hours=i), duration=timezone.timedelta(minutes=30)
+            )
+            for i in range(50)
+        )
+
+        time_log = TimeLog(task_id=1, start_time=start_time + timezone.timedelta(hours=20, minutes=10))
+        with self.assertNumQueries(2), self.assertRaises(TimeLogError):
+            time_log.check_overlap()
+
+        time_log.start_time += timezone.timedelta(minutes=30)
+        time_log.duration = timezone.timedelta(minutes=10)
+        with self.assertNumQueries(3):
+            time_log.check_overlap()
+
+    # A second running timer that gets past the check is rejected by the database
+    def test_start_timer_running_constraint(self) -> None:
+        self.client.patch(reverse("tasks-start-timer", args=[1]))
+
+        with mock.patch.object(TimeLog, "check_overlap"):
+            response = self.client.patch(reverse("tasks-start-timer", args=[1]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(response.data["message"], "Task timer is already running")
+        self.assertEqual(TimeLog.objects.filter(task=1, duration=None).count(), 1)
+
     # Task does not exist
     def test_create_time_log_no_task(self) -> None:
         response = self.client.post(
@@ -540,6 +1373,115 @@ class TestTimeLog(APITestCase):
         )
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_import_time_logs_csv(self) -> None:
+        body = (
+            "task,start_time,duration\n"
+            "5,2024-10-20T10:00:00Z,01:00:00\n"
+            "5,2024-10-20T09:00:00Z,01:00:00.900\n"
+            "5,2024-10-20T10:30:00Z,00:10:00\n"
+            "1,2024-10-09T14:10:00Z,00:10:00\n"
+            "1,2024-10-09T13:50:00Z,00:10:00\n"
+            "6,2024-10-20T10:00:00Z,00:10:00\n"
+            "9999,2024-10-20T10:00:00Z,00:10:00\n"
+            "5,not a date,0\n"
+        )
+        response = self.client.post(reverse("timelogs-import"), body, content_type="text/csv")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["created"], 3)
+        self.assertEqual(
+            [(error["line"], list(error["errors"])) for error in response.data["errors"]],
+            [(4, ["start_time"]), (5, ["start_time"]), (7, ["task"]), (8, ["task"]), (9, ["start_time", "duration"])],
+        )
+        self.assertEqual(response.data["errors"][3]["errors"]["task"], ["Task does not exist"])
+
+        # Whole seconds, and the stored totals follow
+        self.assertEqual(
+            list(TimeLog.objects.filter(task_id=5).order_by("start_time").values_list("duration", flat=True)),
+            [timezone.timedelta(hours=1), timezone.timedelta(hours=1)],
+        )
+        self.assertEqual(Task.objects.get(id=5).time_spent, timezone.timedelta(hours=2))
+        self.assertEqual(Task.objects.get(id=1).time_spent, timezone.timedelta(minutes=25))
+        self.assertEqual(
+            TimeLogRollup.objects.get(task_id=5, day=datetime.date(2024, 10, 20)).total_duration,
+            timezone.timedelta(hours=2),
+        )
+
+    def test_import_time_logs_ndjson(self) -> None:
+        body = (
+            '{"task": 5, "start_time": "2024-10-20T10:00:00Z", "duration": 600}\n'
+            "\n"
+            "[5]\n"
+            '{"task": 2, "start_time": "2024-10-20T10:00:00Z", "duration": "00:10:00"}\n'
+        )
+        response = self.client.post(reverse("timelogs-import"), body, content_type="application/x-ndjson")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["created"], 1)
+        # Task 2 has a running timer, which is open ended
+        self.assertEqual([error["line"] for error in response.data["errors"]], [3, 4])
+        self.assertEqual(TimeLog.objects.get(task_id=5).duration, timezone.timedelta(minutes=10))
+
+    def test_import_time_logs_queries(self) -> None:
+        def import_logs(task_id, count):
+            body = "task,start_time,duration\n" + "".join(
+                f"{task_id},2024-10-{day:02}T10:00:00Z,00:30:00\n" for day in range(1, count + 1)
+            )
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(reverse("timelogs-import"), body, content_type="text/csv")
+            self.assertEqual(response.data["created"], count)
+            return len(queries)
+
+        self.assertEqual(import_logs(5, 3), import_logs(4, 9))
+
+    def test_import_time_logs_invalid_body(self) -> None:
+        response = self.client.post(reverse("timelogs-import"), "task,start\n5,x\n", content_type="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(reverse("timelogs-import"), "[]", content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+        with self.settings(TIME_LOG_IMPORT_MAX_ROWS=1):
+            body = "task,start_time,duration\n5,2024-10-20T10:00:00Z,600\n5,2024-10-21T10:00:00Z,600\n"
+            response = self.client.post(reverse("timelogs-import"), body, content_type="text/csv")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(TimeLog.objects.filter(task_id=5).exists())
+
+    def test_export_time_logs_csv(self) -> None:
+        response = self.client.get(reverse("timelogs-export"))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertIn('filename="timelogs.csv"', response["Content-Disposition"])
+        rows = list(csv.DictReader(StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual([int(row["id"]) for row in rows], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(rows[0]["task_title"], Task.objects.get(id=1).title)
+        self.assertEqual(rows[0]["user"], "1")
+        self.assertEqual(rows[0]["duration"], "00:15:00")
+        self.assertEqual(rows[1]["duration"], "")
+
+    def test_export_time_logs_ndjson_filtered(self) -> None:
+        response = self.client.get(
+            reverse("timelogs-export"),
+            {"format": "ndjson", "from": "2024-10-11T09:15:00Z", "to": "2024-10-11T14:00:00Z", "user": 1},
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row["id"] for row in rows], [4, 5])
+        self.assertEqual(rows[0], TimeLogSerializer(TimeLog.objects.get(id=4)).data | rows[0])
+
+    def test_export_time_logs_invalid_filters(self) -> None:
+        response = self.client.get(
+            reverse("timelogs-export"), {"from": "2024-10-12T00:00:00Z", "to": "2024-10-11T00:00:00Z"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn(b"Must be after from", response.content)
+
+        response = self.client.get(reverse("timelogs-export"), {"format": "xlsx"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_get_time_logs(self) -> None:
         task = Task.objects.get(id=1)
 
@@ -547,6 +1489,13 @@ class TestTimeLog(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), task.timelog_set.count())
 
+    def test_get_time_logs_stream(self) -> None:
+        url = reverse("tasks-timer-logs", args=[3])
+        response = self.client.get(url, {"stream": "true"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(b"".join(response.streaming_content)), self.client.get(url).data)
+
     # Get timelogs for task that does not have any timelogs
     def test_get_time_logs_no_logs(self) -> None:
         task = Task.objects.get(id=8)
@@ -567,6 +1516,100 @@ class TestTimeLog(APITestCase):
         response = self.client.get(reverse("tasks-timer-logs", args=[9999]))
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    # A task that does not exist has no ETag to match
+    def test_get_time_logs_no_task_conditional(self) -> None:
+        response = self.client.get(reverse("tasks-timer-logs", args=[9999]), HTTP_IF_NONE_MATCH="*")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertNotIn("ETag", response)
+
+    # Whether the task exists is cached, deleted tasks are answered 404 without reading it
+    def test_get_time_logs_deleted_task_conditional(self) -> None:
+        etag = self.client.get(reverse("tasks-timer-logs", args=[1]))["ETag"]
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse("tasks-timer-logs", args=[1]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Task.objects.get(id=1).delete()
+        response = self.client.get(reverse("tasks-timer-logs", args=[1]), HTTP_IF_NONE_MATCH="*")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_time_logs_not_modified(self) -> None:
+        etag = self.client.get(reverse("tasks-timer-logs", args=[1]))["ETag"]
+        list_etag = self.client.get(reverse("tasks-list"))["ETag"]
+
+        response = self.client.get(reverse("tasks-timer-logs", args=[1]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.client.post(
+            reverse("timelogs-list"),
+            {"task": 1, "start_time": timezone.now() - timezone.timedelta(hours=1), "duration": "00:30:00"},
+        )
+        response = self.client.get(reverse("tasks-timer-logs", args=[1]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # The listing shows the changed time spent
+        response = self.client.get(reverse("tasks-list"), HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    # Stored time spent follows time log creation, edits and deletion
+    def test_time_spent_maintained(self) -> None:
+        task = Task.objects.get(id=8)
+        self.assertIsNone(task.time_spent)
+
+        time_log = TimeLog.objects.create(
+            task=task, start_time=timezone.now() - timezone.timedelta(hours=3), duration=timezone.timedelta(hours=1)
+        )
+        task.refresh_from_db()
+        self.assertEqual(task.time_spent, timezone.timedelta(hours=1))
+
+        time_log.duration = timezone.timedelta(minutes=20)
+        time_log.save()
+        task.refresh_from_db()
+        self.assertEqual(task.time_spent, timezone.timedelta(minutes=20))
+
+        time_log.delete()
+        task.refresh_from_db()
+        self.assertIsNone(task.time_spent)
+
+    # Stopping a timer adds its duration
+    def test_time_spent_stop_timer(self) -> None:
+        task = Task.objects.get(id=5)
+        TimeLog.objects.create(task=task, start_time=timezone.now() - timezone.timedelta(hours=1))
+
+        self.client.patch(reverse("tasks-stop-timer", args=[task.id]))
+        task.refresh_from_db()
+        self.assertGreaterEqual(task.time_spent, timezone.timedelta(hours=1))
+
+    # Bulk deletion of time logs recomputes the affected tasks
+    def test_time_spent_bulk_delete(self) -> None:
+        TimeLog.objects.filter(task__in=[3, 4]).delete()
+        self.assertEqual(list(Task.objects.filter(id__in=[3, 4]).values_list("time_spent", flat=True)), [None, None])
+        self.assertEqual(Task.objects.get(id=1).time_spent, timezone.timedelta(minutes=15))
+
+    def test_reconcile_time_spent(self) -> None:
+        Task.objects.filter(id=3).update(time_spent=timezone.timedelta(hours=5))
+        Task.objects.filter(id=8).update(time_spent=timezone.timedelta(hours=1))
+
+        call_command("reconcile-time-spent", stdout=StringIO())
+
+        self.assertEqual(Task.objects.get(id=3).time_spent, timezone.timedelta(minutes=45))
+        self.assertIsNone(Task.objects.get(id=8).time_spent)
+
+    def test_benchmark_queries(self) -> None:
+        users, tasks, time_logs = User.objects.count(), Task.objects.count(), TimeLog.objects.count()
+        out = StringIO()
+
+        call_command("benchmark-queries", users=2, tasks=3, logs=5, repeat=1, compare=True, plans=True, stdout=out)
+
+        self.assertIn("without indexes", out.getvalue())
+        self.assertIn("overlap check", out.getvalue())
+        # The generated data and the dropped indexes are rolled back
+        self.assertEqual(
+            (User.objects.count(), Task.objects.count(), TimeLog.objects.count()), (users, tasks, time_logs)
+        )
+        with connection.cursor() as cursor:
+            self.assertIn("time_log_task_start", connection.introspection.get_constraints(cursor, "tasks_timelog"))
+
     def test_get_time_logs_month(self) -> None:
         response = self.client.get(reverse("timelogs-last-month"))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -575,6 +1618,78 @@ class TestTimeLog(APITestCase):
             response.data["month_time_spent"].total_seconds(), timezone.timedelta(hours=2, minutes=30).total_seconds()
         )
 
+    # Both partial days at the edges of the window are read from the logs
+    def test_get_time_logs_month_partial_days(self) -> None:
+        now = timezone.now()
+        TimeLog.objects.create(
+            task_id=1, start_time=now - timezone.timedelta(days=30, hours=1), duration=timezone.timedelta(hours=1)
+        )
+        TimeLog.objects.create(
+            task_id=1,
+            start_time=now - timezone.timedelta(days=30) + timezone.timedelta(minutes=1),
+            duration=timezone.timedelta(minutes=10),
+        )
+        TimeLog.objects.create(
+            task_id=5, start_time=now - timezone.timedelta(minutes=5), duration=timezone.timedelta(minutes=5)
+        )
+
+        response = self.client.get(reverse("timelogs-last-month"))
+        self.assertEqual(response.data["month_time_spent"], timezone.timedelta(hours=2, minutes=45))
+
+    def test_time_log_rollups_maintained(self) -> None:
+        start_time = timezone.now() - timezone.timedelta(days=3)
+        time_log = TimeLog.objects.create(task_id=1, start_time=start_time)
+        self.assertFalse(TimeLogRollup.objects.filter(task=1, day=timezone.localdate(start_time)).exists())
+
+        time_log.duration = timezone.timedelta(minutes=20)
+        time_log.save()
+        TimeLog.objects.create(
+            task_id=1, start_time=start_time + timezone.timedelta(hours=1), duration=timezone.timedelta(minutes=40)
+        )
+        rollup = TimeLogRollup.objects.get(task=1, day=timezone.localdate(start_time))
+        self.assertEqual(
+            (rollup.user_id, rollup.total_duration, rollup.log_count, rollup.max_duration),
+            (self.user.id, timezone.timedelta(hours=1), 2, timezone.timedelta(minutes=40)),
+        )
+
+        time_log.delete()
+        rollup.refresh_from_db()
+        self.assertEqual((rollup.total_duration, rollup.log_count), (timezone.timedelta(minutes=40), 1))
+
+        TimeLog.objects.filter(task=1).delete()
+        self.assertFalse(TimeLogRollup.objects.filter(task=1).exists())
+
+    def test_time_log_rollup_refresh_missing_row(self) -> None:
+        rollup = TimeLogRollup.objects.get(task=4)
+        expected = (rollup.user_id, rollup.total_duration, rollup.log_count, rollup.max_duration)
+        rollup.delete()
+
+        # The row is inserted before it is locked and filled in
+        TimeLogRollup.refresh(4, rollup.day)
+        rollup = TimeLogRollup.objects.get(task=4)
+        self.assertEqual((rollup.user_id, rollup.total_duration, rollup.log_count, rollup.max_duration), expected)
+
+        # No row is left behind for a day without logs
+        TimeLogRollup.refresh(4, rollup.day - datetime.timedelta(days=1))
+        self.assertEqual(TimeLogRollup.objects.filter(task=4).count(), 1)
+
+    def test_time_log_rollups_follow_assign(self) -> None:
+        Task.objects.get(id=4).assign_user(self.user2)
+        self.assertEqual(TimeLogRollup.objects.get(task=4).user, self.user2)
+
+        self.client.force_authenticate(user=self.user2)
+        response = self.client.get(reverse("timelogs-last-month"))
+        self.assertEqual(response.data["month_time_spent"], timezone.timedelta(hours=1, minutes=30))
+
+    def test_rebuild_time_log_rollups(self) -> None:
+        fields = ("user", "task", "day", "total_duration", "log_count", "max_duration")
+        expected = list(TimeLogRollup.objects.order_by("task", "day").values(*fields))
+        TimeLogRollup.objects.all().delete()
+
+        call_command("rebuild-time-log-rollups", stdout=StringIO())
+
+        self.assertEqual(list(TimeLogRollup.objects.order_by("task", "day").values(*fields)), expected)
+
     def test_get_top_logs(self) -> None:
         response = self.client.get(reverse("timelogs-top"), {"limit": 2})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -612,6 +1727,48 @@ class TestTimeLog(APITestCase):
         self.assertEqual(response2.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response2.data), 5)
 
+    def test_get_top_logs_cache_limits(self) -> None:
+        response = self.client.get(reverse("timelogs-top"))
+
+        with self.assertNumQueries(0):
+            limited = self.client.get(reverse("timelogs-top"), {"limit": 2})
+            larger = self.client.get(reverse("timelogs-top"), {"limit": 100})
+        self.assertEqual(limited.data, response.data[:2])
+        self.assertEqual(larger.data, response.data)
+
+    # Limits beyond the cached top logs are rejected instead of scanning the whole window
+    def test_get_top_logs_invalid_limit(self) -> None:
+        for limit in [0, 101, "many"]:
+            response = self.client.get(reverse("timelogs-top"), {"limit": limit})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, limit)
+            self.assertIn("limit", response.data)
+
+    # Time log writes of the user replace the cached top logs
+    def test_get_top_logs_cache_invalidated(self) -> None:
+        self.client.get(reverse("timelogs-top"))
+
+        self.client.post(
+            reverse("timelogs-list"),
+            {"task": 1, "start_time": timezone.now() - timezone.timedelta(days=2), "duration": "05:00:00"},
+        )
+        response = self.client.get(reverse("timelogs-top"))
+        self.assertEqual(len(response.data), 6)
+        self.assertEqual(response.data[0]["duration"], "05:00:00")
+
+        TimeLog.objects.get(id=response.data[0]["id"]).delete()
+        response = self.client.get(reverse("timelogs-top"))
+        self.assertEqual(len(response.data), 5)
+
+    # Requests that find another process refreshing the entry do not recompute it
+    def test_get_top_logs_cache_single_flight(self) -> None:
+        self.client.get(reverse("timelogs-top"))
+
+        with mock.patch("apps.common.cache.expires_early", return_value=True):
+            cache.add(f"tasks:top-logs:user:{self.user.id}:{user_version(self.user.id)}:lock", True)
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse("timelogs-top"))
+        self.assertEqual(len(response.data), 5)
+
 
 class TestMinIO(APITestCase):
     fixtures = ["fixtures/users", "fixtures/tasks"]
@@ -621,6 +1778,8 @@ class TestMinIO(APITestCase):
         self.photos = ["Duck_" + str(i) + ".png" for i in range(1, 10)]
 
         logging.disable(logging.CRITICAL)
+        cache.clear()
+
         self.client = APIClient()
         self.user = User.objects.get(pk=1)
         self.tasks = TaskSerializer(Task.objects.all(), many=True).data
@@ -657,6 +1816,19 @@ class TestMinIO(APITestCase):
         self.assertGreaterEqual(len(response.data), 1)
         self.assertIn(self.photos[1].split(".")[0], response.data[0]["file"])
 
+    def test_get_attachments_stream(self):
+        task = Task.objects.first()
+        for photo in self.photos[:3]:
+            TaskAttachment.objects.create(
+                task=task, file=SimpleUploadedFile(photo, b"file_content", content_type="image/png")
+            )
+
+        url = reverse("tasks-attachments", args=[task.id])
+        response = self.client.get(url, {"stream": "true"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(b"".join(response.streaming_content)), self.client.get(url).data)
+
     def test_get_attachment_not_exist(self):
         response = self.client.get(reverse("tasks-attachments", args=[999]))
 
@@ -676,6 +1848,8 @@ class TestElasticSearch(APITestCase):
     def setUp(self) -> None:
         logging.disable(logging.CRITICAL)
 
+        cache.clear()
+
         self.client = APIClient()
         user1 = User.objects.get(pk=1)
         self.client.force_authenticate(user=user1)
@@ -717,6 +1891,66 @@ class TestElasticSearch(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertGreaterEqual(len(response.data), 1)
 
+    def test_task_search_invalid_params(self):
+        response = self.client.get(
+            reverse("elasticsearch-task"),
+            {"title": "Test task", "cursor": "not a cursor", "fields": "title,secret", "total": "some", "limit": 0},
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data), {"cursor", "fields", "total", "limit"})
+        self.assertEqual(response.data["fields"], ["Unknown fields: secret"])
+
+    def test_task_search_invalid_cursor(self):
+        for sort in [["x"], [1.5, 2, 3], ["x", 2], [1.5, "2"], [1.5, 2.5], [True, 2]]:
+            cursor = TaskDocumentSearchSerializer.encode_cursor(sort)
+            response = self.client.get(reverse("elasticsearch-task"), {"cursor": cursor})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, sort)
+            self.assertEqual(response.data["cursor"], ["Invalid cursor"])
+
+        # Blank parameters are left out
+        serializer = TaskDocumentSearchSerializer(
+            data=QueryDict("title=week&cursor=&fields=&exclude=&limit=&total=&comment-body=")
+        )
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        self.assertEqual(serializer.validated_data, {"title": "week", "limit": 20, "total": "exact", "comments": "all"})
+
+        serializer = TaskDocumentSearchSerializer(data={"cursor": TaskDocumentSearchSerializer.encode_cursor([1.5, 2])})
+        self.assertTrue(serializer.is_valid())
+        self.assertEqual(serializer.validated_data["cursor"], [1.5, 2])
+
+    @skipUnless(ELASTICSEARCH_ACTIVE, "ElasticSearch is not active")
+    def test_task_search_cursor(self):
+        response = self.client.get(reverse("elasticsearch-task"), {"description": "week", "limit": 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["X-Total-Relation"], "eq")
+        self.assertGreaterEqual(int(response["X-Total-Count"]), 2)
+        next_page = response["Link"].split(";")[0].strip("<>")
+
+        response_next = self.client.get(next_page)
+        self.assertEqual(response_next.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response_next.data), 1)
+        self.assertNotEqual(response_next.data[0]["id"], response.data[0]["id"])
+
+    @skipUnless(ELASTICSEARCH_ACTIVE, "ElasticSearch is not active")
+    def test_task_search_projection(self):
+        response = self.client.get(
+            reverse("elasticsearch-task"), {"description": "week", "fields": "id,title", "total": "none"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({key for hit in response.data for key in hit}, {"id", "title"})
+        self.assertNotIn("X-Total-Count", response)
+
+    @skipUnless(ELASTICSEARCH_ACTIVE, "ElasticSearch is not active")
+    def test_task_search_matching_comments(self):
+        response = self.client.get(
+            reverse("elasticsearch-task"), {"comment-body": "Test comment", "comments": "matching", "total": "capped"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreaterEqual(len(response.data), 1)
+        for hit in response.data:
+            self.assertTrue(hit["comments"])
+            self.assertTrue(all("comment" in comment["body"].lower() for comment in hit["comments"]))
+
     @skipUnless(ELASTICSEARCH_ACTIVE, "ElasticSearch is not active")
     def test_task_update_task(self):
         response = self.client.get(reverse("elasticsearch-task"), {"title": "cat"})
@@ -725,7 +1959,8 @@ class TestElasticSearch(APITestCase):
 
         task_instance = Task.objects.first()
         task_instance.title += " test cat"
-        task_instance.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            task_instance.save()
 
         response = self.client.get(reverse("elasticsearch-task"), {"title": "cat"})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -739,8 +1974,251 @@ class TestElasticSearch(APITestCase):
 
         comment_instance = Comment.objects.first()
         comment_instance.body = "test spider"
-        comment_instance.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            comment_instance.save()
 
         response = self.client.get(reverse("elasticsearch-task"), {"comment-body": "spider"})
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertLessEqual(len(response.data), 1)
+
+    # Changes are indexed by one Celery task per window instead of during the request
+    def test_index_changes_in_background(self):
+        processor = TaskSignalProcessor(None)
+        self.addCleanup(processor.teardown)
+
+        with self.settings(ELASTICSEARCH_ACTIVE=True):
+            with (
+                mock.patch("apps.tasks.tasks.sync_task_documents.apply_async") as apply_async,
+                mock.patch("apps.tasks.tasks.sync_task_comments.delay") as delay,
+            ):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.client.patch(reverse("tasks-complete-task", args=[1]))
+                    # Built with the scheduled document of the task
+                    response = self.client.post(reverse("comments-list"), {"body": "Test comment", "task": 1})
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.client.patch(reverse("tasks-bulk-complete"), {"ids": [1, 3, 4]}, format="json")
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            apply_async.call_args_list,
+            [
+                mock.call(([1],), countdown=settings.ELASTICSEARCH_INDEX_WINDOW),
+                mock.call(([3, 4],), countdown=settings.ELASTICSEARCH_INDEX_WINDOW),
+            ],
+        )
+        self.assertFalse(delay.called)
+
+    # A failed publish leaves no pending key behind, the next change schedules the task again
+    def test_index_changes_broker_down(self):
+        processor = TaskSignalProcessor(None)
+        self.addCleanup(processor.teardown)
+
+        with self.settings(ELASTICSEARCH_ACTIVE=True):
+            with mock.patch("apps.tasks.tasks.sync_task_documents.apply_async") as apply_async:
+                apply_async.side_effect = [ConnectionError, None]
+                with self.captureOnCommitCallbacks(execute=True):
+                    response = self.client.patch(reverse("tasks-complete-task", args=[1]))
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertIsNone(cache.get("tasks:search:pending:1"))
+
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.client.patch(reverse("tasks-undo-task", args=[1]))
+
+        self.assertEqual(apply_async.call_count, 2)
+        self.assertTrue(cache.get("tasks:search:pending:1"))
+
+    # A comment is written into the document of its task by a script, without the other comments
+    def test_index_comment_changes(self):
+        processor = TaskSignalProcessor(None)
+        self.addCleanup(processor.teardown)
+
+        with self.settings(ELASTICSEARCH_ACTIVE=True):
+            with (
+                mock.patch("apps.tasks.tasks.sync_task_documents.apply_async") as apply_async,
+                mock.patch("apps.tasks.tasks.sync_task_comments.delay") as delay,
+            ):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.client.post(reverse("comments-list"), {"body": "Test comment", "task": 1})
+                comment_id = Comment.objects.latest("id").id
+                with self.captureOnCommitCallbacks(execute=True):
+                    Comment.objects.get(id=comment_id).delete()
+
+        self.assertFalse(apply_async.called)
+        self.assertEqual(delay.call_args_list, [mock.call(1, [comment_id])] * 2)
+
+    # A moved comment is removed from the document of its previous task, deleted tasks take their comments along
+    def test_index_comment_moved(self):
+        processor = TaskSignalProcessor(None)
+        self.addCleanup(processor.teardown)
+        comment = Comment.objects.create(body="Test comment", task_id=1, user_id=1)
+
+        with self.settings(ELASTICSEARCH_ACTIVE=True):
+            with (
+                mock.patch("apps.tasks.tasks.sync_task_documents.apply_async") as apply_async,
+                mock.patch("apps.tasks.tasks.sync_task_comments.delay") as delay,
+            ):
+                with self.captureOnCommitCallbacks(execute=True):
+                    comment.task_id = 3
+                    comment.save()
+                self.assertEqual(delay.call_args_list, [mock.call(3, [comment.id]), mock.call(1, [comment.id])])
+
+                delay.reset_mock()
+                with self.captureOnCommitCallbacks(execute=True):
+                    Task.objects.get(id=3).delete()
+
+        self.assertFalse(delay.called)
+        apply_async.assert_called_once_with(([3],), countdown=settings.ELASTICSEARCH_INDEX_WINDOW)
+
+    def test_sync_task_comments(self):
+        comment = Comment.objects.filter(task=1).first()
+        with mock.patch.object(TaskDocument, "_get_connection") as get_connection:
+            sync_task_comments(1, [comment.id, 9999])
+
+        _, kwargs = get_connection.return_value.update.call_args
+        self.assertEqual((kwargs["index"], kwargs["id"]), ("tasks", 1))
+        self.assertEqual(
+            kwargs["script"]["params"],
+            {"ids": [comment.id, 9999], "comments": [{"id": comment.id, "body": comment.body}]},
+        )
+
+    def test_sync_task_comments_not_indexed(self):
+        comment = Comment.objects.filter(task=1).first()
+        with (
+            mock.patch.object(TaskDocument, "_get_connection") as get_connection,
+            mock.patch.object(TaskDocument, "update") as update,
+        ):
+            get_connection.return_value.update.side_effect = NotFoundError("not found", mock.Mock(), {})
+            sync_task_comments(1, [comment.id])
+
+        # The whole document is indexed instead
+        (indexed,), _ = update.call_args
+        self.assertEqual([task.id for task in indexed], [1])
+
+    def test_sync_task_comments_without_ids(self):
+        comment = Comment.objects.filter(task=1).first()
+        with (
+            mock.patch.object(TaskDocument, "_get_connection") as get_connection,
+            mock.patch.object(TaskDocument, "update") as update,
+        ):
+            get_connection.return_value.update.return_value = {"result": "noop"}
+            sync_task_comments(1, [comment.id])
+
+        # The comments of the document are rebuilt from the database
+        (indexed,), _ = update.call_args
+        self.assertEqual([task.id for task in indexed], [1])
+
+    # Only a new email is written to the documents of a user, by one update_by_query
+    def test_index_user_email_changes(self):
+        processor = TaskSignalProcessor(None)
+        self.addCleanup(processor.teardown)
+        user = User.objects.get(pk=1)
+
+        with self.settings(ELASTICSEARCH_ACTIVE=True):
+            with (
+                mock.patch("apps.tasks.tasks.sync_user_documents.delay") as delay,
+                mock.patch("apps.tasks.tasks.sync_task_documents.apply_async") as apply_async,
+            ):
+                with self.captureOnCommitCallbacks(execute=True):
+                    user.last_login = timezone.now()
+                    user.save(update_fields=["last_login"])
+                    user.first_name = "Renamed"
+                    user.save()
+                self.assertFalse(delay.called)
+
+                with self.captureOnCommitCallbacks(execute=True):
+                    user.email = "renamed@example.com"
+                    user.save()
+        delay.assert_called_once_with(1)
+        self.assertFalse(apply_async.called)
+
+    def test_sync_user_documents(self):
+        with mock.patch.object(TaskDocument, "_get_connection") as get_connection:
+            get_connection.return_value.update_by_query.return_value = {"updated": 3}
+            sync_user_documents(1)
+
+        _, kwargs = get_connection.return_value.update_by_query.call_args
+        self.assertEqual(kwargs["index"], "tasks")
+        self.assertEqual(kwargs["query"], {"term": {"user.id": 1}})
+        self.assertEqual(kwargs["script"]["params"], {"email": User.objects.get(pk=1).email})
+
+    def test_sync_task_documents(self):
+        cache.set("tasks:search:pending:1", True)
+        Task.objects.filter(id=2).delete()
+
+        with mock.patch.object(TaskDocument, "update") as update:
+            sync_task_documents([1, 2])
+
+        self.assertIsNone(cache.get("tasks:search:pending:1"))
+        (indexed,), _ = update.call_args_list[0]
+        self.assertEqual([task.id for task in indexed], [1])
+        (deleted,), kwargs = update.call_args_list[1]
+        self.assertEqual(([task.id for task in deleted], kwargs), ([2], {"action": "delete", "raise_on_error": False}))
+
+    # The documents are indexed once Elasticsearch is reachable again
+    def test_sync_task_documents_retry(self):
+        celery_app.conf.update(task_always_eager=True)
+        with mock.patch.object(
+            TaskDocument, "update", side_effect=[TransportError("Connection refused"), None]
+        ) as update:
+            sync_task_documents.delay([1])
+
+        self.assertEqual(update.call_count, 2)
+        (indexed,), _ = update.call_args
+        self.assertEqual([task.id for task in indexed], [1])
+
+    def test_sync_task_documents_during_reindex(self):
+        cache.set("tasks:search:reindex-target", "tasks-new")
+        Task.objects.filter(id=2).delete()
+
+        with mock.patch.object(TaskDocument, "update"), mock.patch.object(TaskDocument, "bulk") as bulk:
+            sync_task_documents([1, 2])
+
+        indexed, deleted = [list(actions) for (actions,), _ in bulk.call_args_list]
+        self.assertEqual(
+            [(action["_index"], action["_id"], action["_op_type"]) for action in indexed], [("tasks-new", 1, "index")]
+        )
+        self.assertEqual(
+            [(action["_index"], action["_id"], action["_op_type"]) for action in deleted], [("tasks-new", 2, "delete")]
+        )
+        self.assertEqual(reindex_changes("tasks-new"), {1, 2})
+
+    # Documents of tasks changed during the load are built again, the load may have streamed older versions
+    def test_reindex_tasks_resync(self):
+        cache.set("tasks:search:reindex-target", "tasks-new")
+        with mock.patch.object(TaskDocument, "_get_connection"):
+            sync_user_documents(2)
+        Task.objects.filter(id=2).delete()
+        with mock.patch.object(TaskDocument, "update"), mock.patch.object(TaskDocument, "bulk"):
+            sync_task_documents([2])
+
+        command = import_module("apps.tasks.management.commands.reindex-tasks").Command
+        with mock.patch.object(TaskDocument, "bulk", return_value=(1, [])) as bulk:
+            removed = command.resync(TaskDocument(), "tasks-new")
+
+        user_task_ids = set(Task.objects.filter(user_id=2).values_list("id", flat=True))
+        indexed, deleted = [list(actions) for (actions,), _ in bulk.call_args_list]
+        self.assertEqual({action["_id"] for action in indexed}, user_task_ids)
+        self.assertEqual({action["_index"] for action in indexed + deleted}, {"tasks-new"})
+        self.assertEqual([(action["_id"], action["_op_type"]) for action in deleted], [(2, "delete")])
+        self.assertEqual(removed, 1)
+        self.assertEqual(reindex_changes("tasks"), set())
+
+    @skipUnless(ELASTICSEARCH_ACTIVE, "ElasticSearch is not active")
+    def test_reindex_tasks(self):
+        call_command("reindex-tasks", stdout=StringIO())
+        client = TaskDocument._get_connection()
+        (first,) = client.indices.get_alias(name="tasks")
+
+        out = StringIO()
+        call_command("reindex-tasks", "--workers", "2", stdout=out)
+        (second,) = client.indices.get_alias(name="tasks")
+        self.assertNotEqual(first, second)
+        self.assertFalse(client.indices.exists(index=first))
+        self.assertIn(f"Indexed {Task.objects.count()} tasks", out.getvalue())
+
+        response = self.client.get(reverse("elasticsearch-task"), {"description": "week"})
+        self.assertGreaterEqual(len(response.data), 2)
+
+        out = StringIO()
+        call_command("reindex-tasks", "--if-missing", stdout=out)
+        self.assertIn("already exists", out.getvalue())
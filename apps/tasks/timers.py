@@ -0,0 +1,156 @@
+"""
+Registry of the running timers, i.e. the time logs without a duration.
+
+With redis as the cache backend every running log is kept in a hash by task and in a hash per user
+of the task owner, so starting, stopping and listing timers does not touch the time logs table.
+The hashes are written once the time log write is committed and rebuilt from the database by the
+`reconcile-running-timers` command at startup and periodically by the `reconcile_running_timers` task.
+A task missing from the registry, e.g. after a lost write, an eviction or a flush, is looked up in the
+database and registered again. Without redis, or while it is unreachable, every lookup reads the running
+logs through the partial unique index on (task) WHERE duration IS NULL.
+"""
+
+import json
+
+from django.conf import settings
+from django.db import transaction
+from redis.exceptions import RedisError
+from rest_framework import serializers
+
+TASK_KEY = "tasks:timers:task"
+USER_KEY = "tasks:timers:user:{}"
+USER_KEY_PATTERN = "tasks:timers:user:*"
+
+start_time_field = serializers.DateTimeField()
+
+
+def get_registry():
+    from django_redis import get_redis_connection
+
+    return get_redis_connection("default")
+
+
+def entry(time_log_id, task_id, start_time, user_id) -> dict:
+    """Running log in the shape of TimeLogSerializer, plus the owner of its task"""
+    return {
+        "id": time_log_id,
+        "task": task_id,
+        "start_time": start_time_field.to_representation(start_time),
+        "duration": None,
+        "user": user_id,
+    }
+
+
+def store(time_log_id, task_id, start_time, user_id):
+    value = json.dumps(entry(time_log_id, task_id, start_time, user_id))
+    pipeline = get_registry().pipeline()
+    pipeline.hset(TASK_KEY, task_id, value)
+    pipeline.hset(USER_KEY.format(user_id), task_id, value)
+    pipeline.execute()
+
+
+def register(time_log, user_id):
+    if not settings.TIMER_REGISTRY_ACTIVE:
+        return
+    transaction.on_commit(lambda: store(time_log.id, time_log.task_id, time_log.start_time, user_id))
+
+
+def unregister(task_id, user_id):
+    if not settings.TIMER_REGISTRY_ACTIVE:
+        return
+
+    def write():
+        pipeline = get_registry().pipeline()
+        pipeline.hdel(TASK_KEY, task_id)
+        pipeline.hdel(USER_KEY.format(user_id), task_id)
+        pipeline.execute()
+
+    transaction.on_commit(write)
+
+
+def move(task_id, user_id):
+    """Move the running timer of a task, if any, to the hash of its new owner"""
+    if not settings.TIMER_REGISTRY_ACTIVE:
+        return
+
+    def write():
+        registry = get_registry()
+        value = registry.hget(TASK_KEY, task_id)
+        if value is None:
+            return
+        running = json.loads(value)
+        if running["user"] == user_id:
+            return
+        previous_user_id, running["user"] = running["user"], user_id
+        value = json.dumps(running)
+        pipeline = registry.pipeline()
+        pipeline.hdel(USER_KEY.format(previous_user_id), task_id)
+        pipeline.hset(TASK_KEY, task_id, value)
+        pipeline.hset(USER_KEY.format(user_id), task_id, value)
+        pipeline.execute()
+
+    transaction.on_commit(write)
+
+
+def running_time_log_id(task_id):
+    """Id of the running time log of a task, or None"""
+    registry_active = settings.TIMER_REGISTRY_ACTIVE
+    if registry_active:
+        try:
+            value = get_registry().hget(TASK_KEY, task_id)
+        except RedisError:
+            value, registry_active = None, False
+        if value is not None:
+            return json.loads(value)["id"]
+
+    from apps.tasks.models import TimeLog
+
+    running = (
+        TimeLog.objects.filter(task_id=task_id, duration=None).values_list("id", "start_time", "task__user_id").first()
+    )
+    if running is None:
+        return None
+    time_log_id, start_time, user_id = running
+    if registry_active:
+        # Missing from the registry, the database has the final say
+        store(time_log_id, task_id, start_time, user_id)
+    return time_log_id
+
+
+def user_running(user_id) -> list[dict]:
+    """Running time logs of the tasks of a user"""
+    running = None
+    if settings.TIMER_REGISTRY_ACTIVE:
+        try:
+            running = [json.loads(value) for value in get_registry().hvals(USER_KEY.format(user_id))]
+        except RedisError:
+            pass
+    if running is None:
+        from apps.tasks.models import TimeLog
+
+        logs = TimeLog.objects.filter(task__user=user_id, duration=None).values_list("id", "task_id", "start_time")
+        running = [entry(*log, user_id) for log in logs]
+
+    for log in running:
+        del log["user"]
+    return sorted(running, key=lambda log: log["id"])
+
+
+def reconcile() -> int:
+    """Replace the registry by the running time logs in the database"""
+    from apps.tasks.models import TimeLog
+
+    registry = get_registry()
+    logs = TimeLog.objects.filter(duration=None).values_list("id", "task_id", "start_time", "task__user_id")
+
+    pipeline = registry.pipeline()
+    pipeline.delete(TASK_KEY, *registry.scan_iter(USER_KEY_PATTERN))
+    running = 0
+    for time_log_id, task_id, start_time, user_id in logs.iterator(chunk_size=settings.STREAMING_CHUNK_SIZE):
+        value = json.dumps(entry(time_log_id, task_id, start_time, user_id))
+        pipeline.hset(TASK_KEY, task_id, value)
+        pipeline.hset(USER_KEY.format(user_id), task_id, value)
+        running += 1
+    # MULTI/EXEC, readers never see the registry half rebuilt
+    pipeline.execute()
+    return running
@@ -0,0 +1,139 @@
+"""
+Version stamps of the data behind the task endpoints.
+
+Every user and every task has a stamp in the default cache that is moved forward whenever
+something rendered under it is written. Responses derive their ETag from the stamps only, so a
+conditional GET is answered without reading any rows. No Last-Modified is sent: its whole seconds
+cannot tell apart two states stamped within the same second, an If-Modified-Since request would get
+a 304 for a write made in the second of the cached response.
+
+Stamps are nanosecond timestamps rather than counters: an evicted stamp is recreated with the
+current time and can never collide with a value a client has already seen. The cache must be
+shared by all web processes (redis), a per-process locmem cache would hand out 304s for
+changes made in another process.
+"""
+
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from rest_framework.response import Response
+
+VERSION_TIMEOUT = 60 * 60 * 24 * 7
+
+USER_VERSION_KEY = "tasks:version:user:{}"
+TASK_VERSION_KEY = "tasks:version:task:{}"
+# Whether the task exists, so a conditional GET of a deleted task is answered 404 without a query
+TASK_EXISTS_KEY = "tasks:exists:task:{}"
+# Moved forward only by changes to the watchers of a task, not by every write to it
+WATCHERS_VERSION_KEY = "tasks:version:watchers:{}"
+RESPONSE_KEY = "tasks:response:user:{}:{}:{}"
+
+
+def _get_version(key) -> int:
+    version = cache.get(key)
+    if version is None:
+        version = time.time_ns()
+        if not cache.add(key, version, timeout=VERSION_TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+
+def _bump(keys):
+    keys = list(keys)
+    if not keys:
+        return
+
+    def bump():
+        now = time.time_ns()
+        cache.set_many({key: now for key in keys}, timeout=VERSION_TIMEOUT)
+
+    # Bump right away so that readers stop answering 304 for the old state, and again once the write
+    # is committed so a response rendered from the still uncommitted data is not kept under the new stamp
+    bump()
+    transaction.on_commit(bump)
+
+
+def user_version(user_id) -> int:
+    return _get_version(USER_VERSION_KEY.format(user_id))
+
+
+def task_version(task_id) -> int:
+    return _get_version(TASK_VERSION_KEY.format(task_id))
+
+
+def watchers_version(task_id) -> int:
+    return _get_version(WATCHERS_VERSION_KEY.format(task_id))
+
+
+def bump_user_versions(*user_ids):
+    _bump(USER_VERSION_KEY.format(user_id) for user_id in set(user_ids) if user_id is not None)
+
+
+def bump_task_versions(*task_ids):
+    _bump(TASK_VERSION_KEY.format(task_id) for task_id in set(task_ids) if task_id is not None)
+
+
+def task_exists(task_id, lookup) -> bool:
+    """Whether a task exists, read from the database with `lookup()` only when it is not cached"""
+    key = TASK_EXISTS_KEY.format(task_id)
+    exists = cache.get(key)
+    if exists is None:
+        exists = lookup()
+        # Not replacing a value set by a create or delete committed since the lookup
+        cache.add(key, exists, timeout=VERSION_TIMEOUT)
+    return exists
+
+
+def set_tasks_exist(task_ids, exists):
+    """Record the created or deleted tasks once the transaction is committed"""
+    keys = {TASK_EXISTS_KEY.format(task_id): exists for task_id in task_ids}
+    transaction.on_commit(lambda: cache.set_many(keys, timeout=VERSION_TIMEOUT))
+
+
+def bump_watchers_versions(*task_ids):
+    _bump(WATCHERS_VERSION_KEY.format(task_id) for task_id in set(task_ids) if task_id is not None)
+
+
+def version_etag(request, *versions) -> str:
+    """Strong ETag of a response that only depends on the request URL, the user and `versions`"""
+    key = f"{request.get_full_path()}:{request.user.pk}:{":".join(map(str, versions))}"
+    return f'"{hashlib.sha1(key.encode()).hexdigest()}"'
+
+
+def cached_user_response(request, user_id, render):
+    """
+    Response returned by `render()` with its data cached for the request URL and the user's version.
+
+    Bumping the version makes every entry rendered under the old one unreachable, so the cached
+    data is never older than the user's last write. Only 200 responses are cached.
+    """
+    url = hashlib.sha1(request.build_absolute_uri().encode()).hexdigest()
+    key = RESPONSE_KEY.format(user_id, user_version(user_id), url)
+    data = cache.get(key)
+    if data is None:
+        response = render()
+        if response.status_code != 200:
+            return response
+        data = response.data
+        cache.set(key, data, timeout=settings.CACHE_RESPONSE_TIMEOUT)
+    return Response(data)
+
+
+def conditional(get_version):
+    """
+    Answer conditional GETs of a viewset method from a version stamp.
+
+    `get_version(request, **kwargs)` returns the stamp of everything the response is rendered from,
+    or None to answer the request unconditionally, e.g. for an object that does not exist.
+    """
+
+    def etag(request, *args, **kwargs):
+        version = get_version(request, **kwargs)
+        return version_etag(request, version) if version is not None else None
+
+    return method_decorator(condition(etag_func=etag))
@@ -1,8 +1,9 @@
 import logging
 
-from django.core.cache import cache
+from django.conf import settings
+from django.db import transaction
 from drf_spectacular.openapi import OpenApiExample, OpenApiTypes
-from drf_spectacular.utils import extend_schema, OpenApiResponse, inline_serializer, OpenApiParameter
+from drf_spectacular.utils import extend_schema, OpenApiResponse, inline_serializer
 from elasticsearch_dsl.query import Q
 from rest_framework.parsers import FormParser, MultiPartParser
 
@@ -11,10 +12,23 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import status, mixins, serializers
-
-from apps.tasks.documents import TaskDocument
+from rest_framework.utils.urls import replace_query_param
+
+from apps.common.cache import get_or_compute
+from apps.common.helpers import ValuesSerializer
+from apps.common.pagination import IdCursorPagination
+from apps.common.streaming import (
+    export_renderer_classes,
+    stream_export,
+    stream_json_array,
+    stream_parameter,
+    wants_stream,
+)
+from apps.tasks import timers
+from apps.tasks.documents import TaskDocument, update_task_documents
 from apps.tasks.exceptions import TimeLogError
-from apps.tasks.models import Task, Comment, TimeLog, TaskAttachment
+from apps.tasks.imports import CSV_MEDIA_TYPES, NDJSON_MEDIA_TYPES, import_time_logs, read_records
+from apps.tasks.models import Task, Comment, TimeLog, TaskAttachment, TaskWatcher
 from apps.tasks.serializers import (
     TaskSerializer,
     TaskPreviewSerializer,
@@ -24,19 +38,68 @@ from apps.tasks.serializers import (
     EmptySerializer,
     TimeLogSerializer,
     TimeLogTopSerializer,
+    TimeLogImportResultSerializer,
     TaskAttachmentSerializer,
+    TaskBulkSerializer,
+    TaskDocumentSearchSerializer,
+    TaskBulkAssignSerializer,
+    TaskBulkResultSerializer,
+    TaskBulkCreateResultSerializer,
+    TaskExportSerializer,
+    TaskExportFilterSerializer,
+    TimeLogExportSerializer,
+    TimeLogExportFilterSerializer,
+)
+from apps.tasks.outbox import publish
+from apps.tasks.versions import (
+    bump_user_versions,
+    cached_user_response,
+    conditional,
+    set_tasks_exist,
+    task_exists,
+    task_version,
+    user_version,
 )
-from apps.tasks.signals import task_comment, task_assigned, task_complete, task_undo
 from apps.users.models import User
 
 logger = logging.getLogger("django")
 
+task_preview_rows = ValuesSerializer(TaskPreviewSerializer)
+time_log_rows = ValuesSerializer(TimeLogSerializer)
+comment_rows = ValuesSerializer(CommentSerializer)
+task_export_rows = ValuesSerializer(TaskExportSerializer)
+time_log_export_rows = ValuesSerializer(TimeLogExportSerializer)
+
+# Matching comments returned per hit of a task search
+SEARCH_MATCHING_COMMENTS = 20
+
+# The top logs are cached per user version, the timeout only moves the 30-day window forward
+TOP_LOGS_CACHE_TIMEOUT = 60
+
+user_tasks_conditional = conditional(lambda request, **kwargs: user_version(request.user.id))
+
+
+def existing_task_version(request, **kwargs):
+    """Version of the task, None for a task that does not exist so that it is answered 404 rather than 304"""
+    pk = kwargs["pk"]
+    if not str(pk).isdigit() or not task_exists(pk, Task.objects.filter(id=pk).exists):
+        return None
+    return task_version(pk)
+
+
+task_conditional = conditional(existing_task_version)
+
 
 class TaskViewSet(ModelViewSet):
     serializer_class = TaskSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = IdCursorPagination
     queryset = Task.objects.all()
 
+    def preview_page(self, queryset):
+        page = self.paginate_queryset(task_preview_rows.values(queryset))
+        return self.get_paginated_response(task_preview_rows.to_representation(page))
+
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -45,18 +108,43 @@ class TaskViewSet(ModelViewSet):
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
     @extend_schema(responses={200: TaskPreviewSerializer})
+    @user_tasks_conditional
     def list(self, request, *args, **kwargs):
         queryset = Task.objects.filter(user=request.user)
+        return cached_user_response(request, request.user.id, lambda: self.preview_page(queryset))
 
-        serializer = TaskPreviewSerializer(queryset, many=True)
-        return Response(serializer.data)
+    @task_conditional
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
-    @extend_schema(responses={200: TaskPreviewSerializer(many=True)})
+    @extend_schema(parameters=[stream_parameter], responses={200: TaskPreviewSerializer(many=True)})
     @action(detail=False, methods=["GET"], url_path="all", url_name="all-tasks")
     def all_tasks(self, request, *args, **kwargs):
         queryset = Task.objects.all()
-        serializer = TaskPreviewSerializer(queryset, many=True)
-        return Response(serializer.data)
+        if wants_stream(request):
+            return stream_json_array(task_preview_rows.iterator(queryset.order_by("id")))
+        return self.preview_page(queryset)
+
+    @extend_schema(parameters=[TaskExportFilterSerializer], responses={200: TaskExportSerializer(many=True)})
+    @action(
+        detail=False,
+        methods=["GET"],
+        url_path="export",
+        url_name="export",
+        renderer_classes=export_renderer_classes,
+        pagination_class=None,
+    )
+    def export_tasks(self, request, *args, **kwargs):
+        serializer = TaskExportFilterSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+
+        tasks = Task.objects.order_by("id")
+        if "user" in serializer.validated_data:
+            tasks = tasks.filter(user=serializer.validated_data["user"])
+
+        rows = task_export_rows.iterator(tasks)
+        fieldnames = [name for name, _, _ in task_export_rows.fields]
+        return stream_export(rows, fieldnames, request.accepted_renderer.format, "tasks")
 
     #
     @extend_schema(responses={200: TaskPreviewSerializer(many=True)})
@@ -67,22 +155,19 @@ class TaskViewSet(ModelViewSet):
             return Response(status=status.HTTP_404_NOT_FOUND)
 
         queryset = Task.objects.filter(user=user_id)
-        serializer = TaskPreviewSerializer(queryset, many=True)
-        return Response(serializer.data)
+        return cached_user_response(request, user_id, lambda: self.preview_page(queryset))
 
     @extend_schema(responses={201: TaskPreviewSerializer(many=True)})
     @action(detail=False, methods=["GET"], url_path="completed")
     def completed_tasks(self, request, *args, **kwargs):
         queryset = Task.objects.filter(is_completed=True, user=request.user)
-        serializer = TaskPreviewSerializer(queryset, many=True)
-        return Response(serializer.data)
+        return cached_user_response(request, request.user.id, lambda: self.preview_page(queryset))
 
     @extend_schema(responses={200: TaskPreviewSerializer(many=True)})
     @action(detail=False, methods=["GET"], url_path="incomplete")
     def incomplete_tasks(self, request, *args, **kwargs):
         queryset = Task.objects.filter(is_completed=False, user=request.user)
-        serializer = TaskPreviewSerializer(queryset, many=True)
-        return Response(serializer.data)
+        return cached_user_response(request, request.user.id, lambda: self.preview_page(queryset))
 
     @extend_schema(responses={200: TaskPreviewSerializer(many=True)})
     @action(detail=False, methods=["POST"], url_path="search", serializer_class=TaskSearchSerializer)
@@ -90,8 +175,115 @@ class TaskViewSet(ModelViewSet):
         search_serializer = self.get_serializer(data=request.data)
         search_serializer.is_valid(raise_exception=True)
         queryset = Task.objects.filter(title__icontains=search_serializer.validated_data["search"])
-        serializer = TaskPreviewSerializer(queryset, many=True)
-        return Response(serializer.data)
+        return self.preview_page(queryset)
+
+    @extend_schema(request=TaskSerializer(many=True), responses={200: TaskBulkCreateResultSerializer(many=True)})
+    @action(detail=False, methods=["POST"], url_path="bulk", url_name="bulk", pagination_class=None)
+    def bulk_create_tasks(self, request, *args, **kwargs):
+        if not isinstance(request.data, list) or not 0 < len(request.data) <= settings.BULK_MAX_ITEMS:
+            return Response(
+                {"error": f"Expected a list of 1 to {settings.BULK_MAX_ITEMS} tasks"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        results = []
+        tasks = []
+        for index, item in enumerate(request.data):
+            serializer = self.get_serializer(data=item)
+            if serializer.is_valid():
+                tasks.append((index, Task(**{**serializer.validated_data, "user": request.user})))
+            else:
+                results.append({"index": index, "errors": serializer.errors})
+
+        with transaction.atomic():
+            created = Task.objects.bulk_create([task for _, task in tasks])
+            # bulk_create() sends no post_save, the owner is added to the watchers here
+            TaskWatcher.add((task.id, request.user.id) for task in created)
+            set_tasks_exist([task.id for task in created], True)
+        bump_user_versions(request.user.id)
+        update_task_documents([task.id for task in created])
+
+        results += [{"index": index, "id": task.id} for index, task in tasks]
+        return Response(sorted(results, key=lambda result: result["index"]))
+
+    def bulk_set_completed(self, request, is_completed, message, error, event):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        task_ids = list(dict.fromkeys(serializer.validated_data["ids"]))
+
+        existing = set(Task.objects.filter(id__in=task_ids).values_list("id", flat=True))
+        with transaction.atomic():
+            changed = Task.objects.filter(id__in=task_ids).set_completed(is_completed)
+            if changed:
+                publish(event, task_ids=changed)
+        if changed:
+            update_task_documents(changed)
+        return Response(self.bulk_results(task_ids, existing, set(changed), message, error))
+
+    @staticmethod
+    def bulk_results(task_ids, existing, changed, message, error):
+        results = []
+        for task_id in task_ids:
+            if task_id not in existing:
+                results.append({"id": task_id, "error": "Task does not exist"})
+            elif task_id in changed:
+                results.append({"id": task_id, "message": message})
+            else:
+                results.append({"id": task_id, "error": error})
+        return results
+
+    @extend_schema(responses={200: TaskBulkResultSerializer(many=True)})
+    @action(
+        detail=False,
+        methods=["PATCH"],
+        url_path="bulk-complete",
+        serializer_class=TaskBulkSerializer,
+        pagination_class=None,
+    )
+    def bulk_complete(self, request, *args, **kwargs):
+        return self.bulk_set_completed(
+            request, True, "Task completed successfully", "Task already completed", "tasks_complete"
+        )
+
+    @extend_schema(responses={200: TaskBulkResultSerializer(many=True)})
+    @action(
+        detail=False,
+        methods=["PATCH"],
+        url_path="bulk-undo",
+        serializer_class=TaskBulkSerializer,
+        pagination_class=None,
+    )
+    def bulk_undo(self, request, *args, **kwargs):
+        return self.bulk_set_completed(
+            request, False, "Task undone successfully", "Task not yet completed", "tasks_undo"
+        )
+
+    @extend_schema(responses={200: TaskBulkResultSerializer(many=True)})
+    @action(
+        detail=False,
+        methods=["PATCH"],
+        url_path="bulk-assign",
+        serializer_class=TaskBulkAssignSerializer,
+        pagination_class=None,
+    )
+    def bulk_assign(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        task_ids = list(dict.fromkeys(serializer.validated_data["ids"]))
+        new_user = serializer.validated_data["user"]
+
+        existing = set(Task.objects.filter(id__in=task_ids).values_list("id", flat=True))
+        with transaction.atomic():
+            changed = Task.objects.filter(id__in=task_ids).assign(new_user)
+            if changed:
+                publish("tasks_assigned", user_id=new_user.id, task_ids=changed)
+        if changed:
+            update_task_documents(changed)
+        return Response(
+            self.bulk_results(
+                task_ids, existing, set(changed), "Task assigned successfully", "Task already belongs to user"
+            )
+        )
 
     @extend_schema(
         responses={
@@ -118,8 +310,9 @@ class TaskViewSet(ModelViewSet):
         if task.user == new_user:
             return Response({"error": "Task already belongs to user"}, status=status.HTTP_400_BAD_REQUEST)
 
-        task.assign_user(new_user)
-        task_assigned.send(sender=None, user=new_user, task=task)
+        with transaction.atomic():
+            task.assign_user(new_user)
+            publish("task_assigned", user_id=new_user.id, task_id=task.id)
         return Response({"message": "Task assigned successfully"})
 
     @extend_schema(
@@ -142,8 +335,9 @@ class TaskViewSet(ModelViewSet):
         if task.is_completed:
             return Response({"error": "Task already completed"}, status=status.HTTP_400_BAD_REQUEST)
 
-        task.complete_task()
-        task_complete.send(sender=self.__class__, task=task)
+        with transaction.atomic():
+            task.complete_task()
+            publish("task_complete", task_id=task.id)
         return Response({"message": "Task completed successfully"}, status=status.HTTP_200_OK)
 
     @extend_schema(
@@ -166,8 +360,9 @@ class TaskViewSet(ModelViewSet):
         if not task.is_completed:
             return Response({"error": "Task not yet completed"}, status=status.HTTP_400_BAD_REQUEST)
 
-        task.undo_task()
-        task_undo.send(sender=self.__class__, task=task)
+        with transaction.atomic():
+            task.undo_task()
+            publish("task_undo", task_id=task.id)
         return Response({"message": "Task undone successfully"}, status=status.HTTP_200_OK)
 
     @extend_schema(
@@ -179,6 +374,7 @@ class TaskViewSet(ModelViewSet):
         }
     )
     @action(detail=True, methods=["GET"], url_path="comments")
+    @task_conditional
     def comments(self, request, *args, **kwargs):
         if not Task.objects.filter(id=kwargs["pk"]).exists():
             return Response({"error": "Task does not exist"}, status=status.HTTP_404_NOT_FOUND)
@@ -228,16 +424,19 @@ class TaskViewSet(ModelViewSet):
         serializer = TaskSerializer(task)
         return Response({"message": "Timer stopped", "time spent on task": serializer.data["time_spent"]}, status=200)
 
-    @extend_schema(responses={200: TimeLogSerializer(many=True)})
-    @action(detail=True, methods=["GET"], url_path="timer-logs", serializer_class=TimeLogSerializer)
+    @extend_schema(parameters=[stream_parameter], responses={200: TimeLogSerializer(many=True)})
+    @action(
+        detail=True, methods=["GET"], url_path="timer-logs", serializer_class=TimeLogSerializer, pagination_class=None
+    )
+    @task_conditional
     def timer_logs(self, request, *args, **kwargs):
         if not Task.objects.filter(id=kwargs["pk"]).exists():
             return Response({"error": "Task does not exist"}, status=status.HTTP_404_NOT_FOUND)
 
-        task = Task.objects.get(id=kwargs["pk"])
-        time_logs = task.get_time_logs()
-        serializer = self.get_serializer(time_logs, many=True)
-        return Response(serializer.data)
+        time_logs = TimeLog.objects.filter(task=kwargs["pk"])
+        if wants_stream(request):
+            return stream_json_array(time_log_rows.iterator(time_logs))
+        return Response(time_log_rows.to_representation(time_log_rows.values(time_logs)))
 
     @extend_schema(
         request={
@@ -266,13 +465,17 @@ class TaskViewSet(ModelViewSet):
 
         return Response({"attach_id": instance.id, "task_id:": task.id}, status=status.HTTP_201_CREATED)
 
-    @extend_schema(responses={200: TaskAttachmentSerializer(many=True)})
-    @action(detail=True, methods=["GET"], serializer_class=TaskAttachmentSerializer)
+    @extend_schema(parameters=[stream_parameter], responses={200: TaskAttachmentSerializer(many=True)})
+    @action(detail=True, methods=["GET"], serializer_class=TaskAttachmentSerializer, pagination_class=None)
     def attachments(self, request, *args, **kwargs):
         if not Task.objects.filter(id=kwargs["pk"]).exists():
             return Response({"error": "Task does not exist"}, status=status.HTTP_404_NOT_FOUND)
 
         attachments = TaskAttachment.objects.filter(task=kwargs["pk"])
+        if wants_stream(request):
+            attachments = attachments.iterator(chunk_size=settings.STREAMING_CHUNK_SIZE)
+            return stream_json_array(self.get_serializer(attachment).data for attachment in attachments)
+
         serializer = self.get_serializer(attachments, many=True)
         return Response(serializer.data)
 
@@ -282,6 +485,10 @@ class CommentViewSet(mixins.CreateModelMixin, mixins.ListModelMixin, mixins.Upda
     serializer_class = CommentSerializer
     queryset = Comment.objects.all()
 
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return Response(comment_rows.to_representation(comment_rows.values(queryset)))
+
     @extend_schema(
         request=CommentSerializer,
         responses={
@@ -296,8 +503,9 @@ class CommentViewSet(mixins.CreateModelMixin, mixins.ListModelMixin, mixins.Upda
 
         task = serializer.validated_data["task"]
 
-        comment = serializer.save(user=request.user)
-        task_comment.send(sender=None, user=task.user, task=task, comment=comment)
+        with transaction.atomic():
+            comment = serializer.save(user=request.user)
+            publish("task_comment", user_id=task.user_id, task_id=task.id, comment_id=comment.id)
 
         headers = self.get_success_headers(serializer.data)
         return Response({"comment_id": serializer.data["id"]}, status=status.HTTP_201_CREATED, headers=headers)
@@ -351,6 +559,36 @@ class TaskTimeLogViewSet(mixins.CreateModelMixin, GenericViewSet):
             status=status.HTTP_201_CREATED,
         )
 
+    @extend_schema(
+        request={media_type: OpenApiTypes.STR for media_type in CSV_MEDIA_TYPES + NDJSON_MEDIA_TYPES},
+        responses={
+            200: TimeLogImportResultSerializer,
+            409: OpenApiResponse(
+                response=OpenApiTypes.OBJECT,
+                examples=[
+                    OpenApiExample(
+                        name="0",
+                        value={
+                            "error": "Time logs of the imported tasks changed during the import, nothing was imported"
+                        },
+                    )
+                ],
+            ),
+        },
+        description=(
+            "Import stopped time logs from a CSV body with a `task,start_time,duration` header "
+            "or from newline delimited JSON objects. Valid rows are imported, the others are reported by line."
+        ),
+    )
+    @action(detail=False, methods=["POST"], url_path="import", url_name="import")
+    def import_logs(self, request, *args, **kwargs):
+        records = read_records(request.stream, request.content_type, settings.TIME_LOG_IMPORT_MAX_ROWS)
+        try:
+            created, errors = import_time_logs(request.user, records)
+        except TimeLogError as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response({"created": created, "errors": errors})
+
     @extend_schema(
         responses={
             200: OpenApiResponse(
@@ -364,90 +602,124 @@ class TaskTimeLogViewSet(mixins.CreateModelMixin, GenericViewSet):
         month_time_spent = TimeLog.user_time_last_month(user)
         return Response({"month_time_spent": month_time_spent})
 
+    @extend_schema(parameters=[TimeLogExportFilterSerializer], responses={200: TimeLogExportSerializer(many=True)})
+    @action(
+        detail=False,
+        methods=["GET"],
+        url_path="export",
+        url_name="export",
+        renderer_classes=export_renderer_classes,
+        pagination_class=None,
+    )
+    def export_logs(self, request, *args, **kwargs):
+        serializer = TimeLogExportFilterSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        filters = serializer.validated_data
+
+        # Ordered by the (start_time) index that also serves the date range
+        time_logs = TimeLog.objects.order_by("start_time", "id")
+        if "from" in filters:
+            time_logs = time_logs.filter(start_time__gte=filters["from"])
+        if "to" in filters:
+            time_logs = time_logs.filter(start_time__lt=filters["to"])
+        if "user" in filters:
+            time_logs = time_logs.filter(task__user=filters["user"])
+        if "task" in filters:
+            time_logs = time_logs.filter(task=filters["task"])
+
+        rows = time_log_export_rows.iterator(time_logs)
+        fieldnames = [name for name, _, _ in time_log_export_rows.fields]
+        return stream_export(rows, fieldnames, request.accepted_renderer.format, "timelogs")
+
     @extend_schema(responses={200: TimeLogSerializer(many=True)})
+    @action(detail=False, methods=["GET"], url_path="running", url_name="running")
+    def running_logs(self, request, *args, **kwargs):
+        return Response(timers.user_running(request.user.id))
+
+    @extend_schema(parameters=[TimeLogTopSerializer], responses={200: TimeLogSerializer(many=True)})
     @action(detail=False, methods=["GET"], url_path="top", url_name="top", serializer_class=TimeLogTopSerializer)
     def top_logs(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.query_params)
         serializer.is_valid(raise_exception=True)
         limit = serializer.validated_data.get("limit")
-        cache_str = self.request.user.username + "month-top-logs" + f":{limit}"
-        cached_logs = cache.get(cache_str)
-        if cached_logs is not None:
-            logger.debug("Used cached logs")
-            top_logs = cached_logs
-        else:
-            top_logs = TimeLog.user_top_logs(request.user, limit)
-            cache.set(cache_str, top_logs, timeout=60)
-
-        response_serializer = TimeLogSerializer(top_logs, many=True)
-        return Response(response_serializer.data)
+        user_id = request.user.id
+        size = TimeLogTopSerializer.MAX_LIMIT
+
+        def compute():
+            logs = TimeLog.user_top_logs(request.user, size)
+            return {"limit": size, "rows": time_log_rows.to_representation(time_log_rows.values(logs))}
+
+        # A top-N answers every smaller limit, and so does one that holds all of the user's logs
+        top_logs = get_or_compute(
+            f"tasks:top-logs:user:{user_id}:{user_version(user_id)}",
+            compute,
+            timeout=TOP_LOGS_CACHE_TIMEOUT,
+            usable=lambda top: limit <= top["limit"] or len(top["rows"]) < top["limit"],
+        )
+        return Response(top_logs["rows"][:limit])
 
 
 class ElasticSearchViewSet(GenericViewSet):
     permission_classes = [IsAuthenticated]
 
     @extend_schema(
-        parameters=[
-            OpenApiParameter(
-                name="title",
-                type=OpenApiTypes.STR,
-                location=OpenApiParameter.QUERY,
-                required=False,
-                description="Title of the task (optional)",
-            ),
-            OpenApiParameter(
-                name="description",
-                type=OpenApiTypes.STR,
-                location=OpenApiParameter.QUERY,
-                required=False,
-                description="Description of the task (optional)",
-            ),
-            OpenApiParameter(
-                name="comment-body",
-                type=OpenApiTypes.STR,
-                location=OpenApiParameter.QUERY,
-                required=False,
-                description="Body of comment associated with the task (optional)",
-            ),
-            OpenApiParameter(
-                name="limit",
-                type=OpenApiTypes.INT,
-                location=OpenApiParameter.QUERY,
-                required=False,
-                description="Length of the response (optional, defaults to 20)",
-            ),
-        ],
-        responses={200: "Response schema or serializer here"},
+        parameters=[TaskDocumentSearchSerializer],
+        responses={200: OpenApiResponse(response=OpenApiTypes.OBJECT, description="Task documents")},
     )
     @action(detail=False, methods=["GET"], url_path="task", url_name="task")
     def task_search(self, request, *args, **kwargs):
-        title = request.query_params.get("title")
-        description = request.query_params.get("description")
-        comment_body = request.query_params.get("comment-body")
-        limit = request.query_params.get("limit")
-
-        if not limit:
-            limit = 20
+        """
+        Search the task documents, sorted by score. The next page is linked by a search_after cursor in the
+        Link header and the total number of hits is sent in the X-Total-Count and X-Total-Relation headers.
+        """
+        serializer = TaskDocumentSearchSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        matching_comments = params["comments"] == "matching"
 
         queries = []
-        if title:
-            queries.append(Q("match", title=title))
-        if description:
-            queries.append(Q("match", description=description))
-        if comment_body:
-            queries.append(Q("nested", path="comments", query=Q("match", comments__body=comment_body)))
+        if "title" in params:
+            queries.append(Q("match", title=params["title"]))
+        if "description" in params:
+            queries.append(Q("match", description=params["description"]))
+        if "comment-body" in params:
+            comments_query = Q("match", comments__body=params["comment-body"])
+            if matching_comments:
+                inner_hits = {"size": SEARCH_MATCHING_COMMENTS, "_source": ["comments.body"]}
+                queries.append(Q("nested", path="comments", query=comments_query, inner_hits=inner_hits))
+            else:
+                queries.append(Q("nested", path="comments", query=comments_query))
 
         if not queries:
             return Response({"error": "No query was provided"}, status=status.HTTP_400_BAD_REQUEST)
 
-        search_query = Q("bool", must=queries)
+        search = TaskDocument.search().query(Q("bool", must=queries))
+        # The id breaks ties between equal scores, so the search_after cursor is stable
+        search = search.sort("_score", {"id": {"order": "asc", "unmapped_type": "long"}})
+        track_total_hits = {"exact": True, "capped": settings.ELASTICSEARCH_TOTAL_HITS_CAP, "none": False}
+        search = search.extra(size=params["limit"], track_total_hits=track_total_hits[params["total"]])
+        if "cursor" in params:
+            search = search.extra(search_after=params["cursor"])
 
-        search = TaskDocument.search()
-        search = search.query(search_query)
-        search = search.extra(track_total_hits=True)
-        search = search[: int(limit)]
-        search_result = search.execute()
+        excludes = params.get("exclude", []) + ([] if params["comments"] == "all" else ["comments"])
+        if "fields" in params or excludes:
+            search = search.source(includes=params.get("fields", []), excludes=excludes)
 
-        search_results = [hit.to_dict() for hit in search_result]
+        search_result = search.execute()
 
-        return Response(search_results)
+        search_results = []
+        for hit in search_result:
+            result = hit.to_dict()
+            if matching_comments:
+                inner_hits = getattr(hit.meta, "inner_hits", None)
+                result["comments"] = [comment.to_dict() for comment in inner_hits.comments] if inner_hits else []
+            search_results.append(result)
+
+        response = Response(search_results)
+        if len(search_result.hits) == params["limit"]:
+            cursor = TaskDocumentSearchSerializer.encode_cursor(search_result.hits[-1].meta.sort)
+            response["Link"] = f'<{replace_query_param(request.build_absolute_uri(), "cursor", cursor)}>; rel="next"'
+        if params["total"] != "none":
+            response["X-Total-Count"] = search_result.hits.total.value
+            response["X-Total-Relation"] = search_result.hits.total.relation
+        return response
@@ -1,3 +1,5 @@
+import json
+
 from apps.users.models import User
 from django.test import TestCase
 from rest_framework.reverse import reverse
@@ -115,6 +117,16 @@ class TestUsers(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.data), 6)
 
+    def test_user_list_stream(self) -> None:
+        self.client.force_authenticate(user=self.test_user1)
+        response = self.client.get(reverse("users-list"), {"stream": "true"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+
+        users = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(len(users), 6)
+        self.assertEqual(users[0]["fullname"], "user1 user1")
+
     def test_get_user(self) -> None:
         self.client.force_authenticate(user=self.test_user1)
         response = self.client.get(reverse("users-detail", kwargs={"pk": self.test_user1.id}))
@@ -1,5 +1,7 @@
-from django.db.models import Sum, F
+from django.conf import settings
+from django.db.models import F
 
+from apps.common.streaming import stream_json_array, stream_parameter, wants_stream
 from apps.tasks.models import Task
 from apps.users.models import User
 from drf_spectacular.utils import extend_schema, OpenApiResponse, inline_serializer
@@ -36,23 +38,25 @@ class UserViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin, mixins.Updat
 
         return Response(response_data)
 
-    @extend_schema(responses={200: UserPreviewSerializer(many=True)})
+    @extend_schema(parameters=[stream_parameter], responses={200: UserPreviewSerializer(many=True)})
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-
-        response_data = []
-        for user in queryset:
-            response_data.append(
-                {
-                    "id": user.id,
-                    "username": user.username,
-                    "fullname": f"{user.first_name} {user.last_name}",
-                    "email": user.email,
-                }
-            )
+        queryset = self.get_queryset().values("id", "username", "first_name", "last_name", "email")
+        if wants_stream(request):
+            users = queryset.order_by("id").iterator(chunk_size=settings.STREAMING_CHUNK_SIZE)
+            return stream_json_array(self.preview(user) for user in users)
 
+        response_data = [self.preview(user) for user in queryset]
         return Response(response_data)
 
+    @staticmethod
+    def preview(user):
+        return {
+            "id": user["id"],
+            "username": user["username"],
+            "fullname": f"{user["first_name"]} {user["last_name"]}",
+            "email": user["email"],
+        }
+
     @extend_schema(
         request=UserRegisterSerializer,
         responses={
@@ -150,11 +154,7 @@ class UserViewSet(mixins.RetrieveModelMixin, mixins.ListModelMixin, mixins.Updat
 
     @action(detail=True, url_path="top-tasks", url_name="top-tasks")
     def top_tasks(self, request, *args, **kwargs):
-        assert isinstance(F("time_all").desc, object)
-
         tasks = (
-            Task.objects.filter(user=kwargs["pk"])
-            .annotate(time_all=Sum("timelog__duration"))
-            .order_by(F("time_all").desc(nulls_last=True))[:20]
+            Task.objects.filter(user=kwargs["pk"]).with_time_spent().order_by(F("time_all").desc(nulls_last=True))[:20]
         )
         return render(request, "tasks/tasks_email.html", {"tasks": tasks})
@@ -28,6 +28,20 @@ env = environ.Env(
     CACHE_DEFAULT_BACKEND=(str, "none"),  # options: none, redis
     CACHE_HOST=(str, "localhost"),
     CACHE_PORT=(int, 6379),
+    CACHE_RESPONSE_TIMEOUT=(int, 60 * 60 * 24),
+    PAGINATION_PAGE_SIZE=(int, 100),
+    PAGINATION_MAX_PAGE_SIZE=(int, 1000),
+    STREAMING_CHUNK_SIZE=(int, 2000),
+    BULK_MAX_ITEMS=(int, 1000),
+    TIME_LOG_IMPORT_MAX_ROWS=(int, 100_000),
+    WEEKLY_REPORT_CHUNK_SIZE=(int, 500),
+    MAIL_BATCH_SIZE=(int, 100),
+    NOTIFICATION_DIGEST_WINDOW=(int, 60 * 10),
+    NOTIFICATION_DIGEST_MAX_EVENTS=(int, 20),
+    TIMER_RECONCILE_INTERVAL=(int, 60 * 5),
+    OUTBOX_RELAY_INTERVAL=(int, 30),
+    OUTBOX_RELAY_BATCH_SIZE=(int, 500),
+    OUTBOX_MAX_ATTEMPTS=(int, 10),
     EMAIL_HOST=(str, "localhost"),
     EMAIL_BACKEND=(str, "django.core.mail.backends.smtp.EmailBackend"),
     CELERY_ACTIVE=(bool, True),
@@ -39,6 +53,8 @@ env = environ.Env(
     S3_EXTERNAL_HOST=(str, "localhost"),
     ELASTICSEARCH_ACTIVE=(bool, True),
     ELASTICSEARCH_HOST=(str, "localhost"),
+    ELASTICSEARCH_INDEX_WINDOW=(int, 5),
+    ELASTICSEARCH_TOTAL_HITS_CAP=(int, 10000),
     OAUTH_CLIENT_ID_GITHUB=(str, ""),
     OAUTH_CLIENT_SECRET_GITHUB=(str, ""),
 )
@@ -163,6 +179,20 @@ REST_FRAMEWORK = {
     "DEFAULT_SCHEMA_CLASS": "drf_spectacular.openapi.AutoSchema",
 }
 
+# Pagination
+
+PAGINATION_PAGE_SIZE = env("PAGINATION_PAGE_SIZE")
+PAGINATION_MAX_PAGE_SIZE = env("PAGINATION_MAX_PAGE_SIZE")
+
+# Number of rows fetched per server-side cursor round trip and encoded per chunk of streamed responses
+STREAMING_CHUNK_SIZE = env("STREAMING_CHUNK_SIZE")
+
+# Maximum number of tasks handled by one request to the bulk endpoints
+BULK_MAX_ITEMS = env("BULK_MAX_ITEMS")
+
+# Maximum number of time logs in one import
+TIME_LOG_IMPORT_MAX_ROWS = env("TIME_LOG_IMPORT_MAX_ROWS")
+
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
@@ -206,6 +236,17 @@ CACHES = {
     "default": cache_setups[env("CACHE_DEFAULT_BACKEND")],
 }
 
+# Running timers are kept in redis hashes, other cache backends read them from the database
+TIMER_REGISTRY_ACTIVE = env("CACHE_DEFAULT_BACKEND") == "redis"
+# Seconds between the rebuilds of the registry from the database, repairing entries lost to evictions or flushes
+TIMER_RECONCILE_INTERVAL = env("TIMER_RECONCILE_INTERVAL")
+
+# Cached responses are invalidated by version stamps, the timeout only drops entries of outdated versions
+CACHE_RESPONSE_TIMEOUT = env("CACHE_RESPONSE_TIMEOUT")
+
+# Covering indexes (Index.include) only exist on PostgreSQL, SQLite creates them without the extra columns
+SILENCED_SYSTEM_CHECKS = ["models.W040"]
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -313,6 +354,14 @@ EMAIL_HOST_PASSWORD = ""
 
 DEFAULT_FROM_EMAIL = "example@mail.com"
 
+# Emails sent over one SMTP connection by a batch mail task
+MAIL_BATCH_SIZE = env("MAIL_BATCH_SIZE")
+
+# Task notifications of a user are mailed as one digest, at most this many seconds after the first one
+# or as soon as this many are pending
+NOTIFICATION_DIGEST_WINDOW = env("NOTIFICATION_DIGEST_WINDOW")
+NOTIFICATION_DIGEST_MAX_EVENTS = env("NOTIFICATION_DIGEST_MAX_EVENTS")
+
 # Logging
 
 LOGGING = {
@@ -352,6 +401,15 @@ CELERY_RESULT_BACKEND = "django-db"
 
 CELERY_TASK_SERIALIZER = "json"
 
+# Seconds between the periodic relays of the outbox events, and events relayed per transaction
+OUTBOX_RELAY_INTERVAL = env("OUTBOX_RELAY_INTERVAL")
+OUTBOX_RELAY_BATCH_SIZE = env("OUTBOX_RELAY_BATCH_SIZE")
+# Failed relays of an event before it is set aside, retried after OUTBOX_RELAY_INTERVAL seconds doubling each time
+OUTBOX_MAX_ATTEMPTS = env("OUTBOX_MAX_ATTEMPTS")
+
+# Users per weekly report task
+WEEKLY_REPORT_CHUNK_SIZE = env("WEEKLY_REPORT_CHUNK_SIZE")
+
 # Elastic search
 
 ELASTICSEARCH_ACTIVE = env("ELASTICSEARCH_ACTIVE")
@@ -362,6 +420,15 @@ ELASTICSEARCH_DSL = {
     }
 }
 
+# Changed tasks are queued and indexed in bulk by a Celery task instead of during the request
+ELASTICSEARCH_DSL_SIGNAL_PROCESSOR = "apps.tasks.documents.TaskSignalProcessor"
+
+# Seconds the changes of a task are collected before its document is indexed
+ELASTICSEARCH_INDEX_WINDOW = env("ELASTICSEARCH_INDEX_WINDOW")
+
+# Hits counted by a task search with a capped total
+ELASTICSEARCH_TOTAL_HITS_CAP = env("ELASTICSEARCH_TOTAL_HITS_CAP")
+
 # AllAuth
 
 SITE_ID = 1